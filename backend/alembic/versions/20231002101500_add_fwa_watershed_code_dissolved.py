@@ -0,0 +1,106 @@
+"""add fwa_watershed_code_dissolved
+
+Revision ID: 5d1e7c3a9b42
+Revises: a147b403c0a6
+Create Date: 2023-10-02 10:15:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1e7c3a9b42'
+down_revision = 'a147b403c0a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # each row is the dissolved geometry of a complete tributary sub-basin:
+    # every fundamental watershed with a wscode_ltree that is a descendant of (or equal to)
+    # the row's wscode_ltree.  Only sub-basins made up of many polygons are stored;
+    # smaller ones are cheap enough to union on demand.
+    op.execute("""
+    CREATE TABLE IF NOT EXISTS fwa_watershed_code_dissolved (
+        wscode_ltree ltree PRIMARY KEY,
+        polygon_count integer NOT NULL,
+        area_sqm double precision NOT NULL,
+        geom geometry(MultiPolygon, 4326) NOT NULL
+    );
+    COMMENT ON TABLE fwa_watershed_code_dissolved IS 'Pre-dissolved geometry of complete FWA tributary sub-basins, keyed by watershed code. Rebuilt with refresh_fwa_watershed_code_dissolved() after loading freshwater_atlas_watersheds.';
+    CREATE INDEX IF NOT EXISTS fwa_watershed_code_dissolved_wscode_ltree_gist_idx ON fwa_watershed_code_dissolved USING GIST (wscode_ltree);
+    """)
+
+    # builds the table bottom up along the watershed code hierarchy.  A sub-basin is
+    # the union of its own polygons and the (already dissolved) sub-basins of its tributaries
+    # one level down, so every polygon is only unioned a handful of times.
+    # Sub-basins with fewer than min_polygon_count polygons are discarded once their parent
+    # has been built.
+    op.execute("""
+    CREATE OR REPLACE FUNCTION refresh_fwa_watershed_code_dissolved(min_polygon_count integer DEFAULT 250) RETURNS void
+        LANGUAGE plpgsql
+        AS $$
+    DECLARE
+        lvl integer;
+    BEGIN
+        DROP TABLE IF EXISTS tmp_subbasin;
+        CREATE TEMP TABLE tmp_subbasin ON COMMIT DROP AS
+            SELECT  wscode_ltree,
+                    nlevel(wscode_ltree) as code_level,
+                    count(*)::integer as polygon_count,
+                    coalesce(sum("FEATURE_AREA_SQM"), 0)::double precision as area_sqm,
+                    ST_Union("GEOMETRY") as geom
+            FROM    freshwater_atlas_watersheds
+            WHERE   wscode_ltree IS NOT NULL
+            GROUP BY wscode_ltree;
+        CREATE INDEX ON tmp_subbasin (code_level);
+        CREATE UNIQUE INDEX ON tmp_subbasin (wscode_ltree);
+
+        FOR lvl IN REVERSE (SELECT coalesce(max(code_level) - 1, 0) FROM tmp_subbasin)..1 LOOP
+            -- add parent codes that don't have any polygons of their own.
+            INSERT INTO tmp_subbasin (wscode_ltree, code_level, polygon_count, area_sqm, geom)
+            SELECT  DISTINCT subpath(c.wscode_ltree, 0, lvl), lvl, 0, 0, NULL::geometry
+            FROM    tmp_subbasin c
+            WHERE   c.code_level = lvl + 1
+            AND     NOT EXISTS (
+                SELECT 1 FROM tmp_subbasin p WHERE p.wscode_ltree = subpath(c.wscode_ltree, 0, lvl)
+            );
+
+            WITH tributaries as (
+                SELECT  subpath(wscode_ltree, 0, lvl) as parent,
+                        sum(polygon_count) as polygon_count,
+                        sum(area_sqm) as area_sqm,
+                        array_agg(geom) as geoms
+                FROM    tmp_subbasin
+                WHERE   code_level = lvl + 1
+                GROUP BY 1
+            )
+            UPDATE  tmp_subbasin p
+            SET     polygon_count = p.polygon_count + t.polygon_count,
+                    area_sqm = p.area_sqm + t.area_sqm,
+                    geom = ST_Union(array_remove(array_prepend(p.geom, t.geoms), NULL))
+            FROM    tributaries t
+            WHERE   p.wscode_ltree = t.parent;
+
+            DELETE FROM tmp_subbasin WHERE code_level = lvl + 1 AND polygon_count < min_polygon_count;
+        END LOOP;
+
+        DELETE FROM tmp_subbasin WHERE polygon_count < min_polygon_count;
+
+        TRUNCATE fwa_watershed_code_dissolved;
+        INSERT INTO fwa_watershed_code_dissolved (wscode_ltree, polygon_count, area_sqm, geom)
+        SELECT  wscode_ltree, polygon_count, area_sqm, ST_Multi(ST_CollectionExtract(geom, 3))
+        FROM    tmp_subbasin;
+
+        DROP TABLE tmp_subbasin;
+    END;
+    $$;
+    """)
+
+
+def downgrade():
+    op.execute("""
+    DROP FUNCTION IF EXISTS refresh_fwa_watershed_code_dissolved(integer);
+    DROP TABLE IF EXISTS fwa_watershed_code_dissolved;
+    """)
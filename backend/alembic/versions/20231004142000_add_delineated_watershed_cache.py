@@ -0,0 +1,76 @@
+"""add delineated_watershed_cache
+
+Revision ID: 8f02b6d4e1c7
+Revises: 5d1e7c3a9b42
+Create Date: 2023-10-04 14:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8f02b6d4e1c7'
+down_revision = '5d1e7c3a9b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'delineated_watershed_cache',
+        sa.Column('cache_key', sa.TEXT, primary_key=True,
+                  comment='Hash of the upstream method, DEM source, FWA watershed and the point rounded to a DEM cell.'),
+        sa.Column('upstream_method', sa.String, comment='The method used to calculate this watershed.'),
+        sa.Column('dem_source', sa.String, nullable=True, comment='The DEM used (for DEM methods).'),
+        sa.Column('fwa_watershed_id', sa.Integer, nullable=True,
+                  comment='The FWA fundamental watershed containing the point of interest.'),
+        sa.Column('data_version', sa.TEXT, nullable=False,
+                  comment='The FWA and DEM versions this watershed was delineated from.'),
+        sa.Column('watershed', postgresql.JSONB, nullable=False),
+        sa.Column('hit_count', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('create_date', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.Column(
+            'last_accessed_date', sa.DateTime(timezone=True),
+            comment='The date this cached record was last accessed.', nullable=False,
+            server_default=sa.func.now())
+    )
+    op.create_index('delineated_watershed_cache_last_accessed_date_idx',
+                    'delineated_watershed_cache', ['last_accessed_date'])
+
+    # prune entries that haven't been used in 30 days, entries made from an older version
+    # of the data than the newest entry, and anything beyond the 20000 most recently used.
+    op.execute("""
+    CREATE OR REPLACE FUNCTION prune_delineated_watershed_cache() RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+    BEGIN
+    DELETE FROM delineated_watershed_cache WHERE cache_key in (
+        SELECT  cache_key
+        FROM    delineated_watershed_cache
+        WHERE   last_accessed_date < NOW() - INTERVAL '30 days'
+        OR      data_version <> (
+            SELECT data_version FROM delineated_watershed_cache ORDER BY create_date DESC LIMIT 1
+        )
+        OR      cache_key NOT IN (
+            SELECT cache_key FROM delineated_watershed_cache ORDER BY last_accessed_date DESC LIMIT 20000
+        )
+        FOR UPDATE SKIP LOCKED
+    );
+    RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER trigger_prune_delineated_watershed_cache
+    AFTER INSERT ON delineated_watershed_cache
+    EXECUTE PROCEDURE prune_delineated_watershed_cache();
+    """)
+
+
+def downgrade():
+    op.execute("""
+    DROP TRIGGER IF EXISTS trigger_prune_delineated_watershed_cache ON delineated_watershed_cache;
+    DROP FUNCTION IF EXISTS prune_delineated_watershed_cache();
+    """)
+    op.drop_table('delineated_watershed_cache')
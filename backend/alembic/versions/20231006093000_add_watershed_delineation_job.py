@@ -0,0 +1,67 @@
+"""add watershed_delineation_job
+
+Revision ID: c3a9e5f1d7b0
+Revises: 8f02b6d4e1c7
+Create Date: 2023-10-06 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a9e5f1d7b0'
+down_revision = '8f02b6d4e1c7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'watershed_delineation_job',
+        sa.Column('job_id', postgresql.UUID(), primary_key=True),
+        sa.Column('create_user', postgresql.UUID(), nullable=True, comment='The user that requested the job.'),
+        sa.Column('status', sa.String, nullable=False,
+                  comment='queued, running, complete or failed.'),
+        sa.Column('stage', sa.String, nullable=True,
+                  comment='The delineation stage currently running (clip, condition, accumulate, snap, vectorize).'),
+        sa.Column('request', postgresql.JSONB, nullable=False,
+                  comment='The arguments the watershed is being delineated with.'),
+        sa.Column(
+            'generated_watershed_id', sa.Integer,
+            sa.ForeignKey('generated_watershed.generated_watershed_id', ondelete='SET NULL'),
+            nullable=True, comment='The resulting watershed, once the job is complete.'),
+        sa.Column('error', sa.TEXT, nullable=True),
+        sa.Column('create_date', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.Column('update_date', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now())
+    )
+
+    # jobs are only polled for a short time after they finish.
+    op.execute("""
+    CREATE OR REPLACE FUNCTION prune_watershed_delineation_job() RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+    BEGIN
+    DELETE FROM watershed_delineation_job WHERE job_id in (
+        SELECT  job_id
+        FROM    watershed_delineation_job
+        WHERE   update_date < NOW() - INTERVAL '1 day'
+        FOR UPDATE SKIP LOCKED
+    );
+    RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER trigger_prune_watershed_delineation_job
+    AFTER INSERT ON watershed_delineation_job
+    EXECUTE PROCEDURE prune_watershed_delineation_job();
+    """)
+
+
+def downgrade():
+    op.execute("""
+    DROP TRIGGER IF EXISTS trigger_prune_watershed_delineation_job ON watershed_delineation_job;
+    DROP FUNCTION IF EXISTS prune_watershed_delineation_job();
+    """)
+    op.drop_table('watershed_delineation_job')
@@ -0,0 +1,50 @@
+"""add fwa_watershed_attributes
+
+Revision ID: 2b7d4f9c6a13
+Revises: c3a9e5f1d7b0
+Create Date: 2023-10-09 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7d4f9c6a13'
+down_revision = 'c3a9e5f1d7b0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # sums and cell counts (not means) are stored so that the values for a watershed made of
+    # many fundamental watersheds can be added up.
+    op.create_table(
+        'fwa_watershed_attributes',
+        sa.Column('watershed_feature_id', sa.Integer, primary_key=True,
+                  comment='The fundamental watershed (freshwater_atlas_watersheds.WATERSHED_FEATURE_ID).'),
+        sa.Column('area_sqm', sa.Float, nullable=False),
+        sa.Column('precip_sum', sa.Float, nullable=False,
+                  comment='Sum of the mean annual precipitation (mm) of the cells in the polygon.'),
+        sa.Column('precip_count', sa.Integer, nullable=False),
+        sa.Column('pet_sum', sa.Float, nullable=False,
+                  comment='Sum of the potential evapotranspiration (mm) of the cells in the polygon.'),
+        sa.Column('pet_count', sa.Integer, nullable=False),
+        sa.Column('glacier_area_sqm', sa.Float, nullable=False),
+        sa.Column('elevation_histogram', postgresql.JSONB, nullable=False,
+                  comment='Number of CDEM cells at each elevation (1 metre bins), as {"elevation": count}.'),
+        sa.Column('slope_sum', sa.Float, nullable=False,
+                  comment='Sum of the CDEM cell slopes (percent).'),
+        sa.Column('slope_count', sa.Integer, nullable=False),
+        sa.Column('hillshade_sum', sa.Float, nullable=False,
+                  comment='Sum of the hillshade raster cells (0 - 32767).'),
+        sa.Column('hillshade_count', sa.Integer, nullable=False),
+        sa.Column('update_date', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        comment='Precomputed statistics for each FWA fundamental watershed, summed to summarize '
+                'FWA-based watersheds without reading rasters. Built by api/v1/watersheds/fwa_attributes.py.'
+    )
+
+
+def downgrade():
+    op.drop_table('fwa_watershed_attributes')
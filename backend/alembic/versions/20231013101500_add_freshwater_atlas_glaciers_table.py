@@ -0,0 +1,59 @@
+"""add freshwater_atlas_glaciers table
+
+Revision ID: 4a8f1c6e2d93
+Revises: 2b7d4f9c6a13
+Create Date: 2023-10-13 10:15:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2
+
+
+# revision identifiers, used by Alembic.
+revision = '4a8f1c6e2d93'
+down_revision = '2b7d4f9c6a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a local copy of WHSE_BASEMAPPING.FWA_GLACIERS_POLY, so that glacier coverage can be
+    # calculated in the database instead of with a WFS request for every watershed.
+    # The table is loaded by the wfs download + import jobs (see openshift/import-jobs/README.md),
+    # which already use the existing metadata.data_source record for freshwater_atlas_glaciers.
+    op.create_table(
+        'freshwater_atlas_glaciers',
+        sa.Column('WATERBODY_POLY_ID', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('WATERSHED_GROUP_ID', sa.Integer),
+        sa.Column('WATERBODY_TYPE', sa.String),
+        sa.Column('WATERBODY_KEY', sa.Integer),
+        sa.Column('AREA_HA', sa.Float),
+        sa.Column('GNIS_ID_1', sa.Integer),
+        sa.Column('GNIS_NAME_1', sa.String),
+        sa.Column('GNIS_ID_2', sa.Integer),
+        sa.Column('GNIS_NAME_2', sa.String),
+        sa.Column('BLUE_LINE_KEY', sa.Integer),
+        sa.Column('WATERSHED_KEY', sa.Integer),
+        sa.Column('FWA_WATERSHED_CODE', sa.String),
+        sa.Column('LOCAL_WATERSHED_CODE', sa.String),
+        sa.Column('WATERSHED_GROUP_CODE', sa.String),
+        sa.Column('LEFT_RIGHT_TRIBUTARY', sa.String),
+        sa.Column('WATERBODY_KEY_50K', sa.Integer),
+        sa.Column('WATERSHED_GROUP_CODE_50K', sa.String),
+        sa.Column('WATERBODY_KEY_GROUP_CODE_50K', sa.String),
+        sa.Column('WATERSHED_CODE_50K', sa.String),
+        sa.Column('FEATURE_CODE', sa.String),
+        sa.Column('GEOMETRY', geoalchemy2.types.Geometry(srid=4326, spatial_index=False)),
+        sa.Column('OBJECTID', sa.Integer),
+        sa.Column('FEATURE_AREA_SQM', sa.Float),
+        sa.Column('FEATURE_LENGTH_M', sa.Float),
+    )
+    op.create_index(
+        'freshwater_atlas_glaciers_geometry_geom_idx', 'freshwater_atlas_glaciers',
+        ['GEOMETRY'], unique=False, postgresql_using="gist")
+
+
+def downgrade():
+    op.drop_index('freshwater_atlas_glaciers_geometry_geom_idx', table_name='freshwater_atlas_glaciers')
+    op.drop_table('freshwater_atlas_glaciers')
@@ -0,0 +1,42 @@
+"""add hydrologic_zone_boundaries table
+
+Revision ID: 9c5e3b7a1f26
+Revises: 4a8f1c6e2d93
+Create Date: 2023-10-16 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2
+
+
+# revision identifiers, used by Alembic.
+revision = '9c5e3b7a1f26'
+down_revision = '4a8f1c6e2d93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a local copy of WHSE_WATER_MANAGEMENT.HYDZ_HYDROLOGICZONE_SP. Hydrological zone lookups
+    # are made from an in-memory index of this table (see api/v1/models/scsb2016/hydrological_zones.py).
+    # Loaded by the wfs download + import jobs using the existing metadata.data_source record.
+    op.create_table(
+        'hydrologic_zone_boundaries',
+        sa.Column('HYDROLOGICZONE_SP_ID', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('HYDROLOGICZONE_NO', sa.Integer),
+        sa.Column('HYDROLOGICZONE_NAME', sa.String),
+        sa.Column('FEATURE_CODE', sa.String),
+        sa.Column('GEOMETRY', geoalchemy2.types.Geometry(srid=4326, spatial_index=False)),
+        sa.Column('OBJECTID', sa.Integer),
+        sa.Column('FEATURE_AREA_SQM', sa.Float),
+        sa.Column('FEATURE_LENGTH_M', sa.Float),
+    )
+    op.create_index(
+        'hydrologic_zone_boundaries_geometry_geom_idx', 'hydrologic_zone_boundaries',
+        ['GEOMETRY'], unique=False, postgresql_using="gist")
+
+
+def downgrade():
+    op.drop_index('hydrologic_zone_boundaries_geometry_geom_idx', table_name='hydrologic_zone_boundaries')
+    op.drop_table('hydrologic_zone_boundaries')
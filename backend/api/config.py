@@ -40,6 +40,9 @@ SQLALCHEMY_DATABASE_URI = (
     f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}/{POSTGRES_DB}"
 )
 TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+# database connections kept open by each API process, and how many more it can open when busy.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
 MAPBOX_ACCESS_TOKEN = os.getenv("MAPBOX_ACCESS_TOKEN", "")
 MAPBOX_STYLE = os.getenv("MAPBOX_STYLE", "")
 
@@ -59,8 +62,56 @@ MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY", "minio123")
 MINIO_HOST_URL = os.getenv("MINIO_HOST_URL", "127.0.0.1:9000")
 
 WATERSHED_DEBUG = os.getenv("WATERSHED_DEBUG", True)
+
+# engine used to delineate watersheds from a DEM: "numpy" (in-process, see
+# api/v1/watersheds/d8.py) or "wbt" (WhiteboxTools).
+WATERSHED_DELINEATION_ENGINE = os.getenv("WATERSHED_DELINEATION_ENGINE", "numpy")
+
+# change when the DEM rasters in Minio are replaced, so that shared cached watersheds
+# (see api/v1/watersheds/cache.py) delineated from the old rasters are no longer used.
+WATERSHED_DEM_VERSION = os.getenv("WATERSHED_DEM_VERSION", "1")
+
+# background watershed delineation jobs (see api/v1/watersheds/jobs.py): the number of
+# delineations each API process runs at once, and how many more can wait in its queue.
+WATERSHED_JOB_WORKERS = int(os.getenv("WATERSHED_JOB_WORKERS", "2"))
+WATERSHED_JOB_QUEUE_SIZE = int(os.getenv("WATERSHED_JOB_QUEUE_SIZE", "20"))
+
+# the number of candidate watersheds delineated at once when searching for a HYDAT
+# station's watershed (see get_watershed_at_hydat_station).
+WATERSHED_CANDIDATE_WORKERS = int(os.getenv("WATERSHED_CANDIDATE_WORKERS", "4"))
+
+# batch delineation (POST /watersheds/batch): the number of worker processes (one pool per
+# API process, shared by all batches), and the maximum number of points in one request.
+WATERSHED_BATCH_PROCESSES = int(os.getenv("WATERSHED_BATCH_PROCESSES", str(os.cpu_count() or 1)))
+WATERSHED_BATCH_MAX_ITEMS = int(os.getenv("WATERSHED_BATCH_MAX_ITEMS", "10000"))
+HYDRO_ZONE_MODEL_BATCH_MAX_ITEMS = int(os.getenv("HYDRO_ZONE_MODEL_BATCH_MAX_ITEMS", "100000"))
+# "xgboost", or "compiled" to predict with the zone models' trees compiled to NumPy arrays
+# (see api/v1/models/hydrological_zones/compiled.py)
+HYDRO_ZONE_MODEL_BACKEND = os.getenv("HYDRO_ZONE_MODEL_BACKEND", "xgboost")
 RASTER_FILE_DIR = 'raster'
 
+# shared on-disk cache of COG blocks read from Minio (see api/utils/raster_cache.py).
+# Off unless RASTER_CACHE_DIR is set to a directory shared by the API workers.
+RASTER_CACHE_DIR = os.getenv("RASTER_CACHE_DIR", "")
+RASTER_CACHE_SIZE_MB = int(os.getenv("RASTER_CACHE_SIZE_MB", "2048"))
+
+# the most database sessions that TaskGraph tasks (see api/utils/task_graph.py) hold at once in
+# each API process.  Keep it below the connection pool size (DB_POOL_SIZE + DB_MAX_OVERFLOW),
+# so that the request sessions can still get a connection.
+TASK_GRAPH_DB_SESSIONS = int(os.getenv("TASK_GRAPH_DB_SESSIONS", "8"))
+
+# watershed statistics are read from a raster overview when the watershed is large enough that
+# the overview cells would add less than this relative error (see api.utils.raster.select_overview).
+RASTER_OVERVIEW_ERROR_BUDGET = float(os.getenv("RASTER_OVERVIEW_ERROR_BUDGET", "0.02"))
+
+# shared HTTP client for external APIs (DataBC, GWELLS etc, see api/utils/http_client.py):
+# open connections per process and per host, how long idle connections are kept open,
+# and the time limit (seconds) for each request.
+HTTP_CLIENT_MAX_CONNECTIONS = int(os.getenv("HTTP_CLIENT_MAX_CONNECTIONS", "100"))
+HTTP_CLIENT_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_CLIENT_MAX_CONNECTIONS_PER_HOST", "20"))
+HTTP_CLIENT_KEEPALIVE_SECONDS = float(os.getenv("HTTP_CLIENT_KEEPALIVE_SECONDS", "60"))
+HTTP_CLIENT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CLIENT_TIMEOUT_SECONDS", "300"))
+
 AUTH_WELL_KNOWN_ENDPOINT = os.getenv("AUTH_WELL_KNOWN_ENDPOINT", "https://dev.loginproxy.gov.bc.ca/auth/realms/standard/.well-known/openid-configuration")
 AUTH_CLIENT=os.getenv("AUTH_CLIENT", "wally-4389")
 AUTH_CLIENT_APITEST=os.getenv("AUTH_CLIENT_APITEST", "wally-api-4845")
@@ -12,11 +12,13 @@ import api.layers.cadastral
 import api.layers.critical_habitat_species_at_risk
 import api.layers.ecocat_water_related_reports
 import api.layers.first_nations
+import api.layers.freshwater_atlas_glaciers
 import api.layers.freshwater_atlas_stream_directions
 import api.layers.freshwater_atlas_stream_networks
 import api.layers.freshwater_atlas_watersheds
 import api.layers.ground_water_aquifers
 import api.layers.ground_water_wells
+import api.layers.hydrologic_zone_boundaries
 import api.layers.normal_annual_runoff_isolines
 import api.layers.water_allocation_restrictions
 import api.layers.water_rights_applications
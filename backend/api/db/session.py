@@ -3,7 +3,10 @@ from sqlalchemy.orm import scoped_session, sessionmaker
 
 from api import config
 
-engine = create_engine(config.SQLALCHEMY_DATABASE_URI, pool_pre_ping=True)
+# the pool is shared by the request sessions and the TaskGraph task sessions, which are
+# limited to config.TASK_GRAPH_DB_SESSIONS so that requests can still get a connection.
+engine = create_engine(config.SQLALCHEMY_DATABASE_URI, pool_pre_ping=True,
+                       pool_size=config.DB_POOL_SIZE, max_overflow=config.DB_MAX_OVERFLOW)
 db_session = scoped_session(
     sessionmaker(autocommit=False, autoflush=False, bind=engine)
 )
@@ -0,0 +1,53 @@
+# coding: utf-8
+from sqlalchemy import Integer, String, Column, Float
+from api.db.base_class import BaseLayerTable
+from geoalchemy2 import Geometry
+
+
+class FreshwaterAtlasGlaciers(BaseLayerTable):
+    __tablename__ = 'freshwater_atlas_glaciers'
+
+    WATERBODY_POLY_ID = Column(Integer, primary_key=True, autoincrement=False,
+                               comment='The primary key, a unique identifier for each polygon in the layer.')
+    WATERSHED_GROUP_ID = Column(Integer, comment='An automatically generated id that uniquely identifies '
+                                                 'the watershed group feature.')
+    WATERBODY_TYPE = Column(String, comment='The type of waterbody. For glaciers this is G (glacier).')
+    WATERBODY_KEY = Column(Integer, comment='A unique identifier associated with waterbodies in order to '
+                                            'group polygons that make up a single waterbody.')
+    AREA_HA = Column(Float, comment='Area of the waterbody polygon in hectares.')
+    GNIS_ID_1 = Column(Integer, comment='The BCGNIS (BC Geographical Names Information System) feature id '
+                                        'attached to the waterbody.')
+    GNIS_NAME_1 = Column(String, comment='The BCGNIS (BC Geographical Names Information System) name '
+                                         'attached to the waterbody.')
+    GNIS_ID_2 = Column(Integer, comment='The second BCGNIS feature id attached to the waterbody, if any.')
+    GNIS_NAME_2 = Column(String, comment='The second BCGNIS name attached to the waterbody, if any.')
+    BLUE_LINE_KEY = Column(Integer, comment='Uniquely identifies a single flow line such that a main channel '
+                                            'and a secondary channel with the same watershed code would have '
+                                            'different blue line keys.')
+    WATERSHED_KEY = Column(Integer, comment='A key that identifies a stream system.')
+    FWA_WATERSHED_CODE = Column(String, comment='A 143 character code derived using a hierarchy coding scheme.')
+    LOCAL_WATERSHED_CODE = Column(String, comment='A 143 character code similar to the FWA watershed code '
+                                                  'that further subdivides remnant polygons.')
+    WATERSHED_GROUP_CODE = Column(String, comment='The watershed group code associated with the polygon.')
+    LEFT_RIGHT_TRIBUTARY = Column(String, comment='A value attributed via the watershed code to all '
+                                                  'waterbodies indicating on which side of the watershed '
+                                                  'they drain into.')
+    WATERBODY_KEY_50K = Column(Integer, comment='The waterbody key of the waterbody from the 1:50K '
+                                                'watershed atlas.')
+    WATERSHED_GROUP_CODE_50K = Column(String, comment='The watershed group code of the waterbody from the '
+                                                      '1:50K watershed atlas.')
+    WATERBODY_KEY_GROUP_CODE_50K = Column(String, comment='The waterbody key and watershed group code of the '
+                                                          'waterbody from the 1:50K watershed atlas.')
+    WATERSHED_CODE_50K = Column(String, comment='The watershed code of the waterbody from the 1:50K '
+                                                'watershed atlas.')
+    FEATURE_CODE = Column(String, comment='FEATURE CODE contains a value based on the Canadian Council of '
+                                          'Surveys and Mappings (CCSM) system for classification of geographic '
+                                          'features.')
+    GEOMETRY = Column(Geometry(srid=4326), comment='GEOMETRY is the column used to reference the spatial '
+                                                   'coordinates defining the feature.')
+    OBJECTID = Column(Integer, comment='OBJECTID is a required attribute of feature classes and '
+                                       'object classes in a geodatabase.')
+    FEATURE_AREA_SQM = Column(Float, comment='FEATURE_AREA_SQM is the system calculated area of a '
+                                             'two-dimensional polygon in square meters')
+    FEATURE_LENGTH_M = Column(Float, comment='FEATURE_LENGTH_M is the system calculated length or perimeter '
+                                             'of a geometry in meters')
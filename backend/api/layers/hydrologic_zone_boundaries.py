@@ -0,0 +1,25 @@
+# coding: utf-8
+from sqlalchemy import Integer, String, Column, Float
+from api.db.base_class import BaseLayerTable
+from geoalchemy2 import Geometry
+
+
+class HydrologicZoneBoundaries(BaseLayerTable):
+    __tablename__ = 'hydrologic_zone_boundaries'
+
+    HYDROLOGICZONE_SP_ID = Column(Integer, primary_key=True, autoincrement=False,
+                                  comment='A unique identifier for each hydrologic zone polygon.')
+    HYDROLOGICZONE_NO = Column(Integer, comment='The number of the hydrologic zone (1 - 29). The South Coast '
+                                                'Stewardship Baseline model coefficients are by zone number.')
+    HYDROLOGICZONE_NAME = Column(String, comment='The name of the hydrologic zone.')
+    FEATURE_CODE = Column(String, comment='FEATURE CODE contains a value based on the Canadian Council of '
+                                          'Surveys and Mappings (CCSM) system for classification of geographic '
+                                          'features.')
+    GEOMETRY = Column(Geometry(srid=4326), comment='GEOMETRY is the column used to reference the spatial '
+                                                   'coordinates defining the feature.')
+    OBJECTID = Column(Integer, comment='OBJECTID is a required attribute of feature classes and '
+                                       'object classes in a geodatabase.')
+    FEATURE_AREA_SQM = Column(Float, comment='FEATURE_AREA_SQM is the system calculated area of a '
+                                             'two-dimensional polygon in square meters')
+    FEATURE_LENGTH_M = Column(Float, comment='FEATURE_LENGTH_M is the system calculated length or perimeter '
+                                             'of a geometry in meters')
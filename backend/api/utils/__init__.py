@@ -2,14 +2,12 @@
 
 import os
 import uuid
-import fiona
 import math
-from osgeo import gdal
 from typing import Optional
-from tempfile import TemporaryDirectory
-from shapely.geometry import Polygon, Point, mapping
+from shapely.geometry import Polygon, Point
 from shapely.ops import transform
 from api.v1.aggregator.helpers import transform_4326_3005, transform_3005_4326
+from api.utils.raster import clip_raster
 from logging import getLogger
 
 logger = getLogger("utils")
@@ -81,7 +79,8 @@ def new_polygon(centroid: Point, size_sqm: float = 5e6):
 MAX_RASTER_RETRY_BUFFER_AREA_SQM = 20e6
 
 
-def get_raster_dataset(file_name: str, area: Polygon, no_data: int = -32768, retry_min_size: Optional[float] = None):
+def get_raster_dataset(file_name: str, area: Polygon, no_data: int = -32768, retry_min_size: Optional[float] = None,
+                       overview_level: Optional[int] = None):
     """
     Returns a GDAL Dataset containing raster data for a given area
 
@@ -91,44 +90,28 @@ def get_raster_dataset(file_name: str, area: Polygon, no_data: int = -32768, ret
     receive a single pixel when sampling the raster file.  A new, square polygon will be created with
     `retry_min_size` (in square metres) and the function will be called again until we either
     hit MAX_RASTER_RETRY_BUFFER_AREA_SQM or we get a valid result (a dataset with more than 0 pixels)
+
+    overview_level reads a raster overview instead of full resolution data (see api.utils.raster.select_overview)
     """
 
-    with TemporaryDirectory() as rasterdir:
-        extents_file = rasterdir + "/extents.shp"
-
-        # Define a Polygon feature geometry with one attribute
-        poly_schema = {
-            'geometry': 'Polygon',
-            'properties': {'id': 'int'},
-        }
-
-        # Write a new Shapefile with the area of interest
-        with fiona.open(extents_file, 'w', 'ESRI Shapefile', poly_schema, crs=f"EPSG:4326") as c:
-            c.write({
-                'geometry': mapping(area),
-                'properties': {'id': 1},
-            })
-
-        # use gdalwarp to get a raster clipped to the area of interest
-        dataset = gdal.Warp("", file_name, format="MEM",
-                            cutlineDSName=extents_file, cropToCutline=True,
-                            dstNodata=no_data,
-                            )
-
-        if not dataset and retry_min_size:
-            retry_area_sqm = retry_min_size
-            logger.warning(
-                'get_raster_dataset: Area was too small to sample a pixel.  Retrying with a %s sq km square',
-                retry_area_sqm / 1e6)
-            retry_area = new_polygon(area.centroid, size_sqm=retry_area_sqm)
-
-            # set the next retry size to pass into the recursion call. If we're still within the max acceptable
-            # buffered size, set it to double the current area.  If we've hit our limit, set it to None
-            # and we will end up raising an exception instead of retrying.
-            next_retry_size = 2*retry_min_size if retry_min_size < MAX_RASTER_RETRY_BUFFER_AREA_SQM else None
-            return get_raster_dataset(file_name, area=retry_area, no_data=no_data, retry_min_size=next_retry_size)
-
-        if not dataset:
-            raise Exception("Dataset could not be loaded. No data returned.")
-
-        return dataset
+    # use gdalwarp to get a raster clipped to the area of interest
+    dataset = clip_raster(file_name, area, srid=4326, no_data=no_data, overview_level=overview_level)
+
+    if not dataset and retry_min_size:
+        retry_area_sqm = retry_min_size
+        logger.warning(
+            'get_raster_dataset: Area was too small to sample a pixel.  Retrying with a %s sq km square',
+            retry_area_sqm / 1e6)
+        retry_area = new_polygon(area.centroid, size_sqm=retry_area_sqm)
+
+        # set the next retry size to pass into the recursion call. If we're still within the max acceptable
+        # buffered size, set it to double the current area.  If we've hit our limit, set it to None
+        # and we will end up raising an exception instead of retrying.
+        next_retry_size = 2*retry_min_size if retry_min_size < MAX_RASTER_RETRY_BUFFER_AREA_SQM else None
+        return get_raster_dataset(file_name, area=retry_area, no_data=no_data, retry_min_size=next_retry_size,
+                                  overview_level=overview_level)
+
+    if not dataset:
+        raise Exception("Dataset could not be loaded. No data returned.")
+
+    return dataset
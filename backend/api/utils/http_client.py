@@ -0,0 +1,144 @@
+"""
+Shared HTTP client for requests to external APIs (DataBC WFS, GWELLS, the geocoder etc).
+
+Starting an event loop and a ClientSession for every lookup means every request to the same
+host pays for a new DNS lookup and TCP/TLS handshake.  Instead, each process has one
+HttpClient, with:
+
+  - a background thread running its own event loop, so synchronous code (including FastAPI
+    routes running in the threadpool) can make async requests without starting a loop;
+  - one aiohttp ClientSession on that loop, whose connection pool keeps connections open
+    between requests (HTTP_CLIENT_KEEPALIVE_SECONDS), caches DNS lookups and limits the
+    number of connections to each host (HTTP_CLIENT_MAX_CONNECTIONS_PER_HOST).
+
+Coroutines are run on the client's loop with `run`, which blocks until they finish:
+
+    client = get_http_client()
+    results = client.run(fetch_all(requests, client.session))
+
+Each request is limited to HTTP_CLIENT_TIMEOUT_SECONDS by the session, and `run` waits at most
+that long plus RUN_TIMEOUT_MARGIN_SECONDS (or its own `timeout`) before cancelling the coroutine
+and raising TimeoutError, so a stuck loop can't block the calling thread forever.
+
+The client belongs to the process that created it: get_http_client makes a new one in a
+forked process (e.g. gunicorn workers), since the parent's thread and connections can't be
+used there.  It is closed when the process exits.
+"""
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import os
+import threading
+from typing import Awaitable, Optional, TypeVar
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from api.config import (
+    HTTP_CLIENT_MAX_CONNECTIONS, HTTP_CLIENT_MAX_CONNECTIONS_PER_HOST,
+    HTTP_CLIENT_KEEPALIVE_SECONDS, HTTP_CLIENT_TIMEOUT_SECONDS
+)
+
+logger = logging.getLogger("utils")
+
+# how long DNS lookups are cached by the connection pool (seconds)
+DNS_CACHE_SECONDS = 300
+
+DEFAULT_HEADERS = {'accept': 'application/json'}
+
+# extra time `run` waits for a coroutine beyond the session's request timeout (seconds)
+RUN_TIMEOUT_MARGIN_SECONDS = 30
+
+T = TypeVar('T')
+
+
+class HttpClient:
+    """ an aiohttp ClientSession running on a background event loop (see the module docstring) """
+
+    def __init__(self, limit: int = HTTP_CLIENT_MAX_CONNECTIONS,
+                 limit_per_host: int = HTTP_CLIENT_MAX_CONNECTIONS_PER_HOST,
+                 keepalive_timeout: float = HTTP_CLIENT_KEEPALIVE_SECONDS,
+                 timeout: float = HTTP_CLIENT_TIMEOUT_SECONDS):
+        self.pid = os.getpid()
+        self.run_timeout = timeout + RUN_TIMEOUT_MARGIN_SECONDS
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="http-client", daemon=True)
+        self._thread.start()
+
+        async def create_session():
+            connector = TCPConnector(limit=limit, limit_per_host=limit_per_host,
+                                     keepalive_timeout=keepalive_timeout, ttl_dns_cache=DNS_CACHE_SECONDS)
+            return ClientSession(connector=connector, headers=DEFAULT_HEADERS,
+                                 timeout=ClientTimeout(total=timeout))
+
+        # the session has to be created on the loop it will be used on.
+        self.session = self.run(create_session())
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+        """
+        runs `coro` on the client's event loop, and returns its result when it finishes.
+        Raises TimeoutError (and cancels `coro`) if it takes longer than `timeout` seconds
+        (by default, the session's request timeout plus RUN_TIMEOUT_MARGIN_SECONDS).
+        """
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("HttpClient.run can't be called from the client's own event loop")
+        timeout = self.run_timeout if timeout is None else timeout
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"HTTP client request didn't finish in {timeout} seconds") from None
+
+    @property
+    def closed(self) -> bool:
+        return self.loop.is_closed()
+
+    def close(self):
+        """ closes the session's connections and stops the event loop """
+        if self.closed:
+            return
+        try:
+            self.run(self.session.close())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+
+
+_http_client: Optional[HttpClient] = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> HttpClient:
+    """ returns the process' HttpClient, making a new one if there isn't one for this process yet """
+    global _http_client
+    pid = os.getpid()
+    client = _http_client
+    if client is not None and client.pid == pid and not client.closed:
+        return client
+
+    with _http_client_lock:
+        if _http_client is None or _http_client.pid != pid or _http_client.closed:
+            # a client inherited from the parent process is left alone: its loop thread
+            # doesn't exist in this process, and its connections belong to the parent.
+            _http_client = HttpClient()
+            logger.info("started shared HTTP client (pid %s)", pid)
+        return _http_client
+
+
+def close_http_client():
+    """ closes this process' HttpClient, if it has one """
+    global _http_client
+    with _http_client_lock:
+        client = _http_client
+        _http_client = None
+    if client is not None and client.pid == os.getpid():
+        client.close()
+
+
+atexit.register(close_http_client)
@@ -0,0 +1,188 @@
+""" raster I/O helpers that work entirely in memory (no temporary files) """
+
+import json
+import math
+import time
+import uuid
+import numpy as np
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+from osgeo import gdal, ogr, osr
+from shapely import wkb
+from shapely.geometry import MultiPolygon, mapping
+from logging import getLogger
+
+from api.config import RASTER_OVERVIEW_ERROR_BUDGET
+from api.utils.raster_cache import cached_raster
+
+logger = getLogger("utils")
+
+# length of a degree of latitude, in metres
+METRES_PER_DEGREE = 111320
+
+# how long (seconds) the sizes read by get_raster_info are kept before opening the raster again.
+RASTER_INFO_TTL = 300
+
+_raster_info: Dict[str, dict] = {}
+
+
+@contextmanager
+def vsimem_cutline(area, srid: int = 4326):
+    """
+    Writes `area` (a shapely geometry in EPSG:`srid`) to a GeoJSON file in GDAL's
+    in-memory filesystem (/vsimem/) and yields the path, for use as a gdal.Warp cutline.
+    The file is removed when the context exits.
+    """
+    path = f"/vsimem/cutline_{uuid.uuid4().hex}.geojson"
+    feature_collection = {
+        "type": "FeatureCollection",
+        "crs": {"type": "name", "properties": {"name": f"EPSG:{srid}"}},
+        "features": [{
+            "type": "Feature",
+            "geometry": mapping(area),
+            "properties": {"id": 1}
+        }]
+    }
+    gdal.FileFromMemBuffer(path, json.dumps(feature_collection).encode('utf-8'))
+    try:
+        yield path
+    finally:
+        gdal.Unlink(path)
+
+
+def clip_raster(
+        file_name: str,
+        area,
+        srid: int = 4326,
+        no_data=None,
+        dest: str = "",
+        output_format: str = "MEM",
+        overview_level: Optional[int] = None,
+        **warp_options):
+    """
+    Clips `file_name` to `area` (a shapely geometry in EPSG:`srid`) with gdal.Warp.
+    By default the result is an in-memory (MEM) dataset; pass `dest` and `output_format`
+    to write the clipped raster somewhere else (e.g. a GeoTIFF for WhiteboxTools).
+    `overview_level` reads an overview (0 is the first) instead of the full resolution raster.
+    Returns the GDAL dataset, or None if the area didn't cover any pixels.
+    /vsis3/ rasters are read through the local raster block cache (see raster_cache.py).
+    """
+    with vsimem_cutline(area, srid=srid) as cutline, \
+            cached_raster(file_name, area, srid=srid, overview_level=overview_level) as source:
+        options = dict(
+            format=output_format,
+            cutlineDSName=cutline,
+            cropToCutline=True,
+            **warp_options
+        )
+        if no_data is not None:
+            options["dstNodata"] = no_data
+        if overview_level is not None:
+            options["options"] = ["-ovr", str(overview_level)]
+
+        return gdal.Warp(dest, source, **options)
+
+
+def select_overview(
+        file_name: str,
+        area,
+        area_sqm: float,
+        error_budget: float = RASTER_OVERVIEW_ERROR_BUDGET) -> Tuple[Optional[int], float]:
+    """
+    Picks the coarsest overview of `file_name` that can be used to summarize `area` (EPSG:4326,
+    `area_sqm` square metres) within `error_budget`, and returns the overview level (None for
+    full resolution) and its cell size in metres.
+
+    The error of a mean over a polygon comes mostly from the cells cut by its boundary, roughly
+    4 * cell size / sqrt(area) of the area for a compact shape.  Keeping that under the budget
+    means small watersheds are read at full resolution, while large ones are read from an
+    overview with about 16 / error_budget² cells, however large the watershed is.
+    """
+    info = get_raster_info(file_name)
+    cell_area = info['cell_area']
+    if info['geographic']:
+        cell_area *= METRES_PER_DEGREE ** 2 * math.cos(math.radians(area.centroid.y))
+    cell_size = math.sqrt(cell_area)
+    max_cell_size = error_budget * math.sqrt(area_sqm) / 4
+
+    level = None
+    x_size, y_size = info['size']
+    for i, (overview_x_size, overview_y_size) in enumerate(info['overviews']):
+        overview_cell_size = math.sqrt(cell_area * (x_size / overview_x_size) * (y_size / overview_y_size))
+        if overview_cell_size > max_cell_size:
+            break
+        level, cell_size = i, overview_cell_size
+
+    return level, cell_size
+
+
+def get_raster_info(file_name: str) -> dict:
+    """
+    returns the cell area (in the raster's units), whether the coordinate system is geographic,
+    the size and the overview sizes of `file_name`.  The result is kept for RASTER_INFO_TTL
+    seconds, so /vsis3/ rasters aren't opened again for every watershed.
+    """
+    cached = _raster_info.get(file_name)
+    if cached and time.monotonic() - cached['checked'] < RASTER_INFO_TTL:
+        return cached
+
+    dataset = gdal.Open(file_name)
+    if not dataset:
+        raise Exception(f"unable to open {file_name}")
+
+    gt = dataset.GetGeoTransform()
+    band = dataset.GetRasterBand(1)
+    overviews = [band.GetOverview(i) for i in range(band.GetOverviewCount())]
+    info = {
+        'cell_area': abs(gt[1] * gt[5]),
+        'geographic': bool(osr.SpatialReference(wkt=dataset.GetProjection()).IsGeographic()),
+        'size': (dataset.RasterXSize, dataset.RasterYSize),
+        'overviews': [(overview.XSize, overview.YSize) for overview in overviews],
+        'checked': time.monotonic()
+    }
+    overviews = band = dataset = None
+
+    _raster_info[file_name] = info
+    return info
+
+
+def polygonize_band(band) -> MultiPolygon:
+    """
+    use GDAL Polygonize to convert a raster band into a MultiPolygon of the
+    non-zero cells, using an in-memory OGR layer.
+    """
+    vector = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = vector.CreateLayer("polygons", srs=None)
+
+    # the band is also used as the mask, so only non-zero cells are vectorized.
+    gdal.Polygonize(band, band, layer, -1, [], callback=None)
+
+    polygons = [wkb.loads(bytes(feature.GetGeometryRef().ExportToWkb())) for feature in layer]
+    vector = None
+    return MultiPolygon(polygons)
+
+
+def polygonize_array(mask: np.ndarray, geotransform, projection=None) -> MultiPolygon:
+    """
+    converts a boolean raster mask (e.g. a watershed) into a MultiPolygon
+    """
+    nrows, ncols = mask.shape
+    raster = gdal.GetDriverByName("MEM").Create("", ncols, nrows, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform(geotransform)
+    if projection:
+        raster.SetProjection(projection)
+    band = raster.GetRasterBand(1)
+    band.WriteArray(mask.astype(np.uint8))
+
+    return polygonize_band(band)
+
+
+def polygonize_file(file_name: str) -> MultiPolygon:
+    """
+    converts a raster file (e.g. a watershed output by WhiteboxTools) into a
+    MultiPolygon of its non-zero cells.  Band 1 is used.
+    """
+    dataset = gdal.Open(file_name)
+    if not dataset:
+        raise Exception("unable to convert from raster watershed to vector watershed")
+    return polygonize_band(dataset.GetRasterBand(1))
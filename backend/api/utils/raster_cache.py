@@ -0,0 +1,558 @@
+"""
+Shared on-disk block cache for Cloud Optimized GeoTIFFs in Minio (/vsis3/ paths).
+
+GDAL downloads the COG tiles covering each read from Minio, so the same tiles for popular areas
+are downloaded again for every request and by every gunicorn worker.  This cache keeps the bytes
+of the rasters in fixed size blocks (BLOCK_SIZE) on local disk, in a directory shared by all the
+workers (RASTER_CACHE_DIR):
+
+    <RASTER_CACHE_DIR>/<object id>/meta.json    size, etag and header length of the COG
+    <RASTER_CACHE_DIR>/<object id>/00000012     block 12 (bytes 12 * BLOCK_SIZE ...)
+
+The object id includes the etag, so replacing a raster in Minio starts a new set of blocks (the
+etag is checked every RASTER_CACHE_META_TTL seconds).
+
+To read a window, the COG header is used to find the tiles that cover the area (plus a margin of
+one tile), any of their blocks that aren't cached are downloaded (with one range request per run
+of consecutive blocks), and GDAL opens a /vsisparse/ file that maps the cached blocks back to
+their offsets in the COG:
+
+    with cached_raster('/vsis3/raster/WNA_et0.tif', area) as path:
+        dataset = gdal.Warp('', path, format='MEM', ...)
+
+The window must be read inside the `with` block.  Parts of the COG that aren't in the cached
+blocks (e.g. a wider resampling margin, or another overview) are read from /vsis3/, so they are
+slower but never read as zeros.  Rasters that the cache can't safely map (e.g. not a COG, or
+with a mask band) are read straight from /vsis3/.
+
+The cache is kept under RASTER_CACHE_SIZE_MB by removing the least recently used blocks (by
+file modification time, which is updated when a block is read).  Reads hold a shared lock on
+the cache directory that eviction waits for, and check that their blocks are still cached when
+they finish, so a block can't disappear in the middle of a read.
+
+Hits, misses, downloaded bytes and evictions are exported as Prometheus counters.  They are
+kept per process, so under gunicorn /metrics has the counts of the worker that answered.
+
+Areas can be pre-loaded into the cache with:
+
+    python -m api.utils.raster_cache warm --bbox -123.5 49 -122 50 [--raster raster/WNA_et0.tif]
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from osgeo import gdal, osr
+from prometheus_client import Counter
+
+from api.config import RASTER_CACHE_DIR, RASTER_CACHE_SIZE_MB
+
+logger = logging.getLogger("utils")
+
+BLOCK_SIZE = 256 * 1024
+
+# how long (seconds) the size and etag of a raster are trusted before checking Minio again.
+RASTER_CACHE_META_TTL = 300
+
+# runs of missing blocks downloaded at once
+RASTER_CACHE_FETCH_WORKERS = 4
+
+# the cache is trimmed to this fraction of its size limit when it is over the limit.
+EVICT_TO = 0.9
+
+RASTER_CACHE_HITS = Counter('wally_raster_cache_hits', 'Raster blocks read from the local cache')
+RASTER_CACHE_MISSES = Counter('wally_raster_cache_misses', 'Raster blocks downloaded from Minio')
+RASTER_CACHE_FETCHED_BYTES = Counter('wally_raster_cache_fetched_bytes', 'Bytes downloaded from Minio')
+RASTER_CACHE_EVICTIONS = Counter('wally_raster_cache_evictions', 'Raster blocks removed from the cache')
+
+
+def split_vsis3_path(file_name: str) -> Optional[Tuple[str, str]]:
+    """ returns the (bucket, object name) of a /vsis3/ path, or None for other paths """
+    if not file_name.startswith('/vsis3/'):
+        return None
+    bucket, _, key = file_name[len('/vsis3/'):].partition('/')
+    if not bucket or not key:
+        return None
+    return bucket, key
+
+
+def raster_levels(dataset) -> List[List]:
+    """ returns the bands of each level (full resolution first, then the overviews) """
+    bands = [dataset.GetRasterBand(i + 1) for i in range(dataset.RasterCount)]
+    levels = [bands]
+    for i in range(bands[0].GetOverviewCount()):
+        levels.append([band.GetOverview(i) for band in bands])
+    return levels
+
+
+def tile_ranges(band, tiles: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """ returns the (offset, size) of the stored tiles of `band` (empty tiles are skipped) """
+    ranges = []
+    for tx, ty in tiles:
+        offset = band.GetMetadataItem(f'BLOCK_OFFSET_{tx}_{ty}', 'TIFF')
+        size = band.GetMetadataItem(f'BLOCK_SIZE_{tx}_{ty}', 'TIFF')
+        if offset and size and int(size):
+            ranges.append((int(offset), int(size)))
+    return ranges
+
+
+def header_fingerprint(dataset) -> list:
+    """
+    values that are read from the COG header.  If a header-only copy of the file gives the
+    same values as the original, the header (including the tile offsets) is all in the first bytes.
+    """
+    fingerprint = [dataset.RasterXSize, dataset.RasterYSize, dataset.RasterCount, list(dataset.GetGeoTransform())]
+    for bands in raster_levels(dataset):
+        band = bands[0]
+        bx, by = band.GetBlockSize()
+        last = ((band.XSize - 1) // bx, (band.YSize - 1) // by)
+        fingerprint.append([band.XSize, band.YSize, bx, by, tile_ranges(band, [(0, 0), last])])
+    return fingerprint
+
+
+def area_bounds(area, srid: int, dataset) -> Tuple[float, float, float, float]:
+    """ returns the bounds of `area` (EPSG:`srid`) in the coordinate system of `dataset` """
+    src = osr.SpatialReference()
+    src.ImportFromEPSG(srid)
+    dst = osr.SpatialReference(wkt=dataset.GetProjection())
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    minx, miny, maxx, maxy = area.bounds
+    if src.IsSame(dst):
+        return minx, miny, maxx, maxy
+
+    # the edges of the bounding box are curved in the other coordinate system, so points along them are transformed.
+    steps = 16
+    points = []
+    for i in range(steps + 1):
+        x = minx + (maxx - minx) * i / steps
+        y = miny + (maxy - miny) * i / steps
+        points.extend([(x, miny), (x, maxy), (minx, y), (maxx, y)])
+    transformed = osr.CoordinateTransformation(src, dst).TransformPoints(points)
+    xs = [p[0] for p in transformed]
+    ys = [p[1] for p in transformed]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+class RasterCache:
+    """ see the module docstring """
+
+    def __init__(self, cache_dir: str, max_bytes: int, client=None, block_size: int = BLOCK_SIZE,
+                 meta_ttl: float = RASTER_CACHE_META_TTL):
+        """ `client` is a Minio client (anything with stat_object and get_partial_object) """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.meta_ttl = meta_ttl
+        if client is None:
+            from api.minio.client import minio_client
+            client = minio_client
+        self.client = client
+
+        self._meta: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._written = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # locking
+
+    @contextmanager
+    def read_lock(self):
+        """ holds a shared lock on the cache, so that evict() doesn't remove blocks while they are read """
+        with open(os.path.join(self.cache_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # blocks
+
+    def _object_dir(self, meta: dict) -> str:
+        return os.path.join(self.cache_dir, meta['id'])
+
+    def _block_path(self, meta: dict, index: int) -> str:
+        return os.path.join(self._object_dir(meta), f"{index:08d}")
+
+    def _block_length(self, meta: dict, index: int) -> int:
+        return min(self.block_size, meta['size'] - index * self.block_size)
+
+    def _blocks_for(self, ranges: Iterable[Tuple[int, int]]) -> List[int]:
+        """ returns the block indexes covering the (offset, size) byte ranges """
+        blocks = set()
+        for offset, size in ranges:
+            blocks.update(range(offset // self.block_size, (offset + size - 1) // self.block_size + 1))
+        return sorted(blocks)
+
+    def _fetch(self, bucket: str, key: str, meta: dict, first: int, count: int):
+        """ downloads `count` consecutive blocks starting at block `first` with one range request """
+        offset = first * self.block_size
+        length = min(count * self.block_size, meta['size'] - offset)
+        response = self.client.get_partial_object(bucket, key, offset=offset, length=length)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+        if len(data) != length:
+            raise IOError(f"expected {length} bytes of {bucket}/{key} at {offset}, got {len(data)}")
+
+        RASTER_CACHE_FETCHED_BYTES.inc(length)
+        for i in range(count):
+            path = self._block_path(meta, first + i)
+            # written to a temporary file and renamed, so other workers never see a partial block.
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data[i * self.block_size:(i + 1) * self.block_size])
+            os.replace(tmp, path)
+
+    def ensure_blocks(self, bucket: str, key: str, meta: dict, blocks: List[int]):
+        """ downloads the `blocks` that aren't in the cache """
+        missing = []
+        for index in blocks:
+            try:
+                # marks the block as recently used
+                os.utime(self._block_path(meta, index))
+            except FileNotFoundError:
+                missing.append(index)
+
+        RASTER_CACHE_HITS.inc(len(blocks) - len(missing))
+        if not missing:
+            return
+        RASTER_CACHE_MISSES.inc(len(missing))
+
+        runs = []
+        for index in missing:
+            if runs and runs[-1][0] + runs[-1][1] == index:
+                runs[-1][1] += 1
+            else:
+                runs.append([index, 1])
+
+        os.makedirs(self._object_dir(meta), exist_ok=True)
+        if len(runs) == 1:
+            self._fetch(bucket, key, meta, *runs[0])
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(runs), RASTER_CACHE_FETCH_WORKERS)) as executor:
+                for future in [executor.submit(self._fetch, bucket, key, meta, *run) for run in runs]:
+                    future.result()
+
+        with self._lock:
+            self._written += sum(count for _, count in runs) * self.block_size
+
+    def missing_blocks(self, meta: dict, blocks: List[int]) -> List[int]:
+        """ returns the `blocks` that aren't in the cache """
+        return [index for index in blocks if not os.path.exists(self._block_path(meta, index))]
+
+    def evict_if_full(self):
+        """ evicts if enough has been downloaded since the last eviction to fill the cache """
+        with self._lock:
+            if self._written <= self.max_bytes * (1 - EVICT_TO):
+                return
+        if self.evict() is not None:
+            with self._lock:
+                self._written = 0
+
+    @contextmanager
+    def sparse_file(self, meta: dict, blocks: List[int], source: Optional[str] = None):
+        """
+        yields a /vsisparse/ path that reads `blocks` from the cache at their offsets in the COG.
+        The rest of the file is read from `source` if it is given, or as zeros.
+        """
+        regions = ''.join(
+            '<SubfileRegion>'
+            f'<Filename relative="0">{self._block_path(meta, index)}</Filename>'
+            f'<DestinationOffset>{index * self.block_size}</DestinationOffset>'
+            '<SourceOffset>0</SourceOffset>'
+            f'<RegionLength>{self._block_length(meta, index)}</RegionLength>'
+            '</SubfileRegion>'
+            for index in blocks
+        )
+        if source:
+            # the first region containing an offset is used, so this only covers the gaps.
+            regions += (
+                '<SubfileRegion>'
+                f'<Filename relative="0">{source}</Filename>'
+                '<DestinationOffset>0</DestinationOffset>'
+                '<SourceOffset>0</SourceOffset>'
+                f"<RegionLength>{meta['size']}</RegionLength>"
+                '</SubfileRegion>'
+            )
+        xml = f"<VSISparseFile><Length>{meta['size']}</Length>{regions}</VSISparseFile>"
+        path = f"/vsimem/raster_cache_{uuid.uuid4().hex}.xml"
+        gdal.FileFromMemBuffer(path, xml.encode('utf-8'))
+        try:
+            yield f"/vsisparse/{path}"
+        finally:
+            gdal.Unlink(path)
+
+    def evict(self) -> Optional[int]:
+        """
+        removes the least recently used blocks until the cache is under EVICT_TO of its size
+        limit.  Returns the number of blocks removed, or None if the cache is being read or
+        evicted by another thread or process (it is tried again after the next download).
+        """
+        with open(os.path.join(self.cache_dir, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            blocks = []
+            for object_dir in os.scandir(self.cache_dir):
+                if not object_dir.is_dir():
+                    continue
+                for entry in os.scandir(object_dir.path):
+                    if entry.name == 'meta.json' or entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    blocks.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in blocks)
+            if total <= self.max_bytes:
+                return 0
+
+            removed = 0
+            for _, size, path in sorted(blocks):
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+
+        RASTER_CACHE_EVICTIONS.inc(removed)
+        logger.info("raster cache: evicted %s blocks", removed)
+        return removed
+
+    # raster metadata
+
+    def get_meta(self, bucket: str, key: str) -> dict:
+        """
+        returns the size, etag and header length of a raster, and whether the cache can be used
+        for it.  Checked against Minio every `meta_ttl` seconds.
+        """
+        name = f"{bucket}/{key}"
+        meta = self._meta.get(name)
+        if meta and time.monotonic() - meta['checked'] < self.meta_ttl:
+            return meta
+
+        stat = self.client.stat_object(bucket, key)
+        if meta and meta['etag'] == stat.etag:
+            meta['checked'] = time.monotonic()
+            return meta
+
+        object_id = hashlib.sha1(f"{name}:{stat.etag}".encode('utf-8')).hexdigest()
+        meta_path = os.path.join(self.cache_dir, object_id, 'meta.json')
+        try:
+            # inspected by another worker
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            meta = self._inspect(bucket, key, {'id': object_id, 'size': stat.size, 'etag': stat.etag})
+            os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+            tmp = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp, meta_path)
+
+        meta['checked'] = time.monotonic()
+        self._meta[name] = meta
+        return meta
+
+    def _inspect(self, bucket: str, key: str, meta: dict) -> dict:
+        """
+        finds the length of the COG header (everything before the first tile), and checks that
+        a copy with only the header reads the same as the original.
+        """
+        dataset = gdal.Open(f"/vsis3/{bucket}/{key}")
+        if not dataset:
+            raise IOError(f"unable to open /vsis3/{bucket}/{key}")
+
+        meta['cacheable'] = False
+        band = dataset.GetRasterBand(1)
+        if band.GetMaskFlags() & gdal.GMF_PER_DATASET:
+            logger.info("raster cache: not caching %s/%s (mask band)", bucket, key)
+            return meta
+
+        first_tiles = [offset for bands in raster_levels(dataset) for b in bands
+                       for offset, _ in tile_ranges(b, [(0, 0)])]
+        if not first_tiles:
+            return meta
+        meta['header_length'] = min(first_tiles)
+        expected = header_fingerprint(dataset)
+        dataset = None
+
+        header_blocks = self._blocks_for([(0, meta['header_length'])])
+        self.ensure_blocks(bucket, key, meta, header_blocks)
+        with self.sparse_file(meta, header_blocks) as path:
+            header = gdal.Open(path)
+            meta['cacheable'] = bool(header) and header_fingerprint(header) == expected
+            header = None
+
+        if not meta['cacheable']:
+            logger.info("raster cache: not caching %s/%s (the tile offsets aren't in the header)", bucket, key)
+        return meta
+
+    # windows
+
+    def window_blocks(self, bucket: str, key: str, meta: dict, area, srid: int,
+                      overview_level: Optional[int] = None) -> List[int]:
+        """
+        returns the blocks needed to read `area` (EPSG:`srid`) from the raster: the header and
+        the tiles covering the area plus one tile around it, at full resolution or at
+        `overview_level` (0 is the first overview).
+        """
+        header_blocks = self._blocks_for([(0, meta['header_length'])])
+        self.ensure_blocks(bucket, key, meta, header_blocks)
+
+        with self.sparse_file(meta, header_blocks) as path:
+            dataset = gdal.Open(path)
+            minx, miny, maxx, maxy = area_bounds(area, srid, dataset)
+            gt = dataset.GetGeoTransform()
+            levels = raster_levels(dataset)
+            bands = levels[0 if overview_level is None else overview_level + 1]
+
+            ranges = []
+            scale_x = bands[0].XSize / dataset.RasterXSize
+            scale_y = bands[0].YSize / dataset.RasterYSize
+            bx, by = bands[0].GetBlockSize()
+            tiles_x = math.ceil(bands[0].XSize / bx)
+            tiles_y = math.ceil(bands[0].YSize / by)
+
+            col0 = (minx - gt[0]) / gt[1] * scale_x
+            col1 = (maxx - gt[0]) / gt[1] * scale_x
+            row0 = (maxy - gt[3]) / gt[5] * scale_y
+            row1 = (miny - gt[3]) / gt[5] * scale_y
+            tx0 = max(int(math.floor(min(col0, col1) / bx)) - 1, 0)
+            tx1 = min(int(math.floor(max(col0, col1) / bx)) + 1, tiles_x - 1)
+            ty0 = max(int(math.floor(min(row0, row1) / by)) - 1, 0)
+            ty1 = min(int(math.floor(max(row0, row1) / by)) + 1, tiles_y - 1)
+
+            tiles = [(tx, ty) for ty in range(ty0, ty1 + 1) for tx in range(tx0, tx1 + 1)]
+            for band in bands:
+                ranges.extend(tile_ranges(band, tiles))
+            dataset = None
+
+        return sorted(set(header_blocks) | set(self._blocks_for(set(ranges))))
+
+    @contextmanager
+    def window(self, file_name: str, area, srid: int = 4326, overview_level: Optional[int] = None):
+        """
+        yields a path for reading `area` of `file_name` (a /vsis3/ path) from the cache, or
+        `file_name` itself if the raster can't be cached.  Raises IOError if any of the
+        window's blocks were removed from the cache before the read finished.
+        """
+        try:
+            with ExitStack() as lock:
+                lock.enter_context(self.read_lock())
+                blocks = None
+                bucket, key = split_vsis3_path(file_name)
+                try:
+                    meta = self.get_meta(bucket, key)
+                    if meta['cacheable']:
+                        blocks = self.window_blocks(bucket, key, meta, area, srid, overview_level)
+                        self.ensure_blocks(bucket, key, meta, blocks)
+                except Exception as e:
+                    logger.warning("raster cache: reading %s directly: %s", file_name, repr(e))
+                    blocks = None
+
+                if blocks is None:
+                    # direct reads don't use the cache, so they don't hold up eviction.
+                    lock.close()
+                    yield file_name
+                    return
+
+                with self.sparse_file(meta, blocks, source=file_name) as path:
+                    yield path
+
+                missing = self.missing_blocks(meta, blocks)
+                if missing:
+                    raise IOError(f"raster cache: {len(missing)} blocks of {file_name} were removed while being read")
+        finally:
+            self.evict_if_full()
+
+
+_raster_cache = None
+_raster_cache_lock = threading.Lock()
+
+
+def get_raster_cache() -> Optional[RasterCache]:
+    """ returns the process' RasterCache, or None if RASTER_CACHE_DIR isn't set (the default) """
+    global _raster_cache
+    if not RASTER_CACHE_DIR:
+        return None
+    with _raster_cache_lock:
+        if _raster_cache is None:
+            _raster_cache = RasterCache(RASTER_CACHE_DIR, RASTER_CACHE_SIZE_MB * 1024 * 1024)
+        return _raster_cache
+
+
+@contextmanager
+def cached_raster(file_name: str, area, srid: int = 4326, overview_level: Optional[int] = None):
+    """
+    yields the path to read `area` (a shapely geometry in EPSG:`srid`) of `file_name` from.
+    /vsis3/ rasters are read through the block cache; other paths are returned unchanged.
+    """
+    cache = get_raster_cache()
+    if not cache or area is None or not split_vsis3_path(file_name):
+        yield file_name
+        return
+
+    with cache.window(file_name, area, srid=srid, overview_level=overview_level) as path:
+        yield path
+
+
+def warm(rasters: List[str], areas: list, overview_level: Optional[int] = None):
+    """ downloads the blocks of `rasters` covering each of `areas` (EPSG:4326) into the cache """
+    cache = get_raster_cache()
+    if not cache:
+        raise Exception("RASTER_CACHE_DIR is not set")
+
+    for raster in rasters:
+        file_name = raster if raster.startswith('/vsis3/') else f"/vsis3/{raster}"
+        for area in areas:
+            start = time.perf_counter()
+            with cache.window(file_name, area, overview_level=overview_level):
+                pass
+            logger.info("warmed %s %s in %s", file_name, area.bounds, time.perf_counter() - start)
+    cache.evict()
+
+
+def main():
+    from shapely.geometry import box
+    from api.v1.watersheds import PRECIP_RASTER, PET_RASTER, CLIMATE_STACK_RASTER, HILLSHADE_RASTER, CDEM_FILE
+
+    parser = argparse.ArgumentParser(description="Pre-load areas of the watershed rasters into the raster cache.")
+    parser.add_argument('command', choices=['warm'])
+    parser.add_argument('--bbox', nargs=4, type=float, action='append', required=True,
+                        metavar=('MINX', 'MINY', 'MAXX', 'MAXY'), help='an area to load (EPSG:4326). Can be repeated.')
+    parser.add_argument('--raster', action='append',
+                        help='a raster in Minio (e.g. raster/WNA_et0.tif). Defaults to the watershed summary rasters.')
+    parser.add_argument('--overview', type=int, default=None, help='load an overview level instead of full resolution')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    rasters = args.raster or [
+        CLIMATE_STACK_RASTER, PRECIP_RASTER, PET_RASTER, HILLSHADE_RASTER, CDEM_FILE
+    ]
+    warm(rasters, [box(*bbox) for bbox in args.bbox], overview_level=args.overview)
+
+
+if __name__ == "__main__":
+    main()
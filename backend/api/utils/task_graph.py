@@ -0,0 +1,157 @@
+"""
+Runs a set of independent (or partly dependent) functions concurrently on threads.
+
+Used to gather the inputs for watershed summaries, where most of the steps are independent
+of each other and spend their time waiting on GDAL reads, WFS requests or the database:
+
+    graph = TaskGraph()
+    graph.add('precipitation', get_mean_annual_precipitation, args=(polygon,), timeout=60)
+    graph.add('zone', get_hydrological_zone, args=(polygon.centroid,), timeout=30)
+    graph.add('runoff', lambda db, zone: calculate_runoff(db, zone), deps=['zone'], db=True)
+    results = graph.run()
+
+A task starts as soon as the tasks it depends on have finished, and receives their results as
+keyword arguments.  Tasks that need the database (`db=True`) get their own session as the
+`db` keyword argument, since a SQLAlchemy session can't be shared between threads.  At most
+TASK_GRAPH_DB_SESSIONS task sessions are open at once in a process (see `task_session`), so
+concurrent graphs can't use up the connection pool (see api/db/session.py); other tasks wait
+for a session.  A task holding a session mustn't wait for other database tasks (e.g. run a
+graph of its own), or graphs could wait on each other for sessions.
+
+Each task has its own timeout, counted from when it starts.  Tasks that share one time budget,
+such as a read and the fallbacks that run after it, can also be given a `deadline` (a
+`time.monotonic()` time) that bounds them however late they start:
+
+    deadline = time.monotonic() + 60
+    graph.add('stack', read_stack, deadline=deadline)
+    graph.add('fallback', read_fallback, deps=['stack'], deadline=deadline)
+
+If a task raises an exception or times out, the error is logged
+and kept in `graph.errors`, and its result is `default` (unless the task is `required`, in
+which case `run()` raises the error).  Timed out tasks can't be stopped, but their results
+are ignored.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from api.config import TASK_GRAPH_DB_SESSIONS
+from api.db.session import Session as SessionLocal
+
+logger = logging.getLogger("utils")
+
+_db_sessions = threading.BoundedSemaphore(TASK_GRAPH_DB_SESSIONS)
+
+
+@contextmanager
+def task_session():
+    """ yields a new database session, waiting while TASK_GRAPH_DB_SESSIONS task sessions are open """
+    with _db_sessions:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+class Task:
+    def __init__(self, name: str, fn: Callable, args: tuple = (), deps: Iterable[str] = (),
+                 timeout: Optional[float] = None, default: Any = None, db: bool = False,
+                 required: bool = False, deadline: Optional[float] = None):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.deps = list(deps)
+        self.timeout = timeout
+        self.default = default
+        self.db = db
+        self.required = required
+        self.deadline = deadline
+
+    def get_deadline(self, start: float) -> Optional[float]:
+        """ returns the time the task must finish by, if it starts at `start` """
+        deadlines = [d for d in (start + self.timeout if self.timeout else None, self.deadline) if d]
+        return min(deadlines) if deadlines else None
+
+    def __call__(self, **dep_results):
+        start = time.perf_counter()
+        try:
+            if not self.db:
+                return self.fn(*self.args, **dep_results)
+            with task_session() as db:
+                return self.fn(*self.args, db=db, **dep_results)
+        finally:
+            logger.debug('task %s took %s', self.name, time.perf_counter() - start)
+
+
+class TaskGraph:
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers
+        self.tasks: Dict[str, Task] = {}
+        self.results: Dict[str, Any] = {}
+        self.errors: Dict[str, Exception] = {}
+
+    def add(self, name: str, fn: Callable, args: tuple = (), deps: Iterable[str] = (),
+            timeout: Optional[float] = None, default: Any = None, db: bool = False,
+            required: bool = False, deadline: Optional[float] = None):
+        """ adds a task. See the module docstring for the arguments. """
+        if name in self.tasks:
+            raise ValueError(f"duplicate task {name}")
+        self.tasks[name] = Task(name, fn, args=args, deps=deps, timeout=timeout,
+                                default=default, db=db, required=required, deadline=deadline)
+        return self
+
+    def _fail(self, task: Task, error: Exception):
+        self.errors[task.name] = error
+        self.results[task.name] = task.default
+        if task.required:
+            raise error
+        logger.warning('task %s failed: %s', task.name, repr(error))
+
+    def run(self) -> Dict[str, Any]:
+        """ runs every task and returns a dict of results by task name """
+        for task in self.tasks.values():
+            missing = [d for d in task.deps if d not in self.tasks]
+            if missing:
+                raise ValueError(f"task {task.name} depends on unknown tasks {missing}")
+
+        pending = dict(self.tasks)
+        running = {}  # future: (task, deadline)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers or max(len(self.tasks), 1))
+        try:
+            while pending or running:
+                for name, task in list(pending.items()):
+                    if all(d in self.results for d in task.deps):
+                        del pending[name]
+                        future = executor.submit(task, **{d: self.results[d] for d in task.deps})
+                        running[future] = (task, task.get_deadline(time.monotonic()))
+
+                if not running:
+                    raise ValueError(f"tasks {list(pending)} have circular dependencies")
+
+                deadlines = [deadline for (_, deadline) in running.values() if deadline]
+                wait_for = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+                done, _ = wait(running, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    task, _ = running.pop(future)
+                    try:
+                        self.results[task.name] = future.result()
+                    except Exception as e:
+                        self._fail(task, e)
+
+                now = time.monotonic()
+                for future, (task, deadline) in list(running.items()):
+                    if deadline and now >= deadline:
+                        del running[future]
+                        future.cancel()
+                        self._fail(task, FutureTimeoutError(f"{task.name} timed out"))
+        finally:
+            # don't wait for tasks that timed out.
+            executor.shutdown(wait=False)
+
+        return self.results
@@ -19,6 +19,7 @@ from fastapi import HTTPException
 
 from api.v1.catalogue.db_models import DisplayCatalogue
 from api.v1.hydat.db_models import Station as StreamStation
+from api.utils.http_client import get_http_client, DEFAULT_HEADERS
 from api.v1.aggregator.helpers import gwells_api_request, transform_4326_3005, transform_3005_4326
 from api.v1.aggregator.schema import ExternalAPIRequest, LayerResponse, WMSGetFeatureQuery
 from api.layers.freshwater_atlas_stream_networks import FreshwaterAtlasStreamNetworks
@@ -221,34 +222,38 @@ async def batch_fetch(
         return await fetch_results(req, session)
 
 
-async def fetch_all(requests: List[ExternalAPIRequest]) -> asyncio.Future:
+async def fetch_all(requests: List[ExternalAPIRequest], session: ClientSession = None) -> asyncio.Future:
     """
     fetch_all collects features from multiple sources, provided in a list
-    of ExternalAPIRequest objects. It returns a "future" iterable. This function can
-    be run with asyncio.run(fetch_all(requests)), which will block until
-    all the requests are complete.
+    of ExternalAPIRequest objects. It returns a "future" iterable. The requests are made
+    with `session`, or with a new ClientSession if it isn't given (e.g. when run with
+    asyncio.run(fetch_all(requests)), which will block until all the requests are complete).
     """
+    if session is None:
+        async with ClientSession(headers=DEFAULT_HEADERS) as session:
+            return await fetch_all(requests, session)
+
     tasks = []
     semaphore = asyncio.Semaphore(10)
-    headers = {'accept': 'application/json'}
 
-    async with ClientSession(headers=headers) as session:
-        for req in requests:
-            # use the list of ExternalAPIRequests to form URLs and start adding the requests to the
-            # request queue.
-            task = asyncio.ensure_future(
-                batch_fetch(semaphore, req, session))
-            tasks.append(task)
+    for req in requests:
+        # use the list of ExternalAPIRequests to form URLs and start adding the requests to the
+        # request queue.
+        task = asyncio.ensure_future(
+            batch_fetch(semaphore, req, session))
+        tasks.append(task)
 
-        # return the gathered tasks, which will be a list of JSON responses when all requests return.
-        return await asyncio.gather(*tasks)
+    # return the gathered tasks, which will be a list of JSON responses when all requests return.
+    return await asyncio.gather(*tasks)
 
 
 def fetch_geojson_features(requests: List[ExternalAPIRequest]) -> List[LayerResponse]:
     """ fetch_geojson_features collects features from one or more sources and aggregates
     them into a list of LayerResponse results, each containing the geojson response
-    body and a status code """
-    return asyncio.run(fetch_all(requests))
+    body and a status code.  The requests are made with the process' shared HTTP client,
+    which keeps connections to each host open between calls (see api/utils/http_client.py). """
+    client = get_http_client()
+    return client.run(fetch_all(requests, client.session))
 
 
 def get_display_catalogue(db: Session, display_data_names: List[str]):
@@ -0,0 +1,146 @@
+"""
+Compiled inference for the hydrological zone XGBoost models.
+
+XGBoost's predict pays for building a DMatrix and calling into the library for every
+model, which dominates the cost of predicting a few watersheds with a zone's 13 models.
+`CompiledEnsemble` reads the trees from the models' JSON files once and flattens all of
+them (for all the models of a zone) into NumPy node arrays.  Predicting walks every tree
+for every watershed at once, one tree level per step, and sums the leaves of each model:
+
+    ensemble = CompiledEnsemble([(annual_json, annual_inputs), (january_json, january_inputs), ...])
+    flows = ensemble.predict(input_matrix(rows, ensemble.inputs))   # rows x models
+
+Only the models WALLY trains can be compiled: gbtree boosters with numerical splits and an
+identity link (reg:squarederror).  Like XGBoost 1.2's XGBRegressor.predict on a loaded model,
+all trees are used.  Set HYDRO_ZONE_MODEL_BACKEND=compiled to use it for the
+hydrological_zones routes (see registry.py).
+
+Walking every tree with NumPy costs more per watershed than XGBoost's native loop, so the
+compiled models only win when there are few watersheds to predict (a single watershed is about
+ten times faster).  Larger batches still use XGBoost, see COMPILED_MAX_ROWS.
+tests/models/benchmark_zone_models.py compares the two.
+"""
+import json
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+
+# objectives whose prediction is the sum of the leaves plus the base score
+IDENTITY_OBJECTIVES = ('reg:squarederror', 'reg:linear')
+
+# the most rows predicted with a compiled ensemble; XGBoost is faster for more rows
+COMPILED_MAX_ROWS = 32
+
+
+def parse_base_score(value: str) -> float:
+    """ base_score is saved as "5E-1" by XGBoost 1.x and as "[5E-1]" by newer versions """
+    return float(str(value).strip('[]'))
+
+
+def load_model_json(model: Union[bytes, str, dict]) -> dict:
+    if isinstance(model, dict):
+        return model
+    return json.loads(model)
+
+
+class CompiledEnsemble:
+    """ the trees of one or more XGBoost models, as flat NumPy arrays (see the module docstring) """
+
+    def __init__(self, models: Sequence[Tuple[Union[bytes, str, dict], Sequence[str]]]):
+        """
+        `models` is a list of (XGBoost JSON model, names of the model's inputs in order).
+        Raises ValueError if a model can't be compiled.
+        """
+        # the inputs of all the models; each model's features are mapped to these columns.
+        self.inputs: List[str] = []
+        for _, inputs in models:
+            self.inputs.extend(name for name in inputs if name not in self.inputs)
+
+        left, right, feature, threshold, default_left, value = [], [], [], [], [], []
+        roots, model_starts, base_scores = [], [], []
+        self.depth = 0
+
+        for model, inputs in models:
+            learner = load_model_json(model)['learner']
+            objective = learner['objective']['name']
+            booster = learner['gradient_booster']
+            if objective not in IDENTITY_OBJECTIVES or booster['name'] != 'gbtree':
+                raise ValueError(f"can't compile a {booster['name']} model with objective {objective}")
+
+            columns = [self.inputs.index(name) for name in inputs]
+            base_scores.append(parse_base_score(learner['learner_model_param']['base_score']))
+            model_starts.append(len(roots))
+
+            trees = booster['model']['trees']
+            if not trees:
+                # a model without trees predicts its base score
+                trees = [{'left_children': [-1], 'right_children': [-1], 'split_indices': [0],
+                          'split_conditions': [0.0], 'default_left': [0]}]
+
+            for tree in trees:
+                if any(tree.get('split_type', [])):
+                    raise ValueError("can't compile categorical splits")
+                offset = len(left)
+                roots.append(offset)
+                is_leaf = [child == -1 for child in tree['left_children']]
+                left.extend(offset + child if not leaf else offset + i
+                            for i, (child, leaf) in enumerate(zip(tree['left_children'], is_leaf)))
+                right.extend(offset + child if not leaf else offset + i
+                             for i, (child, leaf) in enumerate(zip(tree['right_children'], is_leaf)))
+                feature.extend(columns[index] if not leaf else 0
+                               for index, leaf in zip(tree['split_indices'], is_leaf))
+                # leaves hold their value in split_conditions
+                threshold.extend(tree['split_conditions'])
+                value.extend(condition if leaf else 0.0 for condition, leaf in zip(tree['split_conditions'], is_leaf))
+                default_left.extend(bool(d) for d in tree['default_left'])
+                self.depth = max(self.depth, tree_depth(tree['left_children'], tree['right_children']))
+
+        # leaves point to themselves, so walking `depth` levels leaves every tree at a leaf.
+        self.left = np.array(left, dtype=np.int32)
+        self.right = np.array(right, dtype=np.int32)
+        self.feature = np.array(feature, dtype=np.int32)
+        # XGBoost compares float32 feature values with float32 split conditions
+        self.threshold = np.array(threshold, dtype=np.float32)
+        self.default_left = np.array(default_left, dtype=bool)
+        self.value = np.array(value, dtype=np.float32)
+        self.roots = np.array(roots, dtype=np.int32)
+        self.model_starts = np.array(model_starts, dtype=np.intp)
+        self.base_scores = np.array(base_scores, dtype=np.float32)
+
+    def __len__(self):
+        """ the number of models """
+        return len(self.model_starts)
+
+    def predict(self, rows: np.ndarray) -> np.ndarray:
+        """
+        returns the prediction of each model (columns, in the order they were given) for each
+        row of `rows`, a 2D array with columns in the order of `inputs`.  NaN is a missing value.
+        """
+        rows = np.ascontiguousarray(rows, dtype=np.float32).reshape((-1, len(self.inputs)))
+        n = rows.shape[0]
+        # the offset of each row in the flattened rows, so features are read with one np.take
+        row_offsets = (np.arange(n, dtype=np.intp) * len(self.inputs))[:, None]
+        nodes = np.broadcast_to(self.roots, (n, len(self.roots))).copy()
+
+        for _ in range(self.depth):
+            x = np.take(rows, row_offsets + np.take(self.feature, nodes))
+            go_left = x < np.take(self.threshold, nodes)
+            missing = np.isnan(x)
+            if missing.any():
+                go_left[missing] = np.take(self.default_left, nodes[missing])
+            nodes = np.where(go_left, np.take(self.left, nodes), np.take(self.right, nodes))
+
+        leaves = np.take(self.value, nodes)
+        return np.add.reduceat(leaves, self.model_starts, axis=1) + self.base_scores
+
+
+def tree_depth(left_children: List[int], right_children: List[int]) -> int:
+    """ the number of splits on the longest path from the root to a leaf """
+    depth = 0
+    level = [0]
+    while True:
+        level = [child for node in level for child in (left_children[node], right_children[node]) if child != -1]
+        if not level:
+            return depth
+        depth += 1
+
@@ -1,6 +1,8 @@
-import json
 import datetime
 import logging
+import math
+from collections import defaultdict
+from typing import List, Tuple
 from sqlalchemy.orm import Session
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
@@ -8,20 +10,20 @@ from api.v1.aggregator.controller import feature_search
 from shapely.geometry import MultiPolygon, shape
 from shapely.ops import transform
 from api.v1.aggregator.helpers import transform_4326_3005
-from api.v1.models.hydrological_zones.schema import HydroZoneModelInputs, MeanAnnualFlow, MeanMonthlyFlow
-from xgboost import XGBRegressor, DMatrix
+from api.v1.models.hydrological_zones.schema import (
+    HydroZoneModelInputs, MeanAnnualFlow, MeanMonthlyFlow, HydroZoneModelBatchItem,
+    HydroZoneModelBatchResult, HydroZoneModelBatchResponse, HydroZoneModelScores
+)
+from api.v1.models.hydrological_zones.compiled import COMPILED_MAX_ROWS
+from api.v1.models.hydrological_zones.registry import (
+    get_model_registry, predict, ZoneModels, MODELLING_BUCKET_NAME, V1_ANNUAL_FLOW_BUCKET
+)
 import numpy as np
 from api.minio.client import minio_client
-from minio.error import ResponseError
+from minio.error import MinioError, NoSuchKey
 
 logger = logging.getLogger("hydrological_zones")
 
-WORKING_DIR = "./api/v1/models/hydrological_zones/working_files/"
-MODELLING_BUCKET_NAME = 'modelling'
-V1_ANNUAL_FLOW_BUCKET = "v1/hydro_zone_annual_flow/"
-V2_ANNUAL_FLOW_BUCKET = "v2/hydro_zone_annual_flow/"
-V2_MONTHLY_DISTRIBUTIONS_BUCKET = "v2/hydro_zone_monthly_distributions/"
-
 
 def get_hydrological_zone_model_v1(
     hydrological_zone: int,
@@ -43,15 +45,13 @@ def get_hydrological_zone_model_v1(
 
     hydrological_zone = str(hydrological_zone)
 
-    # Get model state file from minio storage
+    # model state file from minio storage (kept in memory by the model registry)
     state_object_path = V1_ANNUAL_FLOW_BUCKET + "zone_{}.json".format(hydrological_zone)
-    model_ba = load_raw_model_data(state_object_path)
+    xgb = get_model_registry().get_booster(state_object_path)
 
-    xgb = XGBRegressor(random_state=42)
-    xgb.load_model(model_ba)
     inputs = [drainage_area, median_elevation, annual_precipitation]
     inputs = np.array(inputs).reshape((1, -1))
-    mean_annual_flow_prediction = xgb.predict(inputs)
+    mean_annual_flow_prediction = predict(xgb, inputs)[0]
     mean_annual_flow = MeanAnnualFlow(
         mean_annual_flow=mean_annual_flow_prediction,
         r_squared=get_zone_info(hydrological_zone),
@@ -64,107 +64,47 @@ def get_zone_info(zone):
     """
     Returns model fit in r^2 value based on hydrological zone
     """
-    # Get model state file from minio storage
-    r2_file = None
     try:
-        r2_file = minio_client.get_object(MODELLING_BUCKET_NAME, V1_ANNUAL_FLOW_BUCKET + "zone_models_r2.json")
-    except ResponseError as err:
+        zone_r_squares = get_model_registry().get_json(V1_ANNUAL_FLOW_BUCKET + "zone_models_r2.json")
+    except MinioError as err:
         logger.warning(err)
+        return None
 
-    if r2_file:
-        zone_r_squares = json.load(r2_file)
-        return zone_r_squares[str(zone)]
-
-    return None
+    return zone_r_squares[str(zone)]
 
 
 def get_hydrological_zone_model_v2(
     model_inputs: HydroZoneModelInputs
 ):
     """
-    Loads the respective zone's xgb model state and returns an estimated
-    mean annual flow value for the hydrological zone.
+    Returns the estimated mean annual flow and mean monthly flows for the watershed, using
+    the respective zone's xgb models (loaded once and kept in memory, see registry.py).
     """
-    input_values = model_inputs.dict()
-    hydrological_zone = str(model_inputs.hydrological_zone)
-
-    # ANNUAL FLOW
-
-    # get annual_model state
-    state_object_path = V2_ANNUAL_FLOW_BUCKET + "zone_{}.json".format(hydrological_zone)
-    state_file_name = "annual_model_state.json"
-    load_model_data(state_object_path, state_file_name)
-
-    # get annual_model score
-    score_object_path = V2_ANNUAL_FLOW_BUCKET + "annual_model_scores.json"
-    score_file_name = "annual_model_scores.json"
-    load_model_data(score_object_path, score_file_name)
-
-    # load model score
-    with open(score_file_name) as json_file:
-        scores = json.load(json_file)
-        annual_model_score = scores[hydrological_zone]['score']
-        best_inputs = scores[hydrological_zone]['best_inputs']
+    try:
+        zone_models = get_model_registry().get_zone_models(model_inputs.hydrological_zone)
+    except (NoSuchKey, KeyError):
+        raise HTTPException(
+            status_code=404, detail=f"no model found for hydrological zone {model_inputs.hydrological_zone}")
 
-    if len(best_inputs) <= 0: 
+    if len(zone_models.annual.inputs) <= 0:
         raise HTTPException(
             status_code=400, detail="model inputs not found.")
 
-    # Set best model inputs from scores file
-    # extract inputs from request params
-    inputs = [input_values[x] for x in best_inputs]
-    inputs = np.array(inputs).reshape((1, len(inputs)))
+    missing = missing_inputs(model_inputs.dict(), zone_model_inputs(zone_models))
+    if missing:
+        raise HTTPException(
+            status_code=400, detail=f"missing model inputs: {', '.join(missing)}")
 
-    # Load model
-    try:
-        xgb = XGBRegressor(random_state=42)
-        xgb.load_model(state_file_name)
-    except Exception as error:
-        logger.warning(error)
+    annual, monthly = predict_zone_flows(zone_models, [model_inputs.dict()])
 
-    # make annual prediction
-    mean_annual_flow_prediction = xgb.predict(inputs)
     mean_annual_flow = MeanAnnualFlow(
-        mean_annual_flow=mean_annual_flow_prediction,
-        r_squared=annual_model_score
+        mean_annual_flow=annual[0],
+        r_squared=zone_models.annual.score
     )
-
-    # MONTHLY FLOW
-    
-    zone_name = "zone_{}".format(hydrological_zone)
-    # get monthly model scores
-    monthly_scores_object_path = V2_MONTHLY_DISTRIBUTIONS_BUCKET + zone_name + '/' + 'monthly_model_scores.json'
-    monthly_scores_file_name = "monthly_model_scores.json"
-    load_model_data(monthly_scores_object_path, monthly_scores_file_name)
-
-    monthly_scores = {}
-    with open(monthly_scores_file_name) as json_file:
-        monthly_scores = json.load(json_file)
-
-    monthly_predictions = []
-    for month in range(1, 13): # months
-        object_path = V2_MONTHLY_DISTRIBUTIONS_BUCKET + zone_name + '/' + str(month) + '.json'
-        monthly_state_file_name = "monthly_model_state.json"
-        load_model_data(object_path, monthly_state_file_name)
-
-        month_model_score = monthly_scores[str(month)]['score']
-        month_best_inputs = monthly_scores[str(month)]['best_inputs']
-        # extract inputs from request params
-        month_inputs = [input_values[x] for x in month_best_inputs]
-        month_inputs = np.array(month_inputs).reshape((1, -1))
-
-        try:
-            xgb_month = XGBRegressor(random_state=42)
-            xgb_month.load_model(monthly_state_file_name)
-        except Exception as error:
-            logger.warning(error)
-
-        mean_monthly_flow_prediction = xgb_month.predict(month_inputs)
-        mean_monthly_flow = MeanMonthlyFlow(
-            mean_monthly_flow=mean_monthly_flow_prediction,
-            r_squared=month_model_score,
-        )
-        monthly_predictions.append(mean_monthly_flow)
+    monthly_predictions = [
+        MeanMonthlyFlow(mean_monthly_flow=flow, r_squared=month_model.score)
+        for flow, month_model in zip(monthly[0], zone_models.monthly)
+    ]
 
     result = {
       "mean_annual_flow": mean_annual_flow,
@@ -174,31 +114,113 @@ def get_hydrological_zone_model_v2(
     return result
 
 
-def load_model_data(minio_path: str, file_name: str):
+def zone_model_inputs(zone_models: ZoneModels) -> List[str]:
+    """ returns the names of the inputs used by any of the zone's models """
+    inputs = list(zone_models.annual.inputs)
+    for model in zone_models.monthly:
+        inputs.extend(name for name in model.inputs if name not in inputs)
+    return inputs
+
+
+def missing_inputs(row: dict, inputs: List[str]) -> List[str]:
+    """ returns the `inputs` that `row` doesn't have a (finite) value for """
+    missing = []
+    for name in inputs:
+        try:
+            valid = row.get(name) is not None and math.isfinite(float(row[name]))
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            missing.append(name)
+    return missing
+
+
+def input_matrix(rows: List[dict], inputs: List[str]) -> np.ndarray:
     """
-    Gets a model object from Minio and sets the file by file_name
+    returns the `inputs` columns of `rows` as a 2D array.  Raises ValueError if a row is
+    missing an input, since the models would silently predict from a NaN.
     """
-    try:
-        response = minio_client.get_object(MODELLING_BUCKET_NAME, minio_path)
-        content = response.read().decode('utf-8')
-        with open(file_name, "w+") as local_file:
-            local_file.write(content)
+    matrix = np.array([[row.get(name) for name in inputs] for row in rows], dtype=float).reshape((len(rows), -1))
+    if not np.isfinite(matrix).all():
+        missing = {name for row in rows for name in missing_inputs(row, inputs)}
+        raise ValueError(f"missing model inputs: {', '.join(sorted(missing))}")
+    return matrix
 
-    except Exception as error:
-        logger.warning(error)
 
+def predict_zone_flows(zone_models: ZoneModels, rows: List[dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    predicts the mean annual flow (an array of len(rows)) and the 12 mean monthly flows
+    (a len(rows) x 12 array) of watersheds in the same zone, with one predict call per model,
+    or one call for all the models if they were compiled and there are only a few rows
+    (see compiled.py).
+    """
+    if zone_models.compiled and len(rows) <= COMPILED_MAX_ROWS:
+        flows = zone_models.compiled.predict(input_matrix(rows, zone_models.compiled.inputs))
+        return flows[:, 0], flows[:, 1:]
+
+    # most of the monthly models use the same inputs, so each input matrix is only built once.
+    matrices = {}
+
+    def matrix(inputs):
+        key = tuple(inputs)
+        if key not in matrices:
+            matrices[key] = input_matrix(rows, inputs)
+        return matrices[key]
+
+    annual = zone_models.annual.predict(matrix(zone_models.annual.inputs))
+    monthly = np.column_stack([model.predict(matrix(model.inputs)) for model in zone_models.monthly])
+    return annual, monthly
 
-def load_raw_model_data(minio_path: str):
+
+def predict_hydrological_zone_models(items: List[HydroZoneModelBatchItem]) -> HydroZoneModelBatchResponse:
     """
-    Gets and returns bytearray format of a model object from Minio
+    predicts the mean annual and monthly flows of many watersheds.  The items are grouped by
+    hydrological zone, and each zone's models predict all of its watersheds at once.
+    Items in zones without models, or missing any of their zone's model inputs, get an
+    error instead of flows.
     """
-    try:
-        response = minio_client.get_object(MODELLING_BUCKET_NAME, minio_path)
-        content = bytearray(response.read()) #.decode('utf-8')
-        return content
+    rows = [item.dict() for item in items]
+    zones = defaultdict(list)
+    for i, row in enumerate(rows):
+        zones[row['hydrological_zone']].append(i)
 
-    except Exception as error:
-        logger.warning(error)
+    registry = get_model_registry()
+    results = [None] * len(rows)
+    scores = {}
+
+    for zone, positions in zones.items():
+        try:
+            zone_models = registry.get_zone_models(zone)
+        except (NoSuchKey, KeyError):
+            for i in positions:
+                results[i] = HydroZoneModelBatchResult(
+                    id=rows[i]['id'], hydrological_zone=zone,
+                    error=f"no model found for hydrological zone {zone}")
+            continue
+
+        scores[zone] = HydroZoneModelScores(
+            annual=zone_models.annual.score, monthly=[model.score for model in zone_models.monthly])
+
+        inputs = zone_model_inputs(zone_models)
+        complete = []
+        for i in positions:
+            missing = missing_inputs(rows[i], inputs)
+            if missing:
+                results[i] = HydroZoneModelBatchResult(
+                    id=rows[i]['id'], hydrological_zone=zone,
+                    error=f"missing model inputs: {', '.join(missing)}")
+            else:
+                complete.append(i)
+        if not complete:
+            continue
+
+        annual, monthly = predict_zone_flows(zone_models, [rows[i] for i in complete])
+        for j, i in enumerate(complete):
+            results[i] = HydroZoneModelBatchResult(
+                id=rows[i]['id'], hydrological_zone=zone,
+                mean_annual_flow=annual[j], mean_monthly_flows=monthly[j].tolist())
+
+    return HydroZoneModelBatchResponse(results=results, scores=scores)
 
 
 def download_training_data(model_version: str, hydrological_zone: int):
@@ -0,0 +1,196 @@
+"""
+In-memory registry of the hydrological zone model files in Minio.
+
+A v2 prediction needs the zone's annual flow model and the 12 monthly distribution models,
+plus the score files that list each model's r² and inputs.  These used to be downloaded for
+every request and written to fixed file names in the working directory.  The registry keeps
+each file in memory, parsed (json) or loaded (XGBoost models), and checks the object's ETag
+at most every MODEL_REGISTRY_TTL_SECONDS so that models retrained and uploaded to Minio are
+picked up without a restart:
+
+    zone_models = get_model_registry().get_zone_models(27)
+    zone_models.annual.predict(inputs)
+
+With HYDRO_ZONE_MODEL_BACKEND=compiled, each zone's models are also compiled into one
+CompiledEnsemble (zone_models.compiled, see compiled.py).
+"""
+import json
+import logging
+import threading
+import time
+import weakref
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from xgboost import XGBRegressor
+
+from api.config import HYDRO_ZONE_MODEL_BACKEND
+from api.minio.client import minio_client
+from api.v1.models.hydrological_zones.compiled import CompiledEnsemble
+
+logger = logging.getLogger("hydrological_zones")
+
+MODELLING_BUCKET_NAME = 'modelling'
+V1_ANNUAL_FLOW_BUCKET = "v1/hydro_zone_annual_flow/"
+V2_ANNUAL_FLOW_BUCKET = "v2/hydro_zone_annual_flow/"
+V2_MONTHLY_DISTRIBUTIONS_BUCKET = "v2/hydro_zone_monthly_distributions/"
+
+# how long (seconds) a loaded file is used before its ETag is checked again
+MODEL_REGISTRY_TTL_SECONDS = 300
+
+
+# XGBoost 1.2 boosters aren't safe to predict with from several threads at once.
+_predict_locks = weakref.WeakKeyDictionary()
+_predict_locks_lock = threading.Lock()
+
+
+def load_booster(content: bytes) -> XGBRegressor:
+    """ loads an XGBoost model (json or binary) from memory """
+    xgb = XGBRegressor(random_state=42)
+    xgb.load_model(bytearray(content))
+    return xgb
+
+
+def predict(model: XGBRegressor, rows: np.ndarray) -> np.ndarray:
+    """ predicts with a shared (registry) model, one thread at a time """
+    with _predict_locks_lock:
+        lock = _predict_locks.setdefault(model, threading.Lock())
+    with lock:
+        return model.predict(rows)
+
+
+class ZoneModel:
+    """ an XGBoost model with its score and the names of its inputs, in order """
+
+    def __init__(self, model: XGBRegressor, score: float, inputs: List[str]):
+        self.model = model
+        self.score = score
+        self.inputs = list(inputs)
+
+    def predict(self, rows: np.ndarray) -> np.ndarray:
+        """ predicts from a 2D array of rows of `inputs` """
+        return predict(self.model, rows)
+
+
+class ZoneModels:
+    """
+    the v2 annual flow model and the monthly distribution models (January first) of a zone.
+    `compiled` predicts all 13 models at once (annual first), if the models were compiled.
+    """
+
+    def __init__(self, zone: int, annual: ZoneModel, monthly: List[ZoneModel],
+                 compiled: Optional[CompiledEnsemble] = None):
+        self.zone = zone
+        self.annual = annual
+        self.monthly = monthly
+        self.compiled = compiled
+
+
+class CachedObject:
+    def __init__(self, etag: str, value, content: bytes):
+        self.etag = etag
+        self.value = value
+        self.content = content
+        self.checked = time.monotonic()
+
+
+class ModelRegistry:
+    """ see the module docstring """
+
+    def __init__(self, client=None, bucket: str = MODELLING_BUCKET_NAME, ttl: float = MODEL_REGISTRY_TTL_SECONDS,
+                 compile_models: bool = HYDRO_ZONE_MODEL_BACKEND == 'compiled'):
+        self.client = client or minio_client
+        self.bucket = bucket
+        self.ttl = ttl
+        self.compile_models = compile_models
+        self._objects: Dict[str, CachedObject] = {}
+        self._zones: Dict[int, Tuple[list, ZoneModels]] = {}
+        self._lock = threading.RLock()
+
+    def _get(self, path: str, load: Callable):
+        """
+        returns `load(content)` of the object at `path`, from memory if it was loaded
+        before and its ETag hasn't changed.
+        """
+        cached = self._objects.get(path)
+        if cached and time.monotonic() - cached.checked < self.ttl:
+            return cached.value
+
+        with self._lock:
+            cached = self._objects.get(path)
+            if cached and time.monotonic() - cached.checked < self.ttl:
+                return cached.value
+
+            etag = self.client.stat_object(self.bucket, path).etag
+            if cached and cached.etag == etag:
+                cached.checked = time.monotonic()
+                return cached.value
+
+            response = self.client.get_object(self.bucket, path)
+            try:
+                content = response.read()
+            finally:
+                response.close()
+                response.release_conn()
+
+            logger.info("loaded %s/%s (etag %s)", self.bucket, path, etag)
+            self._objects[path] = CachedObject(etag, load(content), content)
+            return self._objects[path].value
+
+    def get_json(self, path: str):
+        return self._get(path, json.loads)
+
+    def get_booster(self, path: str) -> XGBRegressor:
+        return self._get(path, load_booster)
+
+    def get_zone_models(self, zone: int) -> ZoneModels:
+        """
+        returns the v2 models of hydrological zone `zone`.  The ZoneModels is rebuilt
+        only if one of its files changed.
+        """
+        zone_name = f"zone_{zone}"
+        model_paths = [V2_ANNUAL_FLOW_BUCKET + f"{zone_name}.json"] + [
+            V2_MONTHLY_DISTRIBUTIONS_BUCKET + f"{zone_name}/{month}.json" for month in range(1, 13)
+        ]
+        annual_scores = self.get_json(V2_ANNUAL_FLOW_BUCKET + "annual_model_scores.json")
+        annual_model = self.get_booster(model_paths[0])
+        monthly_scores = self.get_json(V2_MONTHLY_DISTRIBUTIONS_BUCKET + f"{zone_name}/monthly_model_scores.json")
+        monthly_models = [self.get_booster(path) for path in model_paths[1:]]
+
+        sources = [annual_scores, annual_model, monthly_scores] + monthly_models
+        if zone in self._zones:
+            cached_sources, zone_models = self._zones[zone]
+            if all(a is b for a, b in zip(cached_sources, sources)):
+                return zone_models
+
+        annual = annual_scores[str(zone)]
+        zone_models = ZoneModels(
+            zone,
+            ZoneModel(annual_model, annual['score'], annual['best_inputs']),
+            [ZoneModel(model, monthly_scores[str(month)]['score'], monthly_scores[str(month)]['best_inputs'])
+             for month, model in zip(range(1, 13), monthly_models)]
+        )
+
+        if self.compile_models:
+            models = [zone_models.annual] + zone_models.monthly
+            try:
+                zone_models.compiled = CompiledEnsemble(
+                    [(self._objects[path].content, model.inputs) for path, model in zip(model_paths, models)])
+            except (ValueError, KeyError) as e:
+                logger.warning("unable to compile the models of zone %s, using xgboost: %s", zone, repr(e))
+
+        self._zones[zone] = (sources, zone_models)
+        return zone_models
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_model_registry() -> ModelRegistry:
+    """ returns the process' model registry """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
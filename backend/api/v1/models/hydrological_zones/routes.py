@@ -6,9 +6,12 @@ from logging import getLogger
 from fastapi import APIRouter, Depends, Query, HTTPException
 from sqlalchemy.orm import Session
 from api.v1.models.hydrological_zones.controller import get_hydrological_zone_model_v1, \
-  get_hydrological_zone_model_v2, download_training_data, download_training_report
-from api.v1.models.hydrological_zones.schema import HydroZoneModelInputs
+  get_hydrological_zone_model_v2, predict_hydrological_zone_models, download_training_data, download_training_report
+from api.v1.models.hydrological_zones.schema import (
+  HydroZoneModelInputs, HydroZoneModelBatchRequest, HydroZoneModelBatchResponse
+)
 from api.db.utils import get_db
+from api.config import HYDRO_ZONE_MODEL_BATCH_MAX_ITEMS
 
 logger = getLogger("hydrological_zones")
 
@@ -53,6 +56,23 @@ def v2_watershed_drainage_model(
     return model_output
 
 
+@router.post("/v2_watershed_drainage_model/batch", response_model=HydroZoneModelBatchResponse)
+def v2_watershed_drainage_model_batch(
+        req: HydroZoneModelBatchRequest
+):
+    """ predicts the v2 mean annual and monthly flows of many watersheds in one request.
+    Items can be in any mix of hydrological zones; results are returned in the same order,
+    with each item's `id`, and the model scores are listed once per zone. """
+    if not req.items:
+        raise HTTPException(status_code=400, detail="No items to predict")
+
+    if len(req.items) > HYDRO_ZONE_MODEL_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400, detail=f"Batches are limited to {HYDRO_ZONE_MODEL_BATCH_MAX_ITEMS} items")
+
+    return predict_hydrological_zone_models(req.items)
+
+
 @router.get("/training_data/download")
 def get_training_data(
         model_version: str,
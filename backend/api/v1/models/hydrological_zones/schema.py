@@ -1,7 +1,7 @@
 """
 API data models for hydrological zone regression models.
 """
-from typing import Optional, List
+from typing import Dict, Optional, List
 from pydantic import BaseModel, Schema
 
 
@@ -27,6 +27,37 @@ class HydroZoneModelInputs(BaseModel):
         orm_mode = True
 
 
+class HydroZoneModelBatchItem(HydroZoneModelInputs):
+    """ a watershed in a batch prediction. `id` is returned with its result. """
+    id: Optional[str]
+
+
+class HydroZoneModelBatchRequest(BaseModel):
+    """ watersheds to predict flows for, in any mix of hydrological zones """
+    items: List[HydroZoneModelBatchItem]
+
+
+class HydroZoneModelBatchResult(BaseModel):
+    """ predicted flows of a watershed in a batch, or an error if its zone has no model or an input is missing """
+    id: Optional[str]
+    hydrological_zone: int
+    mean_annual_flow: Optional[float]
+    mean_monthly_flows: Optional[List[float]]
+    error: Optional[str]
+
+
+class HydroZoneModelScores(BaseModel):
+    """ r² of a zone's annual model and monthly models (January first) """
+    annual: float
+    monthly: List[float]
+
+
+class HydroZoneModelBatchResponse(BaseModel):
+    """ results in the same order as the request items, and the model scores of each zone """
+    results: List[HydroZoneModelBatchResult]
+    scores: Dict[int, HydroZoneModelScores]
+
+
 class MeanAnnualFlow(BaseModel):
     """ output values of the wally hydrological zone model """
     mean_annual_flow: float
@@ -0,0 +1,122 @@
+"""
+Cached SCSB 2016 model coefficients (modeling.mad_model_coefficients).
+
+Each hydrological zone has one linear model per output (MAR, 7Q2, S-7Q10 and the 12 monthly
+distributions).  The coefficients of a zone are kept as a matrix with one row per output and
+one column per model input (SCSB_INPUTS, then the intercept), so all of a watershed's outputs
+come from one matrix-vector product, and many watersheds from one matrix product:
+
+    coefficients = get_mad_model_coefficients(db)[zone]
+    results = coefficients.evaluate(inputs)    # inputs: n x len(SCSB_INPUTS)
+
+A zone with a NULL coefficient has an `error` and can't be evaluated.
+
+The table is small and rarely changes, so it is read once and checked again every
+SCSB_COEFFICIENTS_REFRESH_SECONDS; zones are only rebuilt if their rows changed.
+"""
+import logging
+import threading
+import time
+from decimal import Decimal
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger('api')
+
+# how long the loaded coefficients are used before the table is read again
+SCSB_COEFFICIENTS_REFRESH_SECONDS = 5 * 60
+
+# model inputs, in the order of the coefficient matrix columns
+SCSB_INPUTS = ('median_elevation', 'glacial_coverage', 'annual_precipitation', 'evapo_transpiration',
+               'drainage_area', 'solar_exposure', 'average_slope')
+
+# coefficient columns for SCSB_INPUTS, followed by the intercept
+COEFFICIENT_COLUMNS = ('median_elevation_co', 'glacial_coverage_co', 'precipitation_co',
+                       'potential_evapo_transpiration_co', 'drainage_area_co', 'solar_exposure_co',
+                       'average_slope_co', 'intercept_co')
+
+
+class ZoneCoefficients:
+    """ the SCSB 2016 models of one hydrological zone """
+
+    def __init__(self, rows: List[dict]):
+        """ `rows` are the zone's mad_model_coefficients records, in output order """
+        self.rows = rows
+        self.output_types = [row['model_output_type'] for row in rows]
+        self.months = [row['month'] for row in rows]
+
+        missing = sorted({column for row in rows for column in COEFFICIENT_COLUMNS if row[column] is None})
+        self.error = f"Missing scsb2016 model coefficients: {', '.join(missing)}" if missing else None
+        if missing:
+            logger.warning("hydrological zone %s: %s", rows[0]['hydrologic_zone_id'], self.error)
+
+        self.matrix = np.array(
+            [[np.nan if row[column] is None else float(row[column]) for column in COEFFICIENT_COLUMNS]
+             for row in rows], dtype=np.float64
+        ).reshape((len(rows), len(COEFFICIENT_COLUMNS)))
+
+    def evaluate(self, inputs) -> np.ndarray:
+        """
+        returns the model results for `inputs`: one watershed (a vector of SCSB_INPUTS values)
+        gives a vector with one result per output, and an n x len(SCSB_INPUTS) matrix gives an
+        n x outputs matrix.  Raises ValueError if the zone has NULL coefficients.
+        """
+        if self.error:
+            raise ValueError(self.error)
+        inputs = np.asarray(inputs, dtype=np.float64)
+        return inputs @ self.matrix[:, :-1].T + self.matrix[:, -1]
+
+    def evaluate_exact(self, inputs: Sequence) -> List[Decimal]:
+        """ returns the model results for one watershed, calculated with Decimal arithmetic """
+        if self.error:
+            raise ValueError(self.error)
+        inputs = [Decimal(value) for value in inputs] + [Decimal(1)]
+        return [
+            sum(Decimal(row[column]) * value for column, value in zip(COEFFICIENT_COLUMNS, inputs))
+            for row in self.rows
+        ]
+
+
+def load_mad_model_coefficients(db) -> Dict[int, List[dict]]:
+    """ reads the coefficient records of every zone """
+    q = """
+        select * from modeling.mad_model_coefficients
+        order by hydrologic_zone_id, mad_model_coefficients_id
+    """
+    zones = {}
+    for row in db.execute(q):
+        zones.setdefault(row['hydrologic_zone_id'], []).append(dict(row))
+    return zones
+
+
+_zones: Dict[int, ZoneCoefficients] = {}
+_next_load = 0.0
+_lock = threading.Lock()
+
+
+def get_mad_model_coefficients(db) -> Dict[int, ZoneCoefficients]:
+    """
+    returns the coefficients of each zone, reading the table with `db` if it hasn't been
+    read in the last SCSB_COEFFICIENTS_REFRESH_SECONDS.
+    """
+    global _zones, _next_load
+
+    if time.monotonic() < _next_load:
+        return _zones
+
+    with _lock:
+        if time.monotonic() < _next_load:
+            return _zones
+
+        rows = load_mad_model_coefficients(db)
+        _zones = {
+            zone: _zones[zone] if zone in _zones and _zones[zone].rows == zone_rows else ZoneCoefficients(zone_rows)
+            for zone, zone_rows in rows.items()
+        }
+        _next_load = time.monotonic() + SCSB_COEFFICIENTS_REFRESH_SECONDS
+        return _zones
+
+
+def get_zone_coefficients(db, hydrological_zone: int) -> Optional[ZoneCoefficients]:
+    return get_mad_model_coefficients(db).get(int(hydrological_zone))
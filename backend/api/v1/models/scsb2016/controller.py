@@ -4,13 +4,24 @@ Functions for calculating model data from params and database records
 """
 import logging
 from decimal import Decimal
+from typing import List, Optional, Sequence
+import numpy as np
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
+from shapely.geometry import Point
 from api.v1.aggregator.controller import databc_feature_search
+from api.v1.models.scsb2016.hydrological_zones import get_zone_index
+from api.v1.models.scsb2016.coefficients import (
+    ZoneCoefficients, SCSB_INPUTS, get_mad_model_coefficients, get_zone_coefficients
+)
 
 logger = logging.getLogger('api')
 
 
+MONTH_DAYS = {1: 31, 2: 28, 3: 31, 4: 30, 5: 31, 6: 30,
+              7: 31, 8: 31, 9: 30, 10: 31, 11: 30, 12: 31}
+
+
 def calculate_mean_annual_runoff(db: Session,
                                  hydrological_zone: int,
                                  median_elevation: Decimal,
@@ -19,12 +30,16 @@ def calculate_mean_annual_runoff(db: Session,
                                  evapo_transpiration: Decimal,
                                  drainage_area: Decimal,
                                  solar_exposure: Decimal,
-                                 average_slope: Decimal
+                                 average_slope: Decimal,
+                                 exact: bool = False
                                  ):
     """
     This method pulls the model information for the selected hydrological zone and
     calculates estimated runoff and montly distribution values for the selected watershed area.
     We can use these values to then calculate flow values for the watershed.
+
+    The coefficients are cached (see coefficients.py) and the outputs are calculated with one
+    matrix-vector product.  With `exact`, they are calculated with Decimal arithmetic instead.
     """
 
     if not hydrological_zone or not median_elevation or glacial_coverage is None \
@@ -34,59 +49,93 @@ def calculate_mean_annual_runoff(db: Session,
         # raise HTTPException(
         #     status_code=400, detail="Missing scsb2016 model parameters.")
 
-    # query the co-efficient table for this hydrological zone
-    query = """
-        select * from modeling.mad_model_coefficients where hydrologic_zone_id = :hydro_zone_id
-    """
-    models = db.execute(query, {"hydro_zone_id": hydrological_zone})
-    if not models:
+    # the co-efficients for this hydrological zone
+    coefficients = get_zone_coefficients(db, hydrological_zone)
+    if not coefficients:
         return {"error": "Selection point not within supported hydrological zone."}
         # raise HTTPException(204, "Selection point not within supported hydrological zone.")
+    if coefficients.error:
+        return {"error": coefficients.error}
 
-    # logger.warning("**** CALCULATED VALUES ****")
-    # logger.warning("med.elev.: " + str(median_elevation) + " m")
-    # logger.warning("avg slope: " + str(average_slope))
-    # logger.warning("sol.exp.: " + str(solar_exposure))
-    # logger.warning("dra.area:" + str(drainage_area) + " km2")
-    # logger.warning("gla.cov.: " + str(glacial_coverage))
-    # logger.warning("ann.prec.: " + str(annual_precipitation) + " mm")
-    # logger.warning("models: " + str(models))
+    inputs = [median_elevation, glacial_coverage, annual_precipitation, evapo_transpiration,
+              drainage_area, solar_exposure, average_slope]
 
-    model_outputs = []
-    mean_annual_discharge = 0
     # calculate model outputs for gathered inputs,
     # model output types, MAR, MD(x12months), 7Q2, S-7Q10
-    for model in models:
-        model_result = Decimal(model.median_elevation_co) * Decimal(median_elevation) + \
-            Decimal(model.glacial_coverage_co) * Decimal(glacial_coverage) + \
-            Decimal(model.precipitation_co) * Decimal(annual_precipitation) + \
-            Decimal(model.potential_evapo_transpiration_co) * Decimal(evapo_transpiration) + \
-            Decimal(model.drainage_area_co) * Decimal(drainage_area) + \
-            Decimal(model.solar_exposure_co) * Decimal(solar_exposure) + \
-            Decimal(model.average_slope_co) * Decimal(average_slope) + \
-            Decimal(model.intercept_co)
+    if exact:
+        results = coefficients.evaluate_exact(inputs)
+    else:
+        results = coefficients.evaluate(np.array(inputs, dtype=np.float64)).tolist()
+
+    return model_outputs(coefficients, results, drainage_area, number=Decimal if exact else float)
+
 
+def calculate_mean_annual_runoff_many(db: Session, hydrological_zones: Sequence[int], inputs) -> List:
+    """
+    Calculates the SCSB 2016 model outputs of many watersheds (e.g. a whole region) at once.
+    `inputs` is a matrix with one row per watershed and one column per model input (in the order
+    of SCSB_INPUTS), and `hydrological_zones` has the zone of each row.  Each zone's watersheds
+    are calculated with one matrix product.  Returns the outputs of each watershed in the same
+    form as calculate_mean_annual_runoff (or an error for watersheds outside the supported zones,
+    or in zones with NULL coefficients).
+    """
+    inputs = np.asarray(inputs, dtype=np.float64).reshape((len(hydrological_zones), len(SCSB_INPUTS)))
+    zones = get_mad_model_coefficients(db)
+
+    rows_by_zone = {}
+    for i, zone in enumerate(hydrological_zones):
+        rows_by_zone.setdefault(zone, []).append(i)
+
+    results = [None] * len(hydrological_zones)
+    for zone, rows in rows_by_zone.items():
+        coefficients = zones.get(int(zone)) if zone else None
+        if not coefficients:
+            for i in rows:
+                results[i] = {"error": "Selection point not within supported hydrological zone."}
+            continue
+        if coefficients.error:
+            for i in rows:
+                results[i] = {"error": coefficients.error}
+            continue
+
+        zone_results = coefficients.evaluate(inputs[rows])
+        drainage_area = inputs[rows, SCSB_INPUTS.index('drainage_area')]
+        for j, i in enumerate(rows):
+            results[i] = model_outputs(coefficients, zone_results[j].tolist(), drainage_area[j].item())
+
+    return results
+
+
+def model_outputs(coefficients: ZoneCoefficients, results: list, drainage_area, number=float) -> list:
+    """
+    returns the model output records of a watershed from its model `results` (one per
+    coefficient row), plus the mean annual discharge (MAD) and the monthly discharges.
+    `number` is the type used for the discharge calculations (float or Decimal).
+    """
+    model_outputs = []
+    mean_annual_discharge = 0
+    for model, model_result in zip(coefficients.rows, results):
         model_outputs.append({
-            "output_type": model.model_output_type,
+            "output_type": model['model_output_type'],
             "model_result": model_result,
-            "month": model.month,
-            "r2": model.r2,
-            "adjusted_r2": model.adjusted_r2,
-            "steyx": model.steyx,
-            "median_elevation_co": model.median_elevation_co,
-            "glacial_coverage_co": model.glacial_coverage_co,
-            "precipitation_co": model.precipitation_co,
-            "potential_evapo_transpiration_co": model.potential_evapo_transpiration_co,
-            "drainage_area_co": model.drainage_area_co,
-            "solar_exposure_co": model.solar_exposure_co,
-            "average_slope_co": model.average_slope_co,
-            "intercept_co": model.intercept_co
+            "month": model['month'],
+            "r2": model['r2'],
+            "adjusted_r2": model['adjusted_r2'],
+            "steyx": model['steyx'],
+            "median_elevation_co": model['median_elevation_co'],
+            "glacial_coverage_co": model['glacial_coverage_co'],
+            "precipitation_co": model['precipitation_co'],
+            "potential_evapo_transpiration_co": model['potential_evapo_transpiration_co'],
+            "drainage_area_co": model['drainage_area_co'],
+            "solar_exposure_co": model['solar_exposure_co'],
+            "average_slope_co": model['average_slope_co'],
+            "intercept_co": model['intercept_co']
         })
 
         # this is a helper ouput that calculates MAD from MAR
-        if model.model_output_type == 'MAR':
+        if model['model_output_type'] == 'MAR':
             mean_annual_discharge = model_result / \
-                1000 * Decimal(drainage_area)
+                1000 * number(drainage_area)
             model_outputs.append({
                 "output_type": 'MAD',
                 "model_result": mean_annual_discharge,
@@ -100,9 +149,6 @@ def calculate_mean_annual_runoff(db: Session,
         return {"error": "No model output calculated."}
         # raise HTTPException(204, "No model output calculated.")
 
-    months = {1: 31, 2: 28, 3: 31, 4: 30, 5: 31, 6: 30,
-              7: 31, 8: 31, 9: 30, 10: 31, 11: 30, 12: 31}
-
     # helper to add mad monthly values to result based on Monthly Distributions
     mad_monthlys = []
     for model in model_outputs:
@@ -110,7 +156,7 @@ def calculate_mean_annual_runoff(db: Session,
             mad_monthlys.append({
                 "output_type": 'MAD',
                 "model_result": mean_annual_discharge * model["model_result"] * \
-                                Decimal(365 / months[model["month"]]),
+                                number(365 / MONTH_DAYS[model["month"]]),
                 "month": model["month"],
                 "r2": 0,
                 "adjusted_r2": 0,
@@ -127,6 +173,11 @@ def get_hydrological_zone(point=None):
     if not point:
         return None
 
+    zone_index = get_zone_index()
+    if zone_index:
+        return zone_index.lookup(point)
+
+    # the hydrologic_zone_boundaries table hasn't been loaded.
     hydrologic_zones = databc_feature_search('WHSE_WATER_MANAGEMENT.HYDZ_HYDROLOGICZONE_SP',
                                              search_area=point)
     if hydrologic_zones.features:
@@ -137,6 +188,21 @@ def get_hydrological_zone(point=None):
     return hydrologic_zone_number
 
 
+def get_hydrological_zones(points: List[Point]) -> List[Optional[int]]:
+    """
+    Lookup the hydrological zone of each point in `points` (e.g. the centroids of many
+    watersheds for batch modelling). Points outside every zone are None.
+    """
+    if not points:
+        return []
+
+    zone_index = get_zone_index()
+    if zone_index:
+        return zone_index.lookup_many([p.x for p in points], [p.y for p in points])
+
+    return [get_hydrological_zone(point) for point in points]
+
+
 def model_output_as_dict(data: list):
     """
         organizes SCSB model output in dict format
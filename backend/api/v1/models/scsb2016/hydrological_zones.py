@@ -0,0 +1,142 @@
+"""
+In-memory index of the hydrological zones of BC (WHSE_WATER_MANAGEMENT.HYDZ_HYDROLOGICZONE_SP).
+
+The zone of a watershed selects the SCSB model coefficients, and used to be looked up with a
+DataBC WFS request for every watershed summary.  The zones layer is small and rarely changes, so
+it is read once from the local hydrologic_zone_boundaries table (loaded by the import jobs) into
+an STRtree of prepared polygons, and reloaded every HYDROLOGICAL_ZONES_REFRESH_SECONDS:
+
+    zone = get_zone_index().lookup(point)
+    zones = get_zone_index().lookup_many(xs, ys)   # many points at once, e.g. for batch modelling
+
+`get_zone_index` returns None if the table hasn't been loaded; get_hydrological_zone then falls
+back to a WFS request.
+"""
+import logging
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import shapely.vectorized
+from shapely import wkb
+from shapely.geometry import Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from api.db.session import Session as SessionLocal
+
+logger = logging.getLogger('api')
+
+# how long a loaded index is used before it is read from the database again
+HYDROLOGICAL_ZONES_REFRESH_SECONDS = 24 * 60 * 60
+
+# how long to wait before trying again when the table couldn't be read or was empty
+HYDROLOGICAL_ZONES_RETRY_SECONDS = 5 * 60
+
+
+class HydrologicalZoneIndex:
+    """ point in polygon lookups of hydrological zone numbers """
+
+    def __init__(self, zones: Sequence[Tuple[int, object]]):
+        """ `zones` is a list of (zone number, polygon in EPSG:4326) """
+        self.zone_numbers = [int(number) for number, _ in zones]
+        self._geoms = [geom for _, geom in zones]
+        self._prepared = [prep(geom) for geom in self._geoms]
+        self._bounds = np.array([geom.bounds for geom in self._geoms]).reshape(-1, 4)
+        self._tree = STRtree(self._geoms)
+        # STRtree.query returns the geometries themselves
+        self._position = {id(geom): i for i, geom in enumerate(self._geoms)}
+
+    def __len__(self):
+        return len(self._geoms)
+
+    def lookup(self, point: Point) -> Optional[int]:
+        """ returns the number of the zone `point` is in, or None if it isn't in a zone """
+        # the zone listed first wins if zones overlap (e.g. a point on the border of two zones)
+        candidates = sorted(self._position[id(geom)] for geom in self._tree.query(point))
+        for i in candidates:
+            if self._prepared[i].intersects(point):
+                return self.zone_numbers[i]
+        return None
+
+    def lookup_many(self, xs: Sequence[float], ys: Sequence[float]) -> List[Optional[int]]:
+        """
+        returns the zone number of each point (xs[i], ys[i]) (EPSG:4326), or None for
+        points outside every zone.  Each zone is tested against all the points in its bounding
+        box at once.
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        zones = np.zeros(xs.shape, dtype=np.int64)
+        found = np.zeros(xs.shape, dtype=bool)
+
+        for i, (minx, miny, maxx, maxy) in enumerate(self._bounds):
+            candidates = ~found & (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)
+            if not candidates.any():
+                continue
+            idx = np.flatnonzero(candidates)
+            inside = shapely.vectorized.contains(self._geoms[i], xs[idx], ys[idx])
+            zones[idx[inside]] = self.zone_numbers[i]
+            found[idx[inside]] = True
+
+        result = [int(zone) if ok else None for zone, ok in zip(zones, found)]
+
+        # vectorized.contains excludes points exactly on a boundary, which `lookup` includes.
+        for i in np.flatnonzero(~found):
+            result[i] = self.lookup(Point(xs[i], ys[i]))
+        return result
+
+
+def load_zone_index(db) -> Optional[HydrologicalZoneIndex]:
+    """ reads the zones from the hydrologic_zone_boundaries table. Returns None if it's empty. """
+    q = """
+        SELECT  "HYDROLOGICZONE_NO" as zone,
+                ST_AsBinary("GEOMETRY") as geom
+        FROM    hydrologic_zone_boundaries
+        WHERE   "HYDROLOGICZONE_NO" IS NOT NULL
+        ORDER BY "HYDROLOGICZONE_SP_ID"
+    """
+    zones = [(row['zone'], wkb.loads(bytes(row['geom']))) for row in db.execute(q)]
+    if not zones:
+        return None
+    return HydrologicalZoneIndex(zones)
+
+
+_index: Optional[HydrologicalZoneIndex] = None
+_next_load = 0.0
+_lock = threading.Lock()
+
+
+def get_zone_index() -> Optional[HydrologicalZoneIndex]:
+    """
+    returns the shared zone index, loading it if it hasn't been loaded yet or is older than
+    HYDROLOGICAL_ZONES_REFRESH_SECONDS.  Returns None if the zones aren't available.
+    """
+    global _index, _next_load
+
+    if time.monotonic() < _next_load:
+        return _index
+
+    with _lock:
+        # another thread may have loaded it while we waited.
+        if time.monotonic() < _next_load:
+            return _index
+
+        db = SessionLocal()
+        try:
+            index = load_zone_index(db)
+        except Exception as e:
+            logger.warning("could not load hydrological zones: %s", e)
+            index = None
+        finally:
+            db.close()
+
+        if index:
+            logger.info("loaded %s hydrological zone polygons", len(index))
+            _index = index
+            _next_load = time.monotonic() + HYDROLOGICAL_ZONES_REFRESH_SECONDS
+        else:
+            # keep using the previous index (if any) until the table can be read.
+            _next_load = time.monotonic() + HYDROLOGICAL_ZONES_RETRY_SECONDS
+        return _index
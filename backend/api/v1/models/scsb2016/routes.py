@@ -25,11 +25,12 @@ def get_scsb2016_values(
         drainage_area: float,
         solar_exposure: float,
         average_slope: float,
+        exact: bool = Query(False, description="Calculate the outputs with Decimal arithmetic"),
         db: Session = Depends(get_db),
 ):
 
     result = calculate_mean_annual_runoff(db, hydrological_zone, median_elevation, \
         glacial_coverage, annual_precipitation, evapo_transpiration, \
-        drainage_area, solar_exposure, average_slope)
+        drainage_area, solar_exposure, average_slope, exact=exact)
 
     return result
\ No newline at end of file
@@ -4,3 +4,8 @@ PRECIP_RASTER = f"{RASTER_FILE_DIR}/NORM_6190_Precip.tif"
 PET_RASTER = f"{RASTER_FILE_DIR}/WNA_et0.tif"
 CDEM_FILE = f"{RASTER_FILE_DIR}/Burned_CDEM_4326.tif"
 SRTM_FILE = f"{RASTER_FILE_DIR}/Burned_SRTM_3005.tif"
+HILLSHADE_RASTER = f"{RASTER_FILE_DIR}/BC_Area_Hillshade_3005.tif"
+
+# precipitation, PET and hillshade resampled onto one grid as a multi-band COG
+# (see imports/climate/build_climate_stack.sh)
+CLIMATE_STACK_RASTER = f"{RASTER_FILE_DIR}/BC_Climate_Stack_4326.tif"
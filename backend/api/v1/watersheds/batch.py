@@ -0,0 +1,150 @@
+"""
+Batch watershed delineation.
+
+Delineates watersheds for many points of interest (e.g. every HYDAT station when rebuilding
+model training data) in one request.  Each item runs `calculate_watershed` (or
+`get_watershed_at_hydat_station`) in a pool of worker processes, each with its own database
+connections, and results are returned in the order they finish.
+
+The pool (WATERSHED_BATCH_PROCESSES workers) is shared by all the batches running in an API
+process.  Each batch only keeps as many items in the pool as there are workers, so batches
+running at the same time take turns instead of one batch queueing all of its items first.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from typing import Optional
+
+from shapely.geometry import Point
+
+from api.config import WATERSHED_BATCH_PROCESSES
+from api.v1.watersheds.schema import WatershedBatchItem
+
+logger = logging.getLogger('WATERSHEDS')
+
+
+def _init_worker():
+    # worker processes are started with "spawn", so they don't share the parent's
+    # database connections or GDAL state. Make sure the engine starts with an empty pool.
+    from api.db.session import engine
+    engine.dispose()
+
+
+def delineate_batch_item(item: dict, upstream_method: str, dem_source: str, user_uuid: Optional[str]) -> str:
+    """
+    delineates the watershed for one batch item (a WatershedBatchItem as a dict) in a worker process.
+    Returns a JSON line with the result or the error.
+    """
+    from api.db.session import Session as SessionLocal
+    from api.v1.watersheds.controller import calculate_watershed, get_watershed_at_hydat_station
+
+    start = time.perf_counter()
+    user = SimpleNamespace(user_uuid=user_uuid)
+    result = {"id": item.get("id"), "watershed": None, "error": None}
+
+    db = SessionLocal()
+    try:
+        if item.get("hydat_station_number"):
+            watershed = get_watershed_at_hydat_station(
+                db, user, hydat_station_number=item["hydat_station_number"], upstream_method=upstream_method)
+        elif item.get("watershed_id"):
+            watershed = calculate_watershed(
+                db, user, watershed_id=item["watershed_id"], upstream_method=upstream_method)
+        elif item.get("point"):
+            watershed = calculate_watershed(
+                db, user, click_point=Point(item["point"]), upstream_method=upstream_method,
+                dem_source=dem_source)
+        else:
+            raise ValueError("Provide a point, hydat_station_number or watershed_id")
+
+        if watershed:
+            result["watershed"] = json.loads(watershed.json())
+        else:
+            result["error"] = "unable to delineate a watershed"
+    except Exception as e:
+        logger.exception("batch delineation failed for %s", item)
+        db.rollback()
+        result["error"] = str(e)
+    finally:
+        db.close()
+
+    result["processing_time"] = time.perf_counter() - start
+    return json.dumps(result) + "\n"
+
+
+_batch_executor: Optional[ProcessPoolExecutor] = None
+_batch_executor_lock = threading.Lock()
+
+
+def get_batch_executor() -> ProcessPoolExecutor:
+    """ returns the process pool shared by all batches, starting it if needed """
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ProcessPoolExecutor(
+                max_workers=max(WATERSHED_BATCH_PROCESSES, 1),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker
+            )
+        return _batch_executor
+
+
+def reset_batch_executor(executor: ProcessPoolExecutor):
+    """ discards `executor` if it is still the shared pool (e.g. after a worker process died) """
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is executor:
+            _batch_executor = None
+    executor.shutdown(wait=False)
+
+
+def error_line(item_id, error: str) -> str:
+    return json.dumps({"id": item_id, "watershed": None, "error": error, "processing_time": 0}) + "\n"
+
+
+async def stream_batch(items: list, upstream_method: str, dem_source: str, user_uuid: Optional[str]):
+    """
+    delineates every item in the shared process pool, yielding a newline-delimited JSON
+    result for each item as soon as it finishes.  At most WATERSHED_BATCH_PROCESSES items of
+    the batch are in the pool at once.  Pending items are cancelled if the client disconnects.
+    """
+    queue = []
+    for index, item in enumerate(items):
+        item = item.dict() if isinstance(item, WatershedBatchItem) else dict(item)
+        if item.get("id") is None:
+            item["id"] = str(index)
+        queue.append(item)
+    queue.reverse()
+
+    in_flight = {}
+    try:
+        while queue or in_flight:
+            while queue and len(in_flight) < max(WATERSHED_BATCH_PROCESSES, 1):
+                item = queue.pop()
+                executor = get_batch_executor()
+                try:
+                    future = executor.submit(delineate_batch_item, item, upstream_method, dem_source, user_uuid)
+                except BrokenProcessPool:
+                    reset_batch_executor(executor)
+                    future = get_batch_executor().submit(
+                        delineate_batch_item, item, upstream_method, dem_source, user_uuid)
+                in_flight[asyncio.wrap_future(future)] = (item["id"], executor)
+
+            done, _ = await asyncio.wait(list(in_flight), return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                item_id, executor = in_flight.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool as e:
+                    logger.error("batch delineation worker failed for %s: %s", item_id, e)
+                    reset_batch_executor(executor)
+                    yield error_line(item_id, "delineation worker failed")
+    finally:
+        for future in in_flight:
+            future.cancel()
@@ -0,0 +1,134 @@
+"""
+Cross-user cache of delineated watersheds.
+
+The session cache (`watershed_cache`, see controller.get_cached_watershed) only returns a
+watershed to the user/session that generated it.  This cache is shared by everyone: entries are
+keyed by the inputs that determine the delineation result (the upstream method, DEM source,
+the fundamental watershed containing the point and, for DEM methods, the point on the stream
+rounded to a DEM cell), so the same HYDAT station or intake is only delineated once.
+
+Entries are stamped with a data version (the last FWA load date, WATERSHED_DEM_VERSION and the
+delineation engine).  Reloading either data source changes the version, and entries with an old
+version are ignored and then pruned.  The `prune_delineated_watershed_cache` trigger also removes
+entries that haven't been used in 30 days, and keeps only the most recently used entries.
+"""
+import hashlib
+import json
+import logging
+from typing import Optional
+from geojson import Feature
+from shapely.geometry import Point, shape
+from sqlalchemy.orm import Session
+
+from api.config import WATERSHED_DEM_VERSION, WATERSHED_DELINEATION_ENGINE
+from api.v1.watersheds.schema import GeneratedWatershedDetails
+
+logger = logging.getLogger('WATERSHEDS')
+
+# points are rounded to a 3 arc second grid (the resolution of the stream burned CDEM)
+# before hashing. Points in the same cell delineate to the same pour point.
+CACHE_CELL_SIZE_DEGREES = 1 / 1200
+
+# layers that a change in would change a delineation
+FWA_DATA_TABLES = ('freshwater_atlas_watersheds', 'freshwater_atlas_stream_networks')
+
+
+def watershed_cache_key(
+        upstream_method: str, dem_source: str, watershed_id: int, point: Optional[Point] = None) -> str:
+    """
+    returns a normalized key for a delineation.  The point is only part of the key for DEM methods;
+    FWA methods depend only on the starting fundamental watershed.
+    """
+    if upstream_method.startswith('DEM') and point:
+        col = round(point.x / CACHE_CELL_SIZE_DEGREES)
+        row = round(point.y / CACHE_CELL_SIZE_DEGREES)
+        location = f"{col}:{row}"
+    else:
+        location = ''
+        dem_source = ''
+
+    key = f"{upstream_method}|{dem_source}|{watershed_id}|{location}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def get_watershed_data_version(db: Session) -> str:
+    """
+    returns a stamp that changes when the FWA layers are reloaded or the DEM is replaced
+    (by changing WATERSHED_DEM_VERSION).
+    """
+    q = """
+        SELECT  max(last_updated_data) as last_updated
+        FROM    metadata.data_source
+        WHERE   data_table_name = ANY(:tables)
+    """
+    res = db.execute(q, {"tables": list(FWA_DATA_TABLES)})
+    row = res.fetchone()
+    fwa_version = row['last_updated'].isoformat() if row and row['last_updated'] else ''
+    return f"fwa:{fwa_version}|dem:{WATERSHED_DEM_VERSION}|engine:{WATERSHED_DELINEATION_ENGINE}"
+
+
+def get_shared_cached_watershed(db: Session, cache_key: str, data_version: str) -> Optional[GeneratedWatershedDetails]:
+    """
+    returns a cached delineation for `cache_key` made from the current data, or None.
+    The hit count and `last_accessed_date` are updated on each hit.
+    """
+    q = """
+    update      delineated_watershed_cache
+    set         last_accessed_date = now(),
+                hit_count = hit_count + 1
+    where       cache_key = (
+        select      cache_key
+        from        delineated_watershed_cache
+        where       cache_key = :cache_key
+        and         data_version = :data_version
+        for update skip locked
+    )
+    returning   watershed
+    """
+    res = db.execute(q, {"cache_key": cache_key, "data_version": data_version})
+    row = res.one_or_none()
+    db.commit()
+
+    if not row:
+        return None
+
+    data = row['watershed']
+    if isinstance(data, str):
+        data = json.loads(data)
+    feat = data.pop('watershed')
+    data['watershed'] = Feature(
+        id=feat['id'], geometry=shape(feat['geometry']), properties=feat['properties'])
+
+    ws = GeneratedWatershedDetails(**data)
+    ws.from_cache = True
+    return ws
+
+
+def store_shared_cached_watershed(
+        db: Session, cache_key: str, data_version: str, watershed: GeneratedWatershedDetails):
+    """
+    adds a delineation to the shared cache, replacing any entry with the same key.
+    """
+    q = """
+    insert into delineated_watershed_cache (
+        cache_key, upstream_method, dem_source, fwa_watershed_id, data_version, watershed
+    )
+    values (
+        :cache_key, :upstream_method, :dem_source, :fwa_watershed_id, :data_version, CAST(:watershed AS jsonb)
+    )
+    on conflict (cache_key) do update
+    set     data_version = excluded.data_version,
+            watershed = excluded.watershed,
+            hit_count = 0,
+            create_date = now(),
+            last_accessed_date = now()
+    """
+    db.execute(q, {
+        "cache_key": cache_key,
+        "upstream_method": watershed.upstream_method,
+        "dem_source": watershed.dem_source,
+        "fwa_watershed_id": watershed.fwa_watershed_id,
+        "data_version": data_version,
+        "watershed": watershed.json(exclude={'generated_watershed_id'})
+    })
+    db.commit()
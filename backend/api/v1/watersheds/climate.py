@@ -12,18 +12,26 @@
 """
 import logging
 import time
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from shapely.geometry import Polygon
 from api.utils import get_raster_dataset
-from api.v1.watersheds import PRECIP_RASTER, PET_RASTER
+from api.v1.watersheds import PRECIP_RASTER, PET_RASTER, CLIMATE_STACK_RASTER
 
 logger = logging.getLogger('climate')
 
+# the bands of CLIMATE_STACK_RASTER, in order.
+CLIMATE_STACK_BANDS = ('precipitation', 'pet', 'hillshade')
+CLIMATE_STACK_NO_DATA = -9999
+
+# the max possible value of the int16 hillshade raster
+HILLSHADE_MAX = 32767
+
 
 def get_mean_annual_precipitation(
     area: Polygon,
     raster: str = "/vsis3/"+PRECIP_RASTER,
-    retry_min_size: Optional[float] = None
+    retry_min_size: Optional[float] = None,
+    overview_level: Optional[int] = None
 ) -> float:
     """
     Reads the precip in `area` from a PRISM raster (located at the path provided by the
@@ -32,13 +40,16 @@ def get_mean_annual_precipitation(
     `raster` can be a file path or a GDAL virtual filesystem path.
     /vsis3/ is pre-configured for WALLY's Minio storage.
     example:  "/vsis3/raster/NORM_6190_Precip.tif"
+
+    `overview_level` reads an overview of the raster instead (see api.utils.raster.select_overview).
     """
     start = time.perf_counter()
 
     no_data = -9999
 
     # get a clipped raster covering `area` and read into a Numpy array
-    precip_data = get_raster_dataset(raster, area=area, no_data=no_data, retry_min_size=retry_min_size).ReadAsArray()
+    precip_data = get_raster_dataset(raster, area=area, no_data=no_data, retry_min_size=retry_min_size,
+                                     overview_level=overview_level).ReadAsArray()
 
     # find mean using Numpy
     precip = precip_data[precip_data != no_data].mean().item()
@@ -56,7 +67,8 @@ def get_mean_annual_precipitation(
 def get_potential_evapotranspiration(
     area: Polygon,
     raster: str = "/vsis3/"+PET_RASTER,
-    retry_min_size: Optional[float] = None
+    retry_min_size: Optional[float] = None,
+    overview_level: Optional[int] = None
 ) -> float:
     """
     Retrieves potential evapotranspiration from the Global Aridity and PET database.
@@ -71,14 +83,14 @@ def get_potential_evapotranspiration(
     https://doi.org/10.6084/m9.figshare.7504448.v3 
     https://cgiarcsi.community/data/global-aridity-and-pet-database/
 
-
-
+    `overview_level` reads an overview of the raster instead (see api.utils.raster.select_overview).
     """
     start = time.perf_counter()
     no_data = -32768
 
     # get a clipped raster for `area` and read into a Numpy array
-    pet_data = get_raster_dataset(raster, area=area, no_data=no_data, retry_min_size=retry_min_size).ReadAsArray()
+    pet_data = get_raster_dataset(raster, area=area, no_data=no_data, retry_min_size=retry_min_size,
+                                  overview_level=overview_level).ReadAsArray()
 
     # get mean of all valid cells
     pet = pet_data[pet_data != no_data].mean().item()
@@ -91,3 +103,58 @@ def get_potential_evapotranspiration(
                 pet, elapsed)
 
     return pet
+
+
+def read_climate_stack(
+    area: Polygon,
+    raster: str = "/vsis3/"+CLIMATE_STACK_RASTER,
+    retry_min_size: Optional[float] = None,
+    overview_level: Optional[int] = None
+) -> Dict[str, Tuple[float, int]]:
+    """
+    Reads precipitation, PET and hillshade in `area` with one windowed read of the
+    multi-band climate stack (see imports/climate/build_climate_stack.sh), and returns the
+    sum and number of valid cells of each band, keyed by CLIMATE_STACK_BANDS.
+    `overview_level` reads an overview of the stack instead of full resolution.
+    """
+    start = time.perf_counter()
+
+    # all bands are clipped in a single warp of the (pixel interleaved) COG.
+    dataset = get_raster_dataset(raster, area=area, no_data=CLIMATE_STACK_NO_DATA, retry_min_size=retry_min_size,
+                                 overview_level=overview_level)
+
+    sums = {}
+    for i, band in enumerate(CLIMATE_STACK_BANDS):
+        data = dataset.GetRasterBand(i + 1).ReadAsArray()
+        values = data[data != CLIMATE_STACK_NO_DATA]
+        sums[band] = (float(values.sum()), int(values.size))
+
+    dataset = None
+
+    logger.info('climate stack read in %s', time.perf_counter() - start)
+    return sums
+
+
+def get_climate_means(
+    area: Polygon,
+    raster: str = "/vsis3/"+CLIMATE_STACK_RASTER,
+    retry_min_size: Optional[float] = None,
+    overview_level: Optional[int] = None
+) -> Dict[str, Optional[float]]:
+    """
+    Returns the mean annual precipitation, potential evapotranspiration and solar exposure
+    (mean hillshade as a fraction of HILLSHADE_MAX) in `area` from one read of the climate stack.
+    A value is None if `area` has no valid cells in that band.
+    """
+    sums = read_climate_stack(area, raster=raster, retry_min_size=retry_min_size, overview_level=overview_level)
+
+    def mean(band):
+        total, count = sums[band]
+        return total / count if count else None
+
+    hillshade = mean('hillshade')
+    return {
+        'annual_precipitation': mean('precipitation'),
+        'potential_evapotranspiration': mean('pet'),
+        'solar_exposure': hillshade / HILLSHADE_MAX if hillshade is not None else None,
+    }
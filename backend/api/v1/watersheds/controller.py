@@ -11,13 +11,15 @@ import fiona
 import math
 import re
 import time
+import threading
 import os
 import zipfile
 import sqlalchemy as sa
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
 from tempfile import TemporaryDirectory
 from geoalchemy2.elements import WKTElement
-from shapely import wkb
-from typing import Tuple, List, Optional
+from shapely import wkb, wkt
+from typing import Callable, Tuple, List, Optional
 from urllib.parse import urlencode
 from geojson import FeatureCollection, Feature
 from operator import add
@@ -28,8 +30,11 @@ from sqlalchemy.orm import Session
 from sqlalchemy import func, insert, select
 from fastapi import HTTPException
 
-from api.config import WATERSHED_DEBUG
+from api.config import WATERSHED_DEBUG, WATERSHED_CANDIDATE_WORKERS
+from api.db.session import Session as SessionLocal
 from api.utils import normalize_quantity
+from api.utils.raster import select_overview
+from api.utils.task_graph import TaskGraph, task_session
 from api.layers.freshwater_atlas_watersheds import FreshwaterAtlasWatersheds
 from api.layers.freshwater_atlas_stream_networks import FreshwaterAtlasStreamNetworks
 from api.v1.aggregator.helpers import transform_4326_3005, transform_3005_4326
@@ -37,8 +42,14 @@ from api.v1.hydat.controller import get_point_on_stream, get_station
 from api.v1.models.scsb2016.controller import get_hydrological_zone
 from api.v1.streams.controller import get_nearest_streams, get_nearest_hydat_stream_segments
 from api.v1.watersheds.db_models import GeneratedWatershed, WatershedCache
-from api.v1.watersheds.climate import get_mean_annual_precipitation, get_potential_evapotranspiration
+from api.v1.watersheds.climate import (
+    get_mean_annual_precipitation,
+    get_potential_evapotranspiration,
+    get_climate_means
+)
+from api.v1.watersheds import PRECIP_RASTER, PET_RASTER, HILLSHADE_RASTER, CLIMATE_STACK_RASTER
 from api.v1.watersheds.cdem import CDEM
+from api.v1.watersheds.fwa_attributes import get_fwa_watershed_stats
 from api.v1.watersheds.schema import (
     LicenceDetails,
     SurficialGeologyDetails,
@@ -50,8 +61,14 @@ from api.v1.watersheds.schema import (
 from api.v1.watersheds.delineate_watersheds import (
     get_full_stream_catchment_area,
     get_upstream_catchment_area,
-    get_watershed_using_dem,
-    watershed_touches_border
+    get_watershed_using_dem
+)
+from api.v1.watersheds.upstream import UpstreamWatershedSet
+from api.v1.watersheds.cache import (
+    watershed_cache_key,
+    get_watershed_data_version,
+    get_shared_cached_watershed,
+    store_shared_cached_watershed
 )
 
 
@@ -64,13 +81,62 @@ logger = logging.getLogger('WATERSHEDS')
 
 SEC_IN_YEAR = 31536000
 
+# timeouts (seconds) for each of the inputs gathered by get_watershed_details.
+WFS_TASK_TIMEOUT = 30
+RASTER_TASK_TIMEOUT = 60
+DB_TASK_TIMEOUT = 60
+
+
+# glacier area inside a polygon, from the local copy of the FWA glaciers layer.
+# Only glaciers that intersect the polygon are read (using the index on "GEOMETRY"), and
+# glaciers entirely inside it don't need to be clipped.
+GLACIAL_AREA_QUERY = """
+    WITH area AS (
+        SELECT  ST_GeomFromText(:polygon, 4326) as geom
+    )
+    SELECT  coalesce(sum(
+                CASE WHEN ST_CoveredBy(g."GEOMETRY", area.geom)
+                THEN ST_Area(ST_Transform(g."GEOMETRY", 3005))
+                ELSE ST_Area(ST_Transform(ST_Intersection(g."GEOMETRY", area.geom), 3005))
+                END
+            ), 0) as glacial_area,
+            ST_Area(ST_Transform(area.geom, 3005)) as area,
+            EXISTS (SELECT 1 FROM freshwater_atlas_glaciers) as loaded
+    FROM    area
+    LEFT JOIN freshwater_atlas_glaciers g
+    ON      ST_Intersects(g."GEOMETRY", area.geom)
+    GROUP BY area.geom
+"""
+
 
 def calculate_glacial_area(db: Session, polygon: MultiPolygon) -> Tuple[float, float]:
     """
     Calculates percent glacial coverage using the area of `polygon` which intersects with features from
-    the DataBC FWA Glaciers dataset.
+    the FWA Glaciers layer (freshwater_atlas_glaciers table).
+    If the table hasn't been loaded, the glaciers are requested from the DataBC WFS instead.
     returns a tuple of floats with the form (glacial_area, coverage).
     """
+    try:
+        row = db.execute(GLACIAL_AREA_QUERY, {"polygon": polygon.wkt}).fetchone()
+    except sa.exc.ProgrammingError as e:
+        # the freshwater_atlas_glaciers migration hasn't been run.
+        logger.warning("could not query freshwater_atlas_glaciers: %s", e)
+        db.rollback()
+        row = None
+
+    if not row or not row['loaded']:
+        logger.warning("freshwater_atlas_glaciers has no data; using DataBC WFS for glacial area")
+        return calculate_glacial_area_wfs(db, polygon)
+
+    glacial_area = row['glacial_area']
+    return (glacial_area, glacial_area / row['area'])
+
+
+def calculate_glacial_area_wfs(db: Session, polygon: MultiPolygon) -> Tuple[float, float]:
+    """
+    Calculates glacial area and coverage like `calculate_glacial_area`, using glacier
+    features from the DataBC FWA Glaciers WFS layer.
+    """
 
     glaciers_layer = 'freshwater_atlas_glaciers'
 
@@ -417,6 +483,21 @@ def get_watershed_id_at_point(db: Session, point: Point):
     return watershed_id
 
 
+def get_point_in_watershed(db: Session, watershed_id: int) -> Optional[Point]:
+    """
+    returns a point (EPSG:4326) inside the fundamental watershed polygon `watershed_id`,
+    used as the click point of watersheds delineated from a watershed ID.
+    """
+    q = db.query(func.ST_AsText(func.ST_PointOnSurface(FreshwaterAtlasWatersheds.GEOMETRY))).filter(
+        FreshwaterAtlasWatersheds.WATERSHED_FEATURE_ID == watershed_id
+    )
+
+    point = q.first()
+    if not point or not point[0]:
+        return None
+    return wkt.loads(point[0])
+
+
 def get_upstream_watershed_polygon_count(db: Session, watershed_id: int) -> int:
     """Returns the number of polygons upstream from watershed_id.
     This helps if we want to determine if a group of watershed polygons
@@ -430,38 +511,7 @@ def get_upstream_watershed_polygon_count(db: Session, watershed_id: int) -> int:
     This query can be expensive but is much faster than attempting a full watershed
     delineation and finding out too late that we're working in an unmanageable large area.
     """
-    q = """
-        with subwscode_ltree as (
-            SELECT  "WATERSHED_FEATURE_ID" as origin_id,
-                    wscode_ltree as origin_wscode,
-                    localcode_ltree as origin_localcode,
-                    ltree2text(subpath(localcode_ltree, -1))::integer as downstream_tributary,
-                    nlevel(localcode_ltree) as downstream_tributary_code_pos
-            FROM    freshwater_atlas_watersheds
-            WHERE   "WATERSHED_FEATURE_ID" = :watershed_feature_id
-        )
-        SELECT  count(*)
-        FROM    freshwater_atlas_watersheds
-        WHERE   wscode_ltree <@ (select origin_wscode from subwscode_ltree)
-        AND     ltree2text(subltree(
-                    localcode_ltree || '000000'::ltree,
-                    (select downstream_tributary_code_pos from subwscode_ltree) - 1,
-                    (select downstream_tributary_code_pos from subwscode_ltree) - 0
-                ))::integer >= (select downstream_tributary from subwscode_ltree)
-        AND (NOT wscode_ltree <@ (select origin_localcode from subwscode_ltree) OR (select origin_wscode from subwscode_ltree) = (select origin_localcode from subwscode_ltree))
-
-    """
-
-    res = db.execute(q, {"watershed_feature_id": watershed_id})
-
-    record = res.fetchone()
-
-    if not record or not record[0]:
-        logger.warning(
-            'unable to calculate polygon count from watershed feature id %s', watershed_id)
-        return None
-
-    return record[0]
+    return UpstreamWatershedSet(db, watershed_id).polygon_count()
 
 
 def calculate_watershed(
@@ -471,7 +521,10 @@ def calculate_watershed(
     watershed_id: int = None,
     hydat_station_number: str = None,
     upstream_method='DEM+FWA',
-    dem_source='cdem'
+    dem_source='cdem',
+    progress: Callable[[str], None] = None,
+    store: bool = True,
+    cancel: threading.Event = None
 ) -> GeneratedWatershedDetails:
     """ estimates the watershed area upstream of a POI and returns a GeneratedWatershedDetails object.
 
@@ -496,10 +549,26 @@ def calculate_watershed(
             DEM+FWA: Attempt to combine both the DEM and FWA methods by using the DEM close
                      to the point of interest, and the FWA around the outer perimeter. This
                      is the default.
+
+        progress: optional callback, called with the name of each DEM delineation stage
+                  (clip, condition, accumulate, snap, vectorize) as it starts.
+        store: if False, the result is not saved with store_generated_watershed (and has no
+               generated_watershed_id). Used when the result is one of several candidates.
+        cancel: optional threading.Event. If it is set, the delineation stops at the next
+                stage and DelineationCancelled is raised.
     """
     start = time.perf_counter()
     warnings = []
 
+    def report_progress(stage: str):
+        if cancel and cancel.is_set():
+            raise DelineationCancelled()
+        if progress:
+            progress(stage)
+
+    if cancel and cancel.is_set():
+        raise DelineationCancelled()
+
     if click_point and watershed_id:
         raise ValueError(
             "Do not provide both point and watershed_id at the same time")
@@ -556,12 +625,42 @@ def calculate_watershed(
         # this will be used later to help with queries against the fundamental watersheds.
         watershed_id = get_watershed_id_at_point(db, point_on_stream)
 
+    elif not click_point:
+        # started from a watershed ID: report a point inside the starting polygon as the
+        # click (and snapped) point.
+        click_point = get_point_in_watershed(db, watershed_id)
+        if click_point is None:
+            raise ValueError(f"Watershed {watershed_id} not found")
+
+    # delineations are shared between users and sessions.  Check for a result
+    # delineated from the same inputs and the current version of the FWA/DEM data.
+    cache_key = watershed_cache_key(upstream_method, dem_source, watershed_id, point_on_stream)
+    data_version = get_watershed_data_version(db)
+    cached_watershed = get_shared_cached_watershed(db, cache_key, data_version)
+    if cached_watershed:
+        logger.info('-- returning shared cached watershed for %s', cached_watershed.wally_watershed_id)
+        cached_watershed.warnings = warnings + cached_watershed.warnings
+        if click_point:
+            cached_watershed.click_point = click_point.wkt
+        cached_watershed.processing_time = time.perf_counter() - start
+        if store:
+            cached_watershed.generated_watershed_id = store_generated_watershed(
+                db, user, cached_watershed)
+        return cached_watershed
+
+    # warnings added from here on come from the delineation and are cached with it.
+    request_warning_count = len(warnings)
+
     watershed_point = None
     watershed = None
 
     # declare some variables that will be used for watershed metadata.
     dem_error = None
-    is_near_border = bool(len(watershed_touches_border(db, watershed_id)))
+
+    # the fundamental watersheds upstream of watershed_id are looked up once and
+    # shared by the border check and the delineation methods below.
+    upstream = UpstreamWatershedSet(db, watershed_id)
+    is_near_border = bool(len(upstream.border_crossings()))
 
     # the location of point after correcting/snapping to a stream.
     # This means either snapping to a vector FWA stream or using a SnapPourPoint
@@ -575,7 +674,8 @@ def calculate_watershed(
         # estimate the watershed using the DEM
         (watershed, snapped_point, dem_error) = get_watershed_using_dem(
             db, point_on_stream, stream_feature_id, watershed_id,
-            dem_source=dem_source, use_fwa=upstream_method == 'DEM+FWA')
+            dem_source=dem_source, use_fwa=upstream_method == 'DEM+FWA', upstream=upstream,
+            progress=report_progress)
         watershed_source = "Estimated using CDEM and WhiteboxTools."
         generated_method = 'generated_dem'
         watershed_point = base64.urlsafe_b64encode(
@@ -605,7 +705,7 @@ def calculate_watershed(
             generated_method = 'generated_dem_fwa'
 
     elif upstream_method == 'FWA+UPSTREAM':
-        watershed = get_upstream_catchment_area(db, watershed_id)
+        watershed = get_upstream_catchment_area(db, watershed_id, upstream=upstream)
         watershed_source = "Estimated by combining Freshwater Atlas watershed polygons that are " + \
             "determined to be part of the selected stream based on FWA_WATERSHED_CODE and upstream " + \
             "of the selected point based on LOCAL_WATERSHED_CODE. Note: the watershed polygon " + \
@@ -662,8 +762,14 @@ def calculate_watershed(
         processing_time=elapsed,
         dem_error=dem_error)
 
-    watershed_resp.generated_watershed_id = store_generated_watershed(
-        db, user, watershed_resp)
+    if watershed:
+        store_shared_cached_watershed(
+            db, cache_key, data_version,
+            watershed_resp.copy(update={"warnings": warnings[request_warning_count:]}))
+
+    if store:
+        watershed_resp.generated_watershed_id = store_generated_watershed(
+            db, user, watershed_resp)
 
     return watershed_resp
 
@@ -872,52 +978,97 @@ def store_generated_watershed(db: Session, user, watershed: GeneratedWatershedDe
     return generated_watershed_id
 
 
-def get_watershed_at_inferred_hydat_location(
-    db: Session,
-    user,
-    hydat_station_number: str,
-    expected_drainage_area: float,
-    upstream_method='DEM+FWA'
-):
+class DelineationCancelled(Exception):
+    """ raised by calculate_watershed when its `cancel` event is set """
 
-    stream_segments = get_nearest_hydat_stream_segments(db, hydat_station_number)
 
-    closest_result = None
-    closest_result_vs_expected = None
-
-    if expected_drainage_area > 1000:
-        upstream_method = 'FWA+UPSTREAM'
+# the difference from the listed HYDAT drainage area (as a fraction of the listed area)
+# that is accepted as a match.
+HYDAT_AREA_TOLERANCE = 0.10
 
-    for stream in stream_segments:
-        logger.info("trying from stream at %s", stream.stream_point.wkt)
-        watershed = calculate_watershed(
-            db, user, click_point=stream.stream_point, upstream_method=upstream_method
-        )
 
-        # check if this stream's watershed result is close to the expected drainage area,
-        # if so, stop now and return it.
-        ws_area = watershed.watershed.properties['FEATURE_AREA_SQM'] / 1e6
-        ws_area_vs_expected = abs(ws_area - expected_drainage_area) / expected_drainage_area
-        logger.info("stream at %s was %s off from expected drainage area",
-                    stream.stream_point.wkt, ws_area_vs_expected)
-        if ws_area_vs_expected < 0.10:
-            return watershed
+def _delineate_candidate(user, candidate: dict, cancel: threading.Event) -> GeneratedWatershedDetails:
+    # each candidate runs in its own thread, so it needs its own database session.
+    db = SessionLocal()
+    try:
+        return calculate_watershed(db, user, store=False, cancel=cancel, **candidate)
+    finally:
+        db.close()
 
-        # first iteration - our first result is automatically the closest.
-        if not closest_result:
-            closest_result = watershed
-            closest_result_vs_expected = ws_area_vs_expected
 
-        # otherwise, check for a new closest result
-        elif ws_area_vs_expected < closest_result_vs_expected:
-            closest_result = watershed
-            closest_result_vs_expected = ws_area_vs_expected
+def delineate_candidates(
+    user,
+    candidates: List[dict],
+    expected_drainage_area: float,
+    tolerance: float = HYDAT_AREA_TOLERANCE
+) -> Tuple[Optional[GeneratedWatershedDetails], float, Optional[int]]:
+    """
+    runs calculate_watershed for each candidate (a dict of keyword arguments) in parallel.
+    `candidates` are in order of preference: the first candidate whose area is within
+    `tolerance` of `expected_drainage_area` (km2) is chosen, even if a later one finishes first.
+    Once a candidate is within the tolerance, the candidates after it are cancelled, and the
+    result is returned as soon as every candidate before it has finished.
+
+    Returns a tuple containing the chosen candidate (or the closest candidate, if none are
+    within the tolerance), its difference from the expected area, and its index in `candidates`.
+    Results are not stored; store the returned watershed with store_generated_watershed.
+    """
+    cancel = [threading.Event() for _ in candidates]
+    executor = ThreadPoolExecutor(max_workers=max(min(WATERSHED_CANDIDATE_WORKERS, len(candidates)), 1))
+    futures = {
+        executor.submit(_delineate_candidate, user, candidate, cancel[i]): i
+        for i, candidate in enumerate(candidates)
+    }
 
-    # nothing was within the threshold, but we'll return the closest match.
-    # it can be manually checked.
-    logger.info("No result met threshold (10%%), best result was %s (%s)",
-                closest_result_vs_expected, closest_result.watershed.properties['FEATURE_AREA_SQM'])
-    return closest_result
+    # the watershed and its difference from the expected area, of each finished candidate
+    # (None for candidates that failed or were cancelled).
+    finished = {}
+    chosen = None
+    try:
+        for future in as_completed(futures):
+            index = futures[future]
+            finished[index] = None
+            try:
+                watershed = future.result()
+            except (DelineationCancelled, CancelledError):
+                continue
+            except Exception:
+                logger.exception("candidate watershed %s failed", candidates[index])
+                continue
+
+            if watershed:
+                ws_area = watershed.watershed.properties['FEATURE_AREA_SQM'] / 1e6
+                ws_area_vs_expected = abs(ws_area - expected_drainage_area) / expected_drainage_area
+                logger.info("candidate %s was %s off from expected drainage area",
+                            candidates[index], round(ws_area_vs_expected, 3))
+                finished[index] = (watershed, ws_area_vs_expected)
+
+                if ws_area_vs_expected < tolerance and (chosen is None or index < chosen):
+                    chosen = index
+                    # the candidates after this one can't be chosen any more.
+                    for later_future, later in futures.items():
+                        if later > chosen:
+                            cancel[later].set()
+                            later_future.cancel()
+
+            if chosen is not None and all(i in finished for i in range(chosen)):
+                break
+    finally:
+        # stop the remaining candidates at their next stage, and drop any that haven't started.
+        for event in cancel:
+            event.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    if chosen is not None:
+        return (*finished[chosen], chosen)
+
+    results = [(result[1], index, result[0]) for index, result in finished.items() if result]
+    if not results:
+        return None, 1, None
+    ws_area_vs_expected, index, watershed = min(results, key=lambda result: result[:2])
+    return watershed, ws_area_vs_expected, index
 
 
 def get_watershed_at_hydat_station(
@@ -932,10 +1083,11 @@ def get_watershed_at_hydat_station(
     in an ambiguous location (marked at the confluence of two streams, while only
     monitoring one).
 
-    We first try to see if we can get a result that matches the listed drainage area
-    (from the hydat.stations table) using the HYDAT coordinates.
-    If that doesn't work, we'll inspect the station name and see if we can correct
-    the coordinates onto a stream with the same name as the station.
+    If the station has a listed drainage area, several candidate watersheds are delineated
+    in parallel: from the HYDAT coordinates, from the coordinates corrected onto the stream
+    in the station name, and from each of the stream segments nearest the station.  The first
+    candidate within 10% of the listed drainage area is returned and the others are cancelled.
+    If none are within 10%, the closest is returned.  Only the returned watershed is stored.
     """
 
     # default upstream method
@@ -975,82 +1127,40 @@ def get_watershed_at_hydat_station(
             db, user, hydat_station_number=stn.station_number, upstream_method=upstream_method
         )
 
-    # if we do have a drainage area to compare to, start with the regular method of delineating
-    # from coordinates. For most HYDAT stations, the coordinates are enough to draw the watershed.
-    watershed = calculate_watershed(
-        db, user, click_point=stn.geom, upstream_method=upstream_method
-    )
+    # The candidates, in order of preference:
+    # the HYDAT coordinates. For most HYDAT stations, the coordinates are enough to draw the watershed.
+    # the coordinates corrected to the stream nearest the HYDAT station, with an attempt to match
+    # the stream name from the station name.
+    # each of the stream segments nearest the station. This infers the location of stations where the
+    # coordinates don't line up with the stream that the station is actually monitoring (or are at an
+    # ambiguous confluence where it's not clear which tributary is being monitored).
+    inferred_upstream_method = 'FWA+UPSTREAM' if stn.drainage_area_gross > 1000 else 'DEM+FWA'
+    candidate_names = ["watershed", "hydat_corrected_watershed"]
+    candidates = [
+        dict(click_point=stn.geom, upstream_method=upstream_method),
+        dict(hydat_station_number=stn.station_number, upstream_method=upstream_method)
+    ]
+    for stream in get_nearest_hydat_stream_segments(db, stn.station_number):
+        candidate_names.append("inferred_watershed")
+        candidates.append(dict(click_point=stream.stream_point, upstream_method=inferred_upstream_method))
+
+    (watershed, ws_area_vs_expected, index) = delineate_candidates(user, candidates, stn.drainage_area_gross)
+
+    if not watershed:
+        logger.warning('Hydat station %s - unable to delineate a watershed', stn.station_number)
+        return None
 
-    # If an area is listed on the HYDAT station, we'll use it to make sure the difference
-    # between our delineated watershed and the listed area is within reason.  The most common
-    # reason it wouldn't be is if the HYDAT coordinates don't line up with the stream that
-    # the station is actually monitoring (or is at an ambiguous confluence where it's not
-    # clear from the coordinates which tributary is being monitored).
     ws_area = watershed.watershed.properties['FEATURE_AREA_SQM'] / 1e6
-    ws_area_vs_expected = abs(ws_area - stn.drainage_area_gross) / stn.drainage_area_gross
-
-    if ws_area_vs_expected < 0.10:
-        logger.info('Success: HYDAT watershed within 10%% of listed area. (%s vs %s: off by %s from listed area)',
-                    round(ws_area, 1), round(stn.drainage_area_gross, 1), round(ws_area_vs_expected, 3))
-        return watershed
-
-    # if the result is more than +/- 10% of the listed area, try again using the HYDAT station
-    # as input.  calculate_watershed with the HYDAT station parameter corrects the coordinates
-    # to the stream nearest the HYDAT station, with an attempt to match the stream name from
-    # the station name.
-    logger.info("Drainage area %s doesn't agree with listed area %s (off by %s of listed area)",
-                round(ws_area, 1), round(stn.drainage_area_gross, 1), round(ws_area_vs_expected, 3))
-    hydat_corrected_watershed = calculate_watershed(
-        db, user, hydat_station_number=stn.station_number, upstream_method=upstream_method
-    )
-
-    hy_area = hydat_corrected_watershed.watershed.properties['FEATURE_AREA_SQM'] / 1e6
-    hy_area_vs_expected = abs(hy_area - stn.drainage_area_gross) / stn.drainage_area_gross
-
-    # compare the result after trying to correct for the Hydat station name.
-    # If we managed to get closer to the listed area, return the corrected result.
-    if hy_area_vs_expected < 0.10:
-        logger.info("Using corrected result for station %s - %s (new area %s km2 is off by %s from listed area)",
-                    stn.station_number, stn.station_name, round(hy_area, 1), round(hy_area_vs_expected, 3))
-        return hydat_corrected_watershed
-
-    logger.warn(
-        "Warning: Corrected result doesn't agree with listed area (off by %s from listed area).",
-        round(hy_area_vs_expected, 3))
-
-    logger.warn('Trying to infer the correct location by delineating from multiple nearby streams.')
-
-    inferred_watershed = get_watershed_at_inferred_hydat_location(
-        db, user, stn.station_number, stn.drainage_area_gross)
-
-    if not inferred_watershed:
-        inferred_area_vs_expected = 1
+    if ws_area_vs_expected < HYDAT_AREA_TOLERANCE:
+        logger.info('Success: HYDAT watershed (%s) within 10%% of listed area. (%s vs %s: off by %s from listed area)',
+                    candidate_names[index], round(ws_area, 1), round(stn.drainage_area_gross, 1),
+                    round(ws_area_vs_expected, 3))
     else:
-        inferred_watershed_area = inferred_watershed.watershed.properties['FEATURE_AREA_SQM'] / 1e6
-        inferred_area_vs_expected = abs(inferred_watershed_area - stn.drainage_area_gross) / stn.drainage_area_gross
-
-    if inferred_watershed and inferred_area_vs_expected < 0.10:
-        logger.info('Found a suitable HYDAT watershed by inferring the most likely HYDAT location based on expected drainage area.')
-        logger.info(
-            'Original estimate was %s different from the expected area, inferred estimate is %s different',
-            ws_area_vs_expected, inferred_area_vs_expected)
-        return inferred_watershed
-
-    # we couldn't get a good result.  Return the best one, it can be manually checked/QA'd.
-    result_vs_expected = {
-        "watershed": ws_area_vs_expected,
-        "hydat_corrected_watershed": hy_area_vs_expected,
-        "inferred_watershed": inferred_area_vs_expected
-    }
-    result_map = {
-        "watershed": watershed,
-        "hydat_corrected_watershed": hydat_corrected_watershed,
-        "inferred_watershed": inferred_watershed
-    }
+        # we couldn't get a good result.  Return the best one, it can be manually checked/QA'd.
+        logger.info("best result for HYDAT station was %s. (%s)", candidate_names[index], ws_area_vs_expected)
 
-    best_result = min(result_vs_expected, key=result_vs_expected.get)
-    logger.info("best result for HYDAT station was %s. (%s)", best_result, result_vs_expected.get(best_result))
-    return result_map.get(best_result)
+    watershed.generated_watershed_id = store_generated_watershed(db, user, watershed)
+    return watershed
 
 
 def get_watershed(
@@ -1480,12 +1590,35 @@ def get_scsb2016_input_stats(db: Session):
     return stats
 
 
-def get_watershed_details(db: Session, watershed: Feature, use_sea: bool = True):
-    """ returns watershed inputs variables used in modelling """
+def climate_value(key: str, read: Callable) -> Callable:
+    """
+    returns a task function for get_watershed_details that uses `key` from the climate stack
+    means (the `climate` task), or calls `read` if the stack didn't have a value.
+    """
+    def task(climate, **kwargs):
+        value = climate.get(key)
+        return value if value is not None else read(**kwargs)
+    return task
+
+
+def get_watershed_details(db: Session, watershed: Feature, use_sea: bool = True, fwa_watershed_id: int = None):
+    """ returns watershed inputs variables used in modelling
+
+    The inputs are independent of each other, so they are gathered concurrently
+    (see api.utils.task_graph). An input that fails or times out is None.
+
+    If the watershed is made of FWA fundamental watersheds (`fwa_watershed_id` is the
+    starting fundamental watershed), the climate, terrain and glacier inputs are summed
+    from fwa_watershed_attributes instead of reading the rasters (see fwa_attributes.py).
+
+    Climate and hillshade rasters are read from an overview for large watersheds (see
+    select_overview).  `raster_resolution` has the cell size (metres) each was read at.
+    """
 
     if WATERSHED_DEBUG:
         logger.info("getting watershed details")
 
+    start = time.perf_counter()
     watershed_poly = shape(watershed.geometry)
     watershed_area = transform(transform_4326_3005, watershed_poly).area
 
@@ -1494,11 +1627,6 @@ def get_watershed_details(db: Session, watershed: Feature, use_sea: bool = True)
 
     # watershed characteristics lookups
     drainage_area = watershed_area / 1e6  # needs to be in km²
-    glacial_area_m, glacial_coverage = calculate_glacial_area(
-        db, watershed_poly)
-
-    if WATERSHED_DEBUG:
-        logger.info("glacial coverage %s", glacial_coverage)
 
     # climate raster pixels (precip, evapotranspiration...) are 1 square km.
     # if our watershed is on the small size, we might not get a pixel if
@@ -1509,39 +1637,92 @@ def get_watershed_details(db: Session, watershed: Feature, use_sea: bool = True)
     if watershed_area < 20e6:
         retry_min_size = max(2e6, watershed_area)
 
-    # precipitation values from prism raster
-    annual_precipitation = get_mean_annual_precipitation(watershed_poly, retry_min_size=retry_min_size)
-
-    if WATERSHED_DEBUG:
-        logger.info("annual precipitation %s", annual_precipitation)
+    # sums of the precomputed fundamental watershed attributes, if this watershed is made of them.
+    fwa_stats = None
+    try:
+        fwa_stats = get_fwa_watershed_stats(db, watershed.id, watershed_poly, watershed_area, fwa_watershed_id)
+    except Exception as e:
+        logger.warning('unable to summarize %s from fwa_watershed_attributes: %s', watershed.id, repr(e))
+        db.rollback()
 
-    # temperature and potential evapotranspiration values
+    # the cell size (metres) that each raster input was read at
+    raster_resolution = {}
 
-    potential_evapotranspiration = get_potential_evapotranspiration(
-        watershed_poly, retry_min_size=retry_min_size)
+    def overview_level(file_name: str, *keys: str) -> Optional[int]:
+        """ picks the overview of `file_name` to read for this watershed, and records its resolution """
+        level, cell_size = select_overview(file_name, watershed_poly, watershed_area)
+        for key in keys:
+            raster_resolution[key] = round(cell_size)
+        return level
 
-    if WATERSHED_DEBUG:
-        logger.info("potential evapotranspiration %s", potential_evapotranspiration)
+    graph = TaskGraph()
 
     # hydro zone dictates which model values to use
-    hydrological_zone = get_hydrological_zone(watershed_poly.centroid)
-
-    area_cdem = CDEM(watershed_poly)
-
-    elev_stats = area_cdem.get_raster_summary_stats()
-    median_elev = area_cdem.get_median_elevation()
-    slope_percent = area_cdem.get_average_slope()
-
+    graph.add('hydrological_zone', get_hydrological_zone, args=(watershed_poly.centroid,),
+              timeout=WFS_TASK_TIMEOUT)
+
+    if not fwa_stats:
+        graph.add('glacial', lambda db: calculate_glacial_area(db, watershed_poly),
+                  db=True, timeout=WFS_TASK_TIMEOUT, default=(None, None))
+
+        # precipitation, potential evapotranspiration and hillshade come from one read of the
+        # multi-band climate stack.  Each falls back to reading its own raster if the stack
+        # couldn't be read or has no value for the watershed.  The stack read and the fallbacks
+        # share one time budget, so a slow stack read doesn't add a second full timeout.
+        raster_deadline = time.monotonic() + RASTER_TASK_TIMEOUT
+
+        graph.add('climate', lambda: get_climate_means(
+            watershed_poly, retry_min_size=retry_min_size, overview_level=overview_level(
+                f"/vsis3/{CLIMATE_STACK_RASTER}", 'annual_precipitation', 'potential_evapotranspiration',
+                'solar_exposure')), deadline=raster_deadline, default={})
+
+        # precipitation values from prism raster
+        graph.add('annual_precipitation', climate_value('annual_precipitation', lambda: get_mean_annual_precipitation(
+            watershed_poly, retry_min_size=retry_min_size, overview_level=overview_level(
+                f"/vsis3/{PRECIP_RASTER}", 'annual_precipitation'))), deps=['climate'], deadline=raster_deadline)
+
+        # temperature and potential evapotranspiration values
+        graph.add('potential_evapotranspiration', climate_value('potential_evapotranspiration',
+                  lambda: get_potential_evapotranspiration(
+                      watershed_poly, retry_min_size=retry_min_size, overview_level=overview_level(
+                          f"/vsis3/{PET_RASTER}", 'potential_evapotranspiration'))),
+                  deps=['climate'], deadline=raster_deadline)
+
+        # elevation stats, median elevation and slope all come from one read of the CDEM.
+        graph.add('terrain', lambda db: CDEM(watershed_poly, db=db).get_terrain_stats(),
+                  db=True, timeout=DB_TASK_TIMEOUT, default={})
+
+        def read_solar_exposure():
+            # only opens a session if the climate stack didn't have the hillshade value.
+            with task_session() as db:
+                return CDEM(watershed_poly, db=db).get_mean_hillshade(
+                    retry_min_size=retry_min_size,
+                    overview_level=overview_level(f"/vsis3/{HILLSHADE_RASTER}", 'solar_exposure'))
+
+        graph.add('solar_exposure', climate_value('solar_exposure', read_solar_exposure),
+                  deps=['climate'], deadline=raster_deadline)
+
+    results = graph.run()
+
+    if fwa_stats:
+        results['glacial'] = (fwa_stats['glacial_area'], fwa_stats['glacial_coverage'])
+        results['terrain'] = fwa_stats
+        for key in ('annual_precipitation', 'potential_evapotranspiration', 'solar_exposure'):
+            results[key] = fwa_stats[key]
+
+    glacial_area_m, glacial_coverage = results['glacial']
+    terrain = results['terrain']
     aspect = None
 
-    # todo: retry at min size
-    solar_exposure = area_cdem.get_mean_hillshade(retry_min_size=retry_min_size)
-
     if WATERSHED_DEBUG:
-        logger.info("elevation stats %s", elev_stats)
-        logger.info("median elevation %s", median_elev)
-        logger.info("average slope %s", slope_percent)
-        logger.info("solar exposure %s", solar_exposure)
+        logger.info("glacial coverage %s", glacial_coverage)
+        logger.info("annual precipitation %s", results['annual_precipitation'])
+        logger.info("potential evapotranspiration %s", results['potential_evapotranspiration'])
+        logger.info("elevation stats %s", terrain.get('elevation_stats'))
+        logger.info("median elevation %s", terrain.get('median_elevation'))
+        logger.info("average slope %s", terrain.get('average_slope'))
+        logger.info("solar exposure %s", results['solar_exposure'])
+        logger.info("watershed details took %s", time.perf_counter() - start)
 
     data = {
         "watershed_id": watershed.id,
@@ -1549,14 +1730,16 @@ def get_watershed_details(db: Session, watershed: Feature, use_sea: bool = True)
         "drainage_area": drainage_area,
         "glacial_area": glacial_area_m,
         "glacial_coverage": glacial_coverage,
-        "annual_precipitation": annual_precipitation,
-        "potential_evapotranspiration": potential_evapotranspiration,
-        "hydrological_zone": hydrological_zone,
-        "average_slope": slope_percent,
-        "solar_exposure": solar_exposure,
-        "median_elevation": median_elev,
-        "elevation_stats": elev_stats,
-        "aspect": aspect
+        "annual_precipitation": results['annual_precipitation'],
+        "potential_evapotranspiration": results['potential_evapotranspiration'],
+        "hydrological_zone": results['hydrological_zone'],
+        "average_slope": terrain.get('average_slope'),
+        "solar_exposure": results['solar_exposure'],
+        "median_elevation": terrain.get('median_elevation'),
+        # {count, sum, mean, stddev, min, max}, the fields of ST_SummaryStats
+        "elevation_stats": terrain.get('elevation_stats'),
+        "aspect": aspect,
+        "raster_resolution": raster_resolution
     }
 
     return data
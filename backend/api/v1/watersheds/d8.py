@@ -0,0 +1,265 @@
+"""
+In-process D8 flow routing for delineating watersheds from a DEM.
+
+These functions work on NumPy arrays (e.g. a DEM clipped to a working area
+with gdal.Warp) and replace the WhiteboxTools steps used by the DEM delineation:
+
+    BreachDepressions / FillDepressions  ->  fill_depressions
+    D8Pointer                            ->  d8_pointer
+    D8FlowAccumulation                   ->  d8_flow_accumulation
+    SnapPourPoints                       ->  snap_pour_point
+    Watershed                            ->  watershed_mask
+
+Flow directions are stored as an index into D8_OFFSETS (0 to 7), with
+NO_FLOW (-1) for cells that don't drain to a neighbour (outlets and nodata).
+
+Depression filling is the only step that can't be vectorized. If numba is
+installed it is compiled, otherwise it runs as plain Python.
+"""
+import heapq
+import math
+import logging
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # pragma: no cover
+    njit = None
+
+logger = logging.getLogger('WATERSHEDS')
+
+NO_FLOW = -1
+
+# (row, col) offsets for the 8 neighbours of a cell, clockwise from north-east.
+D8_OFFSETS = (
+    (-1, 1), (0, 1), (1, 1), (1, 0),
+    (1, -1), (0, -1), (-1, -1), (-1, 0),
+)
+
+# WhiteboxTools D8Pointer values (non-ESRI), in the same order as D8_OFFSETS.
+WBT_POINTER_VALUES = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# metres per degree of latitude, used to get cell distances for geographic (EPSG:4326) rasters.
+METRES_PER_DEGREE = 111320.0
+
+
+def _priority_flood(z, valid, seeds, ncols, epsilon, closed, pit):
+    """
+    Priority-Flood+Epsilon (Barnes, Lehman & Mulla, 2014).  Raises every cell that
+    can't drain to the edge of the raster so that it drains to a neighbour that is
+    `epsilon` lower.  `z` is modified in place.
+
+    Written so that it can be compiled with numba, but also runs with plain Python
+    lists.  `closed` (all False) and `pit` are work buffers the same length as `z`.
+    The pit queue receives every cell at most once, so a flat buffer works as a FIFO.
+    """
+    n = len(z)
+    pit_head = 0
+    pit_tail = 0
+
+    heap = [(z[seeds[0]], seeds[0])]
+    closed[seeds[0]] = True
+    for i in range(1, len(seeds)):
+        heap.append((z[seeds[i]], seeds[i]))
+        closed[seeds[i]] = True
+    heapq.heapify(heap)
+
+    while len(heap) > 0 or pit_head < pit_tail:
+        if pit_head < pit_tail:
+            c = pit[pit_head]
+            pit_head += 1
+        else:
+            c = heapq.heappop(heap)[1]
+
+        row = c // ncols
+        col = c - row * ncols
+        spill = z[c] + epsilon
+
+        for dr in range(-1, 2):
+            r = row + dr
+            if r < 0 or r * ncols >= n:
+                continue
+            for dc in range(-1, 2):
+                k = col + dc
+                if (dr == 0 and dc == 0) or k < 0 or k >= ncols:
+                    continue
+                nb = r * ncols + k
+                if closed[nb] or not valid[nb]:
+                    continue
+                closed[nb] = True
+                if z[nb] <= spill:
+                    z[nb] = spill
+                    pit[pit_tail] = nb
+                    pit_tail += 1
+                else:
+                    heapq.heappush(heap, (z[nb], nb))
+    return z
+
+
+if njit:
+    _priority_flood_compiled = njit(cache=True)(_priority_flood)
+
+
+def fill_depressions(dem: np.ndarray, valid: np.ndarray, epsilon: float = 1e-5) -> np.ndarray:
+    """
+    Returns a copy of `dem` (as float64) with depressions filled so that every valid cell
+    has a downslope path to the edge of the valid area.  `valid` is a boolean mask of
+    cells with data.  Flats are given a small gradient (`epsilon` per cell) towards their
+    outlet so that d8_pointer can route flow across them.
+    """
+    nrows, ncols = dem.shape
+    z = dem.astype(np.float64)
+    valid = valid.astype(np.bool_)
+
+    # seeds: valid cells on the edge of the raster or next to a nodata cell.
+    padded = np.pad(valid, 1, mode='constant', constant_values=False)
+    interior = np.ones_like(valid)
+    for dr, dc in D8_OFFSETS:
+        interior &= padded[1 + dr:1 + dr + nrows, 1 + dc:1 + dc + ncols]
+    seeds = np.flatnonzero(valid & ~interior)
+
+    if not len(seeds):
+        return z
+
+    if njit:
+        filled = _priority_flood_compiled(
+            z.ravel(), valid.ravel(), seeds.astype(np.int64), ncols, epsilon,
+            np.zeros(z.size, dtype=np.bool_), np.zeros(z.size, dtype=np.int64))
+        return filled.reshape(nrows, ncols)
+
+    filled = _priority_flood(
+        z.ravel().tolist(), valid.ravel().tolist(), seeds.tolist(), ncols, epsilon,
+        [False] * z.size, [0] * z.size)
+    return np.array(filled, dtype=np.float64).reshape(nrows, ncols)
+
+
+def cell_distances(cell_size_x: float, cell_size_y: float, geographic: bool = False, latitude: float = 0.0):
+    """
+    Returns the distance to each of the 8 neighbours (in the order of D8_OFFSETS).
+    Geographic cell sizes (degrees) are converted to metres at `latitude`.
+    """
+    dx = abs(cell_size_x)
+    dy = abs(cell_size_y)
+    if geographic:
+        dx = dx * METRES_PER_DEGREE * math.cos(math.radians(latitude))
+        dy = dy * METRES_PER_DEGREE
+    diag = math.sqrt(dx ** 2 + dy ** 2)
+    return np.array([diag if dr and dc else (dx if dc else dy) for dr, dc in D8_OFFSETS])
+
+
+def d8_pointer(filled: np.ndarray, valid: np.ndarray, distances: np.ndarray) -> np.ndarray:
+    """
+    Returns the D8 flow direction (an index into D8_OFFSETS) of each cell: the neighbour with
+    the steepest downslope gradient.  Cells with no lower neighbour, or no data, are NO_FLOW.
+    """
+    nrows, ncols = filled.shape
+    z = np.where(valid, filled, np.inf)
+    padded = np.pad(z, 1, mode='constant', constant_values=np.inf)
+
+    slopes = np.empty((8, nrows, ncols))
+    with np.errstate(invalid='ignore'):
+        for i, (dr, dc) in enumerate(D8_OFFSETS):
+            neighbour = padded[1 + dr:1 + dr + nrows, 1 + dc:1 + dc + ncols]
+            slopes[i] = (z - neighbour) / distances[i]
+
+    # neighbours without data have an elevation of +inf and therefore a slope of -inf
+    # (or NaN, for cells without data).
+    slopes[np.isnan(slopes)] = -np.inf
+    direction = np.argmax(slopes, axis=0).astype(np.int8)
+    steepest = np.take_along_axis(slopes, direction[np.newaxis].astype(np.intp), axis=0)[0]
+    direction[~(steepest > 0) | ~valid] = NO_FLOW
+    return direction
+
+
+def from_wbt_pointer(pointer: np.ndarray) -> np.ndarray:
+    """ converts a WhiteboxTools D8Pointer raster (1, 2, 4 ... 128) to D8_OFFSETS indices """
+    direction = np.full(pointer.shape, NO_FLOW, dtype=np.int8)
+    for i, value in enumerate(WBT_POINTER_VALUES):
+        direction[pointer == value] = i
+    return direction
+
+
+def receivers(direction: np.ndarray) -> np.ndarray:
+    """
+    Returns the flat index of the downstream cell of each cell, or -1 for cells
+    that don't drain to another cell in the grid.
+    """
+    nrows, ncols = direction.shape
+    rows, cols = np.indices(direction.shape)
+    flows = direction >= 0
+    offsets = np.array(D8_OFFSETS)
+    d = np.where(flows, direction, 0)
+    to_rows = rows + offsets[d, 0]
+    to_cols = cols + offsets[d, 1]
+    inside = flows & (to_rows >= 0) & (to_rows < nrows) & (to_cols >= 0) & (to_cols < ncols)
+    return np.where(inside, to_rows * ncols + to_cols, -1).ravel()
+
+
+def d8_flow_accumulation(direction: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """
+    Returns the number of cells (including itself) that drain through each cell.
+    Cells are processed in waves, starting from cells that have no upstream cells,
+    so each wave is a vectorized step.
+    """
+    to = receivers(direction)
+    n = to.size
+    accumulation = valid.ravel().astype(np.float64)
+
+    flows = to >= 0
+    in_degree = np.bincount(to[flows], minlength=n)
+    frontier = np.flatnonzero((in_degree == 0) & flows)
+
+    while frontier.size:
+        downstream = to[frontier]
+        np.add.at(accumulation, downstream, accumulation[frontier])
+        np.subtract.at(in_degree, downstream, 1)
+        downstream = np.unique(downstream)
+        frontier = downstream[(in_degree[downstream] == 0) & (to[downstream] >= 0)]
+
+    return accumulation.reshape(direction.shape)
+
+
+def snap_pour_point(accumulation: np.ndarray, row: int, col: int, snap_distance_cells: int):
+    """
+    Moves the pour point at (row, col) to the cell with the highest flow accumulation
+    within `snap_distance_cells` cells (a square window).  Returns the new (row, col).
+    """
+    nrows, ncols = accumulation.shape
+    r0 = max(row - snap_distance_cells, 0)
+    r1 = min(row + snap_distance_cells + 1, nrows)
+    c0 = max(col - snap_distance_cells, 0)
+    c1 = min(col + snap_distance_cells + 1, ncols)
+
+    window = accumulation[r0:r1, c0:c1]
+    best = np.unravel_index(np.argmax(window), window.shape)
+    return (r0 + int(best[0]), c0 + int(best[1]))
+
+
+def watershed_mask(direction: np.ndarray, row: int, col: int) -> np.ndarray:
+    """
+    Returns a boolean mask of the cells that drain to the pour point at (row, col).
+    Walks upstream with a breadth first search over a donor index (cells grouped
+    by their receiver), one vectorized step per level.
+    """
+    to = receivers(direction)
+    donors = np.flatnonzero(to >= 0)
+    order = donors[np.argsort(to[donors], kind='stable')]
+    counts = np.bincount(to[donors], minlength=to.size)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    mask = np.zeros(to.size, dtype=np.bool_)
+    frontier = np.array([row * direction.shape[1] + col])
+    mask[frontier] = True
+
+    while frontier.size:
+        lengths = counts[frontier]
+        total = lengths.sum()
+        if not total:
+            break
+        # gather the donors of every cell in the frontier in one step.
+        offsets = np.repeat(starts[frontier] - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        frontier = order[offsets]
+        frontier = frontier[~mask[frontier]]
+        mask[frontier] = True
+
+    return mask.reshape(direction.shape)
@@ -1,8 +1,9 @@
 import geoalchemy2
-from sqlalchemy import String, Column, DateTime, ARRAY, TEXT, Integer, ForeignKey, Boolean, Numeric
+from sqlalchemy import String, Column, DateTime, ARRAY, TEXT, Integer, ForeignKey, Boolean, Numeric, Float
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import UUID, JSONB
+from sqlalchemy_utils import LtreeType
 from api.db.base_class import BaseTable, BaseAudit
 from api.v1.user.db_models import User
 import uuid
@@ -81,3 +82,80 @@ class StreamBurnedCDEMTile(BaseTable):
     filename = Column(TEXT, comment="An s3 filename reference. Do not include bucket name.", nullable=False)
     geom = Column(geoalchemy2.types.Geometry(
         geometry_type='MULTIPOLYGON', srid=4326, spatial_index=True))
+
+
+class FWAWatershedCodeDissolved(BaseTable):
+    """ Pre-dissolved geometry of complete Freshwater Atlas tributary sub-basins
+        (every fundamental watershed with a watershed code under wscode_ltree).
+        Only sub-basins with many polygons are stored.  Upstream catchments are assembled from
+        these pieces plus the remaining polygons instead of unioning every upstream polygon.
+        Rebuilt by the refresh_fwa_watershed_code_dissolved() database function.
+    """
+    __tablename__ = 'fwa_watershed_code_dissolved'
+    __table_args__ = {'schema': 'public'}
+
+    wscode_ltree = Column(LtreeType, primary_key=True)
+    polygon_count = Column(Integer, nullable=False)
+    area_sqm = Column(Float, nullable=False)
+    geom = Column(geoalchemy2.types.Geometry(
+        geometry_type='MULTIPOLYGON', srid=4326), nullable=False)
+
+
+class DelineatedWatershedCache(BaseTable):
+    """ Delineated watersheds shared between users and sessions, keyed by the inputs to the
+        delineation (see api/v1/watersheds/cache.py).
+    """
+    __tablename__ = 'delineated_watershed_cache'
+    __table_args__ = {'schema': 'public'}
+
+    cache_key = Column(TEXT, primary_key=True)
+    upstream_method = Column(String)
+    dem_source = Column(String, nullable=True)
+    fwa_watershed_id = Column(Integer, nullable=True)
+    data_version = Column(TEXT, nullable=False)
+    watershed = Column(JSONB, nullable=False)
+    hit_count = Column(Integer, nullable=False, server_default='0')
+    create_date = Column(DateTime(timezone=True), nullable=False)
+    last_accessed_date = Column(DateTime(timezone=True), nullable=False)
+
+
+class WatershedDelineationJob(BaseTable):
+    """ Watershed delineations running in the background (see api/v1/watersheds/jobs.py).
+        The result is stored as a GeneratedWatershed (and in the watershed_cache).
+    """
+    __tablename__ = 'watershed_delineation_job'
+    __table_args__ = {'schema': 'public'}
+
+    job_id = Column(UUID(), primary_key=True)
+    create_user = Column(UUID(), nullable=True)
+    status = Column(String, nullable=False, comment='queued, running, complete or failed.')
+    stage = Column(String, nullable=True)
+    request = Column(JSONB, nullable=False)
+    generated_watershed_id = Column(
+        Integer, ForeignKey(GeneratedWatershed.generated_watershed_id, ondelete='SET NULL'), nullable=True)
+    error = Column(TEXT, nullable=True)
+    create_date = Column(DateTime(timezone=True), nullable=False)
+    update_date = Column(DateTime(timezone=True), nullable=False)
+
+
+class FWAWatershedAttributes(BaseTable):
+    """ Precomputed sums for each Freshwater Atlas fundamental watershed polygon.
+        A watershed made up of fundamental watersheds is summarized by adding these up
+        (see api/v1/watersheds/fwa_attributes.py).
+    """
+    __tablename__ = 'fwa_watershed_attributes'
+    __table_args__ = {'schema': 'public'}
+
+    watershed_feature_id = Column(Integer, primary_key=True)
+    area_sqm = Column(Float, nullable=False)
+    precip_sum = Column(Float, nullable=False)
+    precip_count = Column(Integer, nullable=False)
+    pet_sum = Column(Float, nullable=False)
+    pet_count = Column(Integer, nullable=False)
+    glacier_area_sqm = Column(Float, nullable=False)
+    elevation_histogram = Column(JSONB, nullable=False)
+    slope_sum = Column(Float, nullable=False)
+    slope_count = Column(Integer, nullable=False)
+    hillshade_sum = Column(Float, nullable=False)
+    hillshade_count = Column(Integer, nullable=False)
+    update_date = Column(DateTime(timezone=True), nullable=False)
@@ -2,19 +2,26 @@
 Functions for delineating watersheds
 """
 import logging
+import math
 import fiona
 import time
+import numpy as np
+from functools import lru_cache
 from shapely import wkb
 from utils.whitebox_tools import WhiteboxTools
 from tempfile import TemporaryDirectory
-from typing import Tuple, List
-from osgeo import gdal, ogr
+from typing import Callable, Tuple, List, Optional
+from osgeo import gdal
 from shapely.geometry import Point, Polygon, MultiPolygon, shape, mapping
 from shapely.ops import transform
 from sqlalchemy.orm import Session
-from api.config import WATERSHED_DEBUG, RASTER_FILE_DIR
+from api.config import WATERSHED_DEBUG, RASTER_FILE_DIR, WATERSHED_DELINEATION_ENGINE
 from api.v1.aggregator.helpers import transform_4326_3005, transform_3005_4326
 from api.v1.watersheds import CDEM_FILE, SRTM_FILE
+from api.v1.watersheds import d8
+from api.v1.watersheds.upstream import UpstreamWatershedSet, UPSTREAM_GEOMETRY_QUERY
+from api.utils.raster import clip_raster, polygonize_array, polygonize_file
+from api.utils.raster_cache import cached_raster
 
 
 logging.basicConfig(level=logging.INFO)
@@ -60,6 +67,8 @@ def get_cross_border_catchment_area(db: Session, point: Point):
 def get_full_stream_catchment_area(db, watershed_id):
     """
     returns the catchment of the entire selected stream.
+    Large streams are read already dissolved from fwa_watershed_code_dissolved;
+    the polygons are only unioned here if the stream isn't in that table.
     """
 
     q = """
@@ -70,9 +79,18 @@ def get_full_stream_catchment_area(db, watershed_id):
                 )
 
                 SELECT
-                    ST_AsBinary(ST_Union("GEOMETRY")) as geom
-                FROM    freshwater_atlas_watersheds
-                WHERE   wscode_ltree <@ (select origin_wscode from subwscode_ltree)
+                    ST_AsBinary(coalesce(
+                        (
+                            SELECT  geom
+                            FROM    fwa_watershed_code_dissolved
+                            WHERE   wscode_ltree = (select origin_wscode from subwscode_ltree)
+                        ),
+                        (
+                            SELECT  ST_Union("GEOMETRY")
+                            FROM    freshwater_atlas_watersheds
+                            WHERE   wscode_ltree <@ (select origin_wscode from subwscode_ltree)
+                        )
+                    )) as geom
 
     """
 
@@ -92,7 +110,7 @@ def get_full_stream_catchment_area(db, watershed_id):
 
 
 def get_fwa_polygons_for_dem(db: Session, watershed_feature_id: int, stream_feature_id: int, click_point: Point,
-                             start_polygon_buffer_distance: float = 100):
+                             start_polygon_buffer_distance: float = 100, upstream: UpstreamWatershedSet = None):
     """ returns the union of all FWA watershed polygons upstream from
         the watershed polygon with WATERSHED_FEATURE_ID as a Feature
 
@@ -103,7 +121,7 @@ def get_fwa_polygons_for_dem(db: Session, watershed_feature_id: int, stream_feat
         logger.info(
             "Getting upstream catchment area from database, feature id: %s", watershed_feature_id)
 
-    q = """
+    q = f"""
         with subwscode_ltree as (
             SELECT  "WATERSHED_FEATURE_ID" as origin_id,
                     wscode_ltree as origin_wscode,
@@ -161,15 +179,7 @@ def get_fwa_polygons_for_dem(db: Session, watershed_feature_id: int, stream_feat
             AND (NOT wscode_ltree <@ (select origin_localcode from stream_subwscode_ltree) OR (select origin_wscode from stream_subwscode_ltree) = (select origin_localcode from stream_subwscode_ltree))
         ),
         fwa_polygons_upstream AS (
-            SELECT "GEOMETRY" as geom
-            FROM    freshwater_atlas_watersheds
-            WHERE   wscode_ltree <@ (select origin_wscode from subwscode_ltree)
-            AND     ltree2text(subltree(
-                        localcode_ltree || '000000'::ltree,
-                        (select downstream_tributary_code_pos from subwscode_ltree) - 1,
-                        (select downstream_tributary_code_pos from subwscode_ltree) - 0
-                    ))::integer >= (select downstream_tributary from subwscode_ltree)
-            AND (NOT wscode_ltree <@ (select origin_localcode from subwscode_ltree) OR (select origin_wscode from subwscode_ltree) = (select origin_localcode from subwscode_ltree))
+            {UPSTREAM_GEOMETRY_QUERY}
         ),
         working_area AS (
             SELECT geom FROM fwa_polygons_upstream
@@ -205,10 +215,13 @@ def get_fwa_polygons_for_dem(db: Session, watershed_feature_id: int, stream_feat
             ) as dem_file
     """
 
+    upstream = upstream or UpstreamWatershedSet(db, watershed_feature_id)
+
     res = db.execute(
         q,
         {
             "watershed_feature_id": watershed_feature_id,
+            "ids": upstream.ids,
             "stream_feature_id": stream_feature_id,
             "buffer_distance": start_polygon_buffer_distance,
             "click_point": click_point.wkt
@@ -238,7 +251,7 @@ def get_fwa_polygons_for_dem(db: Session, watershed_feature_id: int, stream_feat
     return (working_area, watershed_mask, dem_file)
 
 
-def get_upstream_catchment_area(db: Session, watershed_feature_id: int):
+def get_upstream_catchment_area(db: Session, watershed_feature_id: int, upstream: UpstreamWatershedSet = None):
     """ returns the union of all FWA watershed polygons upstream from
         the watershed polygon with WATERSHED_FEATURE_ID as a Feature
 
@@ -249,42 +262,11 @@ def get_upstream_catchment_area(db: Session, watershed_feature_id: int):
         logger.info(
             "Getting upstream catchment area from database, feature id: %s", watershed_feature_id)
 
-    q = """
-        with subwscode_ltree as (
-            SELECT  "WATERSHED_FEATURE_ID" as origin_id,
-                    wscode_ltree as origin_wscode,
-                    localcode_ltree as origin_localcode,
-                    ltree2text(subpath(localcode_ltree, -1))::integer as downstream_tributary,
-                    nlevel(localcode_ltree) as downstream_tributary_code_pos
-            FROM    freshwater_atlas_watersheds
-            WHERE   "WATERSHED_FEATURE_ID" = :watershed_feature_id
-        )
-        SELECT
-            ST_AsBinary(ST_Union("GEOMETRY")) as geom
-        FROM    freshwater_atlas_watersheds
-        WHERE   wscode_ltree <@ (select origin_wscode from subwscode_ltree)
-        AND     ltree2text(subltree(
-                    localcode_ltree || '000000'::ltree,
-                    (select downstream_tributary_code_pos from subwscode_ltree) - 1,
-                    (select downstream_tributary_code_pos from subwscode_ltree) - 0
-                ))::integer >= (select downstream_tributary from subwscode_ltree)
-        AND (NOT wscode_ltree <@ (select origin_localcode from subwscode_ltree) OR (select origin_wscode from subwscode_ltree) = (select origin_localcode from subwscode_ltree))
-
-    """
-
-    res = db.execute(q, {"watershed_feature_id": watershed_feature_id})
+    upstream = upstream or UpstreamWatershedSet(db, watershed_feature_id)
+    return upstream.geometry()
 
-    record = res.fetchone()
-
-    if not record or not record[0]:
-        logger.warning(
-            'unable to calculate watershed from watershed feature id %s', watershed_feature_id)
-        return None
 
-    return wkb.loads(record[0].tobytes())
-
-
-def get_working_area_for_dem(db: Session, watershed_feature_id: int):
+def get_working_area_for_dem(db: Session, watershed_feature_id: int, upstream: UpstreamWatershedSet = None):
     """
     Gets a working area and the best available DEM that covers the working area.
     """
@@ -292,64 +274,20 @@ def get_working_area_for_dem(db: Session, watershed_feature_id: int):
         logger.info(
             "Getting upstream catchment area from database, feature id: %s", watershed_feature_id)
 
-    q = """
-        with subwscode_ltree as (
-            SELECT  "WATERSHED_FEATURE_ID" as origin_id,
-                    wscode_ltree as origin_wscode,
-                    localcode_ltree as origin_localcode,
-                    ltree2text(subpath(localcode_ltree, -1))::integer as downstream_tributary,
-                    nlevel(localcode_ltree) as downstream_tributary_code_pos
-            FROM    freshwater_atlas_watersheds
-            WHERE   "WATERSHED_FEATURE_ID" = :watershed_feature_id
-        ),
-        working_area as (
-            SELECT
-                ST_Union("GEOMETRY") as geom
-            FROM    freshwater_atlas_watersheds
-            WHERE   wscode_ltree <@ (select origin_wscode from subwscode_ltree)
-            AND     ltree2text(subltree(
-                        localcode_ltree || '000000'::ltree,
-                        (select downstream_tributary_code_pos from subwscode_ltree) - 1,
-                        (select downstream_tributary_code_pos from subwscode_ltree) - 0
-                    ))::integer >= (select downstream_tributary from subwscode_ltree)
-            AND (NOT wscode_ltree <@ (select origin_localcode from subwscode_ltree) OR (select origin_wscode from subwscode_ltree) = (select origin_localcode from subwscode_ltree))
-        )
-        select  ST_AsBinary(geom) as geom,
-                (
-                    select filename
-                    from dem.stream_burned_cdem_tile t
-                    where ST_Within((select geom from working_area), t.geom)
-                    order by resolution asc
-                    limit 1
-                ) as dem_file
-        from    working_area
-
-    """
+    upstream = upstream or UpstreamWatershedSet(db, watershed_feature_id)
+    working_area = upstream.geometry()
 
-    res = db.execute(q, {"watershed_feature_id": watershed_feature_id})
-
-    record = res.fetchone()
-
-    if not record or not record['geom']:
-        logger.warning(
-            'unable to calculate watershed from watershed feature id %s', watershed_feature_id)
+    if not working_area:
         return None
 
-    working_area = wkb.loads(record['geom'].tobytes())
-    dem_file = record['dem_file']
-
-    if not dem_file:
-        dem_file = CDEM_FILE
-    else:
-        dem_file = f"{RASTER_FILE_DIR}/{dem_file}"
-
-    return (working_area, dem_file)
+    return (working_area, upstream.dem_file())
 
 
 def get_watershed_using_dem(
-        db: Session, point: Point, stream_feature_id, watershed_id, dem_source='cdem', use_fwa: bool = False):
+        db: Session, point: Point, stream_feature_id, watershed_id, dem_source='cdem', use_fwa: bool = False,
+        upstream: UpstreamWatershedSet = None, progress: Callable[[str], None] = None):
     """
-    Use Whitebox Tools to calculate the upstream drainage area from point
+    Use the DEM to calculate the upstream drainage area from point
 
     First generate an overestimate of the catchment using a full stream
     catchment query (full stream because it's a fast query). We also add
@@ -359,10 +297,11 @@ def get_watershed_using_dem(
 
     Next, export a new raster from the DEM (a pre-processed DEM with burned streams)
     for tiles that intersect with the above over-estimated catchment.  The catchment
-    is then refined using the Whitebox Tools functions FlowAccumulationFullWorkflow,
-    SnapPourPoints and Watershed. The Whitebox Tools raster to vector function is
-    used to return a vector format watershed.  See `wbt_calculate_watershed` for more
-    on this step.
+    is then refined by conditioning the DEM, calculating flow direction and flow accumulation,
+    snapping the point to the flow accumulation raster and tracing the watershed upstream of
+    the snapped point.  This runs in-process with NumPy (see `d8.py`) or with the equivalent
+    Whitebox Tools functions, depending on WATERSHED_DELINEATION_ENGINE. The raster watershed
+    is then vectorized.  See `wbt_calculate_watershed` for more on this step.
 
     The resulting watershed will show a "pixelated" pattern around the edges corresponding
     to the size of the pixels (or the resolution) of the source DEM (e.g. 30m or 90m edges etc.).
@@ -374,9 +313,13 @@ def get_watershed_using_dem(
     Hydrosheds data:  https://www.hydrosheds.org/ via FWAPG https://github.com/smnorris/fwapg
     Whitebox Tools: https://jblindsay.github.io/wbt_book/available_tools/hydrological_analysis.html
     Hydrosheds recursive query from https://github.com/smnorris/fwapg/blob/main/sql/functions/FWA_WatershedExBC.sql
+
+    `upstream`: the UpstreamWatershedSet for `watershed_id`, if the caller already has one.
+    `progress`: optional callback, called with the name of each delineation stage as it starts.
     """
 
-    border_crossings = list(set(watershed_touches_border(db, watershed_id)))
+    upstream = upstream or UpstreamWatershedSet(db, watershed_id)
+    border_crossings = upstream.border_crossings()
     working_area = None
     dem_error = False
 
@@ -400,11 +343,12 @@ def get_watershed_using_dem(
             db, transform(transform_4326_3005, point))
 
     elif use_fwa:
-        working_area, upstream_mask, dem_file = get_fwa_polygons_for_dem(db, watershed_id, stream_feature_id, point)
+        working_area, upstream_mask, dem_file = get_fwa_polygons_for_dem(
+            db, watershed_id, stream_feature_id, point, upstream=upstream)
         working_area = working_area
 
     else:
-        working_area, dem_file = get_working_area_for_dem(db, watershed_id)
+        working_area, dem_file = get_working_area_for_dem(db, watershed_id, upstream=upstream)
 
     # setup config to be used with WBT and the spatial features.
     # CDEM uses SRID 4326, so snap_distance must be in degrees
@@ -422,52 +366,58 @@ def get_watershed_using_dem(
 
     logger.info('delineating dem using %s', dem_file)
 
-    max_tries = 8
-    dem_error_threshold = 4  # tries before warning that this watershed may have some issues.
-    for n in range(max_tries):
-        (result, snapped_point) = wbt_calculate_watershed(
-            working_area, point, dem_file,
-            log=True,
-            pntr=False,
-            accum_out_type='sca',
-            snap_distance=snap_distance, using_srid=using_srid
-        )
+    # the clipped DEM and the flow accumulation raster only depend on the working area,
+    # so they are generated once and reused for every snap distance that we try.
+    session = open_delineation_session(
+        working_area, dem_file,
+        log=True,
+        pntr=False,
+        accum_out_type='sca',
+        using_srid=using_srid,
+        progress=progress
+    )
 
-        # automated approach to fixing self-intersecting polygons.
-        # see https://shapely.readthedocs.io/en/stable/manual.html#object.buffer
-        # this isn't a reliable way to fix invalid geometries, but if we have an invalid
-        # geometry at this point we need to try to fix it.
-        if not result.is_valid:
-            result = result.buffer(0)
-
-        # if we have an upstream mask, test to make sure the DEM watershed
-        # at least reached the masked area.
-        if upstream_mask and result.is_valid and result.intersects(upstream_mask) and result.area / working_area.area > 0.01:
-            break
-
-        # if the resulting DEM-delineated watershed area is less than 1% of the upstream overestimate,
-        # try again with an increased snap distance.
-        # Even though we expect the DEM derived watershed to be smaller than the upstream overestimate,
-        # we assume that an error occurred if it is 1% or less of the size. The most common error is
-        # that the snapped point did not hit the the target stream in the Flow Accumulation raster, so
-        # increasing the distance has a good chance of returning a good watershed.
-        elif result.is_valid and result.area / working_area.area > 0.01:
-            break
-        else:
-            # if we've tried `dem_error_threshold` times without a good result, set the dem_error.
-            # even though we will keep trying, we'll warn the user to double check the result.
-            # 4 tries is generally the point where the DEM refinement starts to get noticeably worse.
-            if n == dem_error_threshold:
-                dem_error = True
-
-            # increase the snap distance and retry.
-            if n < max_tries - 1:
-                snap_distance *= 2
-                logger.info(
-                    '-- watershed less than 1%% of the upstream area overestimate, trying again with a larger snap point radius: %s',
-                    snap_distance)
+    with session:
+        max_tries = 8
+        dem_error_threshold = 4  # tries before warning that this watershed may have some issues.
+        for n in range(max_tries):
+            (result, snapped_point) = session.delineate(point, snap_distance=snap_distance)
+
+            # automated approach to fixing self-intersecting polygons.
+            # see https://shapely.readthedocs.io/en/stable/manual.html#object.buffer
+            # this isn't a reliable way to fix invalid geometries, but if we have an invalid
+            # geometry at this point we need to try to fix it.
+            if not result.is_valid:
+                result = result.buffer(0)
+
+            # if we have an upstream mask, test to make sure the DEM watershed
+            # at least reached the masked area.
+            if upstream_mask and result.is_valid and result.intersects(upstream_mask) and result.area / working_area.area > 0.01:
+                break
+
+            # if the resulting DEM-delineated watershed area is less than 1% of the upstream overestimate,
+            # try again with an increased snap distance.
+            # Even though we expect the DEM derived watershed to be smaller than the upstream overestimate,
+            # we assume that an error occurred if it is 1% or less of the size. The most common error is
+            # that the snapped point did not hit the the target stream in the Flow Accumulation raster, so
+            # increasing the distance has a good chance of returning a good watershed.
+            elif result.is_valid and result.area / working_area.area > 0.01:
+                break
             else:
-                logger.info("Could not validate that the DEM-delineated polygon is correct")
+                # if we've tried `dem_error_threshold` times without a good result, set the dem_error.
+                # even though we will keep trying, we'll warn the user to double check the result.
+                # 4 tries is generally the point where the DEM refinement starts to get noticeably worse.
+                if n == dem_error_threshold:
+                    dem_error = True
+
+                # increase the snap distance and retry.
+                if n < max_tries - 1:
+                    snap_distance *= 2
+                    logger.info(
+                        '-- watershed less than 1%% of the upstream area overestimate, trying again with a larger snap point radius: %s',
+                        snap_distance)
+                else:
+                    logger.info("Could not validate that the DEM-delineated polygon is correct")
 
     if dem_source == 'srtm':
         working_area = transform(transform_3005_4326, working_area)
@@ -493,95 +443,94 @@ def get_watershed_using_dem(
     return (result, snapped_point, dem_error)
 
 
-def watershed_touches_border(db: Session, watershed_feature_id: int) -> List[str]:
+def watershed_touches_border(
+        db: Session, watershed_feature_id: int, upstream: UpstreamWatershedSet = None) -> List[str]:
     """
     Returns an array of strings indicating which borders the watershed upstream from
     watershed_feature_id touches. The array will be zero length if no borders were reached.
     """
-
-    q = """
-    with subwscode_ltree as (
-            SELECT  "WATERSHED_FEATURE_ID" as origin_id,
-                    wscode_ltree as origin_wscode,
-                    localcode_ltree as origin_localcode,
-                    ltree2text(subpath(localcode_ltree, -1))::integer as downstream_tributary,
-                    nlevel(localcode_ltree) as downstream_tributary_code_pos
-            FROM    freshwater_atlas_watersheds
-            WHERE   "WATERSHED_FEATURE_ID" = :watershed_feature_id
-        ),
-        upstream as (
-            SELECT  "GEOMETRY" as geom
-            FROM    freshwater_atlas_watersheds
-            WHERE   wscode_ltree <@ (select origin_wscode from subwscode_ltree)
-            AND     ltree2text(subltree(
-                        localcode_ltree || '000000'::ltree,
-                        (select downstream_tributary_code_pos from subwscode_ltree) - 1,
-                        (select downstream_tributary_code_pos from subwscode_ltree) - 0
-                    ))::integer >= (select downstream_tributary from subwscode_ltree)
-            AND (NOT wscode_ltree <@ (select origin_localcode from subwscode_ltree) OR (select origin_wscode from subwscode_ltree) = (select origin_localcode from subwscode_ltree))
-        )
-
-    SELECT border
-    FROM fwa_approx_borders b
-    INNER JOIN upstream w ON ST_Intersects(b.geom, ST_Transform(w.geom, 3005))
-    """
-    borders = []
-    res = db.execute(q, {"watershed_feature_id": watershed_feature_id})
-    return [row['border'] for row in res]
+    upstream = upstream or UpstreamWatershedSet(db, watershed_feature_id)
+    return upstream.border_crossings()
 
 
-def wbt_calculate_watershed(
-        watershed_area: MultiPolygon,
-        point: Point,
-        dem_file: str,
-        log: bool = True,
-        pntr: bool = True,
-        accum_out_type: str = 'sca',
-        snap_distance: float = 1000,
-        using_srid: int = 3005) -> Tuple[Point, MultiPolygon]:
+class DEMDelineationSession:
     """
-    Given a watershed region (an overestimate to crop the original DEM raster to), a starting point,
-    and a path to a DEM file (`dem_file`), use WhiteboxTools to generate an upstream watershed from the point.
-    Returns a tuple containing a snapped starting point and a watershed polygon.
-
-    Use `get_upstream_catchment_area()` or a query like `WHERE FWA_WATERSHED_CODE LIKE 100-123456-%`
-    (for example) to generate an overestimate. The input stream-burned DEM file will be cropped to
-    these extents to make it easier and faster to run the watershed analysis.
+    Holds the clipped and conditioned DEM rasters for one working area so that
+    the pour point can be snapped and traced repeatedly (e.g. with increasing
+    snap distances) without clipping, breaching and accumulating the DEM again.
 
-    Optional arguments:
-    `log`:  run WhiteboxTools D8FlowAccumulation with the --log flag.  Tranforms raster values
-    using log to prevent saturating areas with max values.
-    # d8flowaccumulation
-    See https://jblindsay.github.io/wbt_book/available_tools/hydrological_analysis.html
+    The DEM only depends on the working area and the DEM file, so the expensive
+    steps (gdal.Warp, BreachDepressions, D8Pointer and D8FlowAccumulation) run once
+    in `open()`.  Each call to `delineate()` only runs SnapPourPoints, Watershed and
+    the raster to vector conversion.
 
-    `snap_distance`: the max distance that SnapPourPoints should search for a suitable stream.
-    Always use an appropriate value for the map unit (e.g. 1000 m for EPSG:3005; 0.01 deg for EPSG:4326).
-    If the value is too large, the point might get snapped to a larger nearby stream.
+    Use as a context manager so that any temporary files are cleaned up:
 
-    `pntr`: If True, use the output from D8Pointer as input for D8FlowAccumulation. If False, use the original
-    stream-burned and filled DEM as input.
+        with DEMDelineationSession(working_area, dem_file, using_srid=4326) as session:
+            (watershed, snapped_point) = session.delineate(point, snap_distance=0.001)
 
-    `using_srid`: the SRID that we are working in (4326 or 3005).  All files and features (DEM, input polygons)
-    should use the same projection. Results may be off or blank (and fail silently) if this is set wrong.
+    See `wbt_calculate_watershed` for a description of the arguments.
+    `progress` is an optional callback that is called with the name of each stage
+    (clip, condition, accumulate, snap, vectorize) as it starts.
     """
 
-    # callback function to suppress progress output.
-    def wbt_suppress_progress_output(value):
+    def __init__(
+            self,
+            watershed_area: MultiPolygon,
+            dem_file: str,
+            log: bool = True,
+            pntr: bool = True,
+            accum_out_type: str = 'sca',
+            using_srid: int = 3005,
+            progress: Callable[[str], None] = None):
+        self.watershed_area = watershed_area
+        self.dem_file = dem_file
+        self.log = log
+        self.pntr = pntr
+        self.accum_out_type = accum_out_type
+        self.using_srid = using_srid
+        self.progress = progress
+
+        self._tempdir = None
+        self._attempt = 0
+        self.is_open = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _path(self, filename):
+        return f"{self._tempdir.name}/{filename}"
+
+    def _stage(self, stage: str):
+        if self.progress:
+            self.progress(stage)
+
+    def _suppress_progress_output(self, value):
+        # callback function to suppress progress output.
         if not "%" in value:
             logger.debug(value)
 
-    # WhiteboxTools reads and writes files from/to disk.
-    # Set up some filename references in a TemporaryDirectory.
-    with TemporaryDirectory() as watershed_files:
-        file_001_cutline = f"{watershed_files}/001_cutline.shp"
-        file_010_dem = f"{watershed_files}/010_dem.tif"
-        file_020_dem_filled = f"{watershed_files}/020_filled_dem.tif"
-        file_030_fdr = f"{watershed_files}/030_fdr.tif"
-        file_040_fac = f"{watershed_files}/040_fac.tif"
-        file_050_point_shp = f"{watershed_files}/050_point.shp"
-        file_060_snapped = f"{watershed_files}/060_snapped.shp"
-        file_070_watershed = f"{watershed_files}/070_ws_raster.tif"
-        file_080_watershed_vector = f"{watershed_files}/080_ws_vector.shp"
+    def open(self):
+        """
+        clip the DEM to the working area and generate the conditioned DEM, flow direction
+        and flow accumulation rasters.
+        """
+
+        # WhiteboxTools reads and writes files from/to disk.
+        # Set up some filename references in a TemporaryDirectory.
+        self._tempdir = TemporaryDirectory()
+        self.is_open = True
+
+        self.file_010_dem = self._path("010_dem.tif")
+        self.file_020_dem_filled = self._path("020_filled_dem.tif")
+        self.file_030_fdr = self._path("030_fdr.tif")
+        self.file_040_fac = self._path("040_fac.tif")
+
+        self._stage('clip')
 
         # use gdal.Warp to request a clipped portion of the DEM.
         # the DEM file must be a Cloud Optimized GeoTIFF.
@@ -591,60 +540,81 @@ def wbt_calculate_watershed(
         # https://trac.osgeo.org/gdal/wiki/CloudOptimizedGeoTIFF
         start = time.perf_counter()
 
-        # Define a point feature geometry with one attribute
-        poly_schema = {
-            'geometry': 'Polygon',
-            'properties': {'id': 'int'},
-        }
-
-        # Write a new Shapefile for the starting stream point. This will be used as the input vector point
-        # to be snapped to the nearest stream pixel of the Flow Accumulation raster.
-        with fiona.open(file_001_cutline, 'w', 'ESRI Shapefile', poly_schema, crs=f"EPSG:{using_srid}") as c:
-            c.write({
-                'geometry': mapping(watershed_area),
-                'properties': {'id': 1},
-            })
-
-        gdal.Warp(
-            file_010_dem,
-            f'/vsis3/{dem_file}',
-            cutlineDSName=file_001_cutline,
-            cropToCutline=True
+        # the working area is passed to gdal.Warp as an in-memory cutline.  The clipped
+        # DEM itself is written to disk because WhiteboxTools needs to read it.
+        clip_raster(
+            f'/vsis3/{self.dem_file}',
+            self.watershed_area,
+            srid=self.using_srid,
+            dest=self.file_010_dem,
+            output_format="GTiff"
         )
 
         elapsed = (time.perf_counter() - start)
         logger.info('CLIPPING TOOK %s', elapsed)
 
+        start = time.perf_counter()
+        self._stage('condition')
+
         # use either BreachDepressionsLeastCost or BreachDepressions, not both.
         # Author recommends BreachDepressionsLeastCost but worth testing both.
         # Initial testing: BreachDepressions is working consistently
         # https://jblindsay.github.io/wbt_book/available_tools/hydrological_analysis.html#breachdepressionsleastcost
         # https://jblindsay.github.io/wbt_book/available_tools/hydrological_analysis.html#breachdepressions
         wbt.breach_depressions(
-            file_010_dem,
-            file_020_dem_filled,
-            callback=wbt_suppress_progress_output
+            self.file_010_dem,
+            self.file_020_dem_filled,
+            callback=self._suppress_progress_output
         )
 
         # https://jblindsay.github.io/wbt_book/available_tools/hydrological_analysis.html#d8pointer
         wbt.d8_pointer(
-            file_020_dem_filled,
-            file_030_fdr,
-            callback=wbt_suppress_progress_output
+            self.file_020_dem_filled,
+            self.file_030_fdr,
+            callback=self._suppress_progress_output
         )
 
-        accum_input_file = file_030_fdr
-        if not pntr:
-            accum_input_file = file_020_dem_filled
+        self._stage('accumulate')
+        accum_input_file = self.file_030_fdr
+        if not self.pntr:
+            accum_input_file = self.file_020_dem_filled
 
         # https://jblindsay.github.io/wbt_book/available_tools/hydrological_analysis.html#D8FlowAccumulation
         wbt.d8_flow_accumulation(
             accum_input_file,
-            file_040_fac,
-            out_type=accum_out_type,
-            log=log, pntr=pntr, callback=wbt_suppress_progress_output
+            self.file_040_fac,
+            out_type=self.accum_out_type,
+            log=self.log, pntr=self.pntr, callback=self._suppress_progress_output
         )
 
+        elapsed = (time.perf_counter() - start)
+        logger.info('DEM CONDITIONING TOOK %s', elapsed)
+
+    def close(self):
+        self.is_open = False
+        if self._tempdir:
+            self._tempdir.cleanup()
+            self._tempdir = None
+
+    def delineate(self, point: Point, snap_distance: float = 1000) -> Tuple[MultiPolygon, Point]:
+        """
+        snap `point` to the flow accumulation raster and trace the watershed upstream
+        of the snapped point.  Can be called multiple times with different snap distances.
+        Returns a tuple containing a watershed polygon and the snapped starting point.
+        """
+        if not self.is_open:
+            raise Exception("DEM delineation session is not open")
+
+        # each attempt writes to its own files so that results from a previous
+        # attempt can't be read back by mistake.
+        self._attempt += 1
+        n = self._attempt
+        file_050_point_shp = self._path(f"050_point_{n}.shp")
+        file_060_snapped = self._path(f"060_snapped_{n}.shp")
+        file_070_watershed = self._path(f"070_ws_raster_{n}.tif")
+
+        self._stage('snap')
+
         # Define a point feature geometry with one attribute
         shp_schema = {
             'geometry': 'Point',
@@ -661,16 +631,15 @@ def wbt_calculate_watershed(
 
             if WATERSHED_DEBUG:
                 logger.debug('Wrote shapefile')
-            point_shp_file = c.name
 
         #
         # https://jblindsay.github.io/wbt_book/available_tools/hydrological_analysis.html#JensonSnapPourPoints
         # https://jblindsay.github.io/wbt_book/available_tools/hydrological_analysis.html#SnapPourPoints
-        snap_result = wbt.snap_pour_points(
+        wbt.snap_pour_points(
             file_050_point_shp,
-            file_040_fac,
+            self.file_040_fac,
             file_060_snapped,
-            snap_distance, callback=wbt_suppress_progress_output)
+            snap_distance, callback=self._suppress_progress_output)
 
         with fiona.open(file_060_snapped, 'r', 'ESRI Shapefile') as snp:
             snapped_pt = shape(next(iter(snp)).get('geometry'))
@@ -681,55 +650,270 @@ def wbt_calculate_watershed(
                          snapped_pt.distance(point))
 
         # https://jblindsay.github.io/wbt_book/available_tools/hydrological_analysis.html#watershed
-        watershed_result = wbt.watershed(
-            file_030_fdr,
+        wbt.watershed(
+            self.file_030_fdr,
             file_060_snapped,
-            file_070_watershed, esri_pntr=False, callback=wbt_suppress_progress_output)
+            file_070_watershed, esri_pntr=False, callback=self._suppress_progress_output)
 
         start = time.perf_counter()
-        gdal_raster_to_polygon(file_070_watershed, file_080_watershed_vector)
+        self._stage('vectorize')
+        watershed_result = polygonize_file(file_070_watershed)
         elapsed = (time.perf_counter() - start)
 
         logger.debug('VECTORIZING TOOK %s', elapsed)
 
-        with fiona.open(file_080_watershed_vector, 'r', 'ESRI Shapefile') as ws_result:
+        if self.using_srid == '3005':
+            watershed_result = transform(transform_3005_4326, watershed_result)
 
-            watershed_result = None
-            ws_result_list = None
-            if using_srid == '3005':
-                ws_result_list = [transform(transform_3005_4326, shape(
-                    poly['geometry'])) for poly in ws_result]
-            else:
-                ws_result_list = [shape(poly['geometry']) for poly in ws_result]
-            watershed_result = MultiPolygon(ws_result_list)
+        return (watershed_result, snapped_pt)
+
+
+class NumpyDelineationSession(DEMDelineationSession):
+    """
+    A DEMDelineationSession that conditions the DEM and traces watersheds in-process
+    with NumPy (see `api.v1.watersheds.d8`) instead of running WhiteboxTools.
+
+    The clipped DEM is read into memory once, and the filled DEM, flow direction and
+    flow accumulation grids are kept as arrays for the life of the session.
+    `log`, `pntr` and `accum_out_type` are accepted for compatibility but have no effect:
+    they change the flow accumulation values but not which cell has the highest value,
+    which is all that snapping depends on.
+    """
+
+    NO_DATA = -32768
+
+    def open(self):
+        start = time.perf_counter()
+        self._stage('clip')
+
+        # clip the DEM straight into memory.
+        dataset = clip_raster(
+            f'/vsis3/{self.dem_file}',
+            self.watershed_area,
+            srid=self.using_srid,
+            no_data=self.NO_DATA
+        )
+
+        if not dataset:
+            raise Exception("unable to clip DEM to the working area")
+
+        self.geotransform = dataset.GetGeoTransform()
+        self.projection = dataset.GetProjection()
+        dem = dataset.GetRasterBand(1).ReadAsArray()
+        dataset = None
+
+        elapsed = (time.perf_counter() - start)
+        logger.info('CLIPPING TOOK %s', elapsed)
+
+        start = time.perf_counter()
+        self._stage('condition')
+
+        self.valid = dem != self.NO_DATA
+        filled = d8.fill_depressions(dem, self.valid)
+
+        distances = d8.cell_distances(
+            self.geotransform[1], self.geotransform[5],
+            geographic=self.using_srid == 4326,
+            latitude=self.watershed_area.centroid.y)
+        self.direction = d8.d8_pointer(filled, self.valid, distances)
+
+        self._stage('accumulate')
+        self.accumulation = d8.d8_flow_accumulation(self.direction, self.valid)
+
+        self.is_open = True
+
+        elapsed = (time.perf_counter() - start)
+        logger.info('DEM CONDITIONING TOOK %s', elapsed)
+
+    def delineate(self, point: Point, snap_distance: float = 1000) -> Tuple[MultiPolygon, Point]:
+        if not self.is_open:
+            raise Exception("DEM delineation session is not open")
+
+        (x0, cell_size_x, _, y0, _, cell_size_y) = self.geotransform
+        nrows, ncols = self.direction.shape
+        row = int(math.floor((point.y - y0) / cell_size_y))
+        col = int(math.floor((point.x - x0) / cell_size_x))
+
+        # a point outside the DEM returns an empty watershed, which
+        # get_watershed_using_dem will treat as a failed attempt.
+        if not (0 <= row < nrows and 0 <= col < ncols):
+            logger.warning('pour point %s is outside of the DEM working area', point)
+            return (MultiPolygon(), point)
+
+        # SnapPourPoints searches a square window that extends half of the snap
+        # distance from the pour point. Use the same window so that the snap distances
+        # used with get_watershed_using_dem behave the same for both engines.
+        self._stage('snap')
+        snap_distance_cells = int(math.floor(snap_distance / abs(cell_size_x) / 2))
+        (row, col) = d8.snap_pour_point(self.accumulation, row, col, snap_distance_cells)
+        snapped_pt = Point(x0 + (col + 0.5) * cell_size_x, y0 + (row + 0.5) * cell_size_y)
+
+        if WATERSHED_DEBUG:
+            logger.debug('-- snap distance from stream point: %s',
+                         snapped_pt.distance(point))
+
+        mask = d8.watershed_mask(self.direction, row, col)
+
+        start = time.perf_counter()
+        self._stage('vectorize')
+        watershed_result = polygonize_array(mask, self.geotransform, self.projection)
+        elapsed = (time.perf_counter() - start)
+
+        logger.debug('VECTORIZING TOOK %s', elapsed)
+
+        return (watershed_result, snapped_pt)
+
+
+class PrecomputedDelineationSession(NumpyDelineationSession):
+    """
+    A delineation session that reads precomputed D8 flow direction and flow accumulation
+    grids (see `imports/cdem/build_flow_grids.sh`) for the bounding box of the working area,
+    so that no conditioning is done while handling a request.  Only snapping and tracing
+    the watershed upstream of the pour point happen in `delineate()`.
+
+    The grids were computed from the whole DEM, so flow paths that cross the edges of the
+    internal COG tiles are continuous.
+    """
+
+    def __init__(self, watershed_area: MultiPolygon, dem_file: str, flow_grids: Tuple[str, str], **kwargs):
+        super().__init__(watershed_area, dem_file, **kwargs)
+        self.pointer_file, self.accumulation_file = flow_grids
+
+    def open(self):
+        start = time.perf_counter()
+        self._stage('clip')
+
+        # the grids are read through the local raster block cache, which is shared by the workers.
+        with cached_raster(f'/vsis3/{self.pointer_file}', self.watershed_area) as pointer_path, \
+                cached_raster(f'/vsis3/{self.accumulation_file}', self.watershed_area) as accumulation_path:
+            pointer = self._read_window(pointer_path, accumulation_path)
+
+        self.direction = d8.from_wbt_pointer(pointer)
+        self.valid = self.direction != d8.NO_FLOW
+        self.is_open = True
+
+        elapsed = (time.perf_counter() - start)
+        logger.info('READING FLOW GRIDS TOOK %s', elapsed)
+
+    def _read_window(self, pointer_path: str, accumulation_path: str):
+        """
+        reads the grids covering the working area.  Sets the accumulation grid, geotransform
+        and projection, and returns the pointer grid.
+        """
+        pointer_ds = gdal.Open(pointer_path)
+        accumulation_ds = gdal.Open(accumulation_path)
+
+        if not pointer_ds or not accumulation_ds:
+            raise Exception("unable to open precomputed flow grids for %s" % self.dem_file)
+
+        # read the window covering the working area.  With COGs, GDAL only
+        # requests the internal tiles that intersect the window.
+        gt = pointer_ds.GetGeoTransform()
+        (minx, miny, maxx, maxy) = self.watershed_area.bounds
+        xoff = max(int(math.floor((minx - gt[0]) / gt[1])), 0)
+        yoff = max(int(math.floor((maxy - gt[3]) / gt[5])), 0)
+        xend = min(int(math.ceil((maxx - gt[0]) / gt[1])), pointer_ds.RasterXSize)
+        yend = min(int(math.ceil((miny - gt[3]) / gt[5])), pointer_ds.RasterYSize)
+
+        if xend <= xoff or yend <= yoff:
+            raise Exception("working area is outside of the precomputed flow grids for %s" % self.dem_file)
+
+        pointer = pointer_ds.GetRasterBand(1).ReadAsArray(xoff, yoff, xend - xoff, yend - yoff)
+        self.accumulation = accumulation_ds.GetRasterBand(1).ReadAsArray(
+            xoff, yoff, xend - xoff, yend - yoff).astype(np.float64)
+
+        self.geotransform = (gt[0] + xoff * gt[1], gt[1], 0, gt[3] + yoff * gt[5], 0, gt[5])
+        self.projection = pointer_ds.GetProjection()
+        pointer_ds = None
+        accumulation_ds = None
+        return pointer
+
+
+@lru_cache()
+def get_flow_grids(dem_file: str) -> Optional[Tuple[str, str]]:
+    """
+    Returns the (pointer, accumulation) file names of the precomputed flow grids for
+    `dem_file`, or None if they haven't been uploaded to Minio.
+    e.g. raster/Burned_CDEM_4326.tif -> raster/Burned_CDEM_4326_d8_pointer.tif
+    The result is cached for the life of the process.
+    """
+    name = dem_file[:-len('.tif')] if dem_file.endswith('.tif') else dem_file
+    flow_grids = (f"{name}_d8_pointer.tif", f"{name}_d8_accumulation.tif")
+
+    if all(gdal.VSIStatL(f'/vsis3/{f}') is not None for f in flow_grids):
+        return flow_grids
+    return None
+
+
+def open_delineation_session(
+        watershed_area: MultiPolygon,
+        dem_file: str,
+        engine: str = None,
+        **kwargs) -> DEMDelineationSession:
+    """
+    Returns a delineation session for `watershed_area` using `engine` ("numpy" or "wbt").
+    Defaults to the WATERSHED_DELINEATION_ENGINE setting. With the numpy engine, precomputed
+    flow grids for `dem_file` are used if they are available. The session must be opened,
+    e.g. by using it as a context manager.
+    """
+    engine = engine or WATERSHED_DELINEATION_ENGINE
 
-    return (watershed_result, snapped_pt)
+    if engine == 'wbt':
+        return DEMDelineationSession(watershed_area, dem_file, **kwargs)
 
+    flow_grids = get_flow_grids(dem_file)
+    if flow_grids:
+        logger.info('using precomputed flow grids %s', flow_grids)
+        return PrecomputedDelineationSession(watershed_area, dem_file, flow_grids, **kwargs)
 
-def gdal_raster_to_polygon(in_file, out_file):
+    return NumpyDelineationSession(watershed_area, dem_file, **kwargs)
+
+
+def wbt_calculate_watershed(
+        watershed_area: MultiPolygon,
+        point: Point,
+        dem_file: str,
+        log: bool = True,
+        pntr: bool = True,
+        accum_out_type: str = 'sca',
+        snap_distance: float = 1000,
+        using_srid: int = 3005,
+        engine: str = None) -> Tuple[Point, MultiPolygon]:
     """
-    use GDAL Polygonize to convert a raster watershed to a vector watershed.
-    Will write to `out_file`.  Use `fiona.open(outfile, 'r', 'ESRI Shapefile')`
-    to read from outfile into Python.
+    Given a watershed region (an overestimate to crop the original DEM raster to), a starting point,
+    and a path to a DEM file (`dem_file`), use WhiteboxTools to generate an upstream watershed from the point.
+    Returns a tuple containing a watershed polygon and a snapped starting point.
+
+    Use `get_upstream_catchment_area()` or a query like `WHERE FWA_WATERSHED_CODE LIKE 100-123456-%`
+    (for example) to generate an overestimate. The input stream-burned DEM file will be cropped to
+    these extents to make it easier and faster to run the watershed analysis.
+
+    This is a one-shot wrapper around a delineation session (see `open_delineation_session`).
+    Use a session directly if the watershed may need to be delineated more than once from
+    the same working area.
+
+    Optional arguments:
+    `log`:  run WhiteboxTools D8FlowAccumulation with the --log flag.  Tranforms raster values
+    using log to prevent saturating areas with max values.
+    # d8flowaccumulation
+    See https://jblindsay.github.io/wbt_book/available_tools/hydrological_analysis.html
+
+    `snap_distance`: the max distance that SnapPourPoints should search for a suitable stream.
+    Always use an appropriate value for the map unit (e.g. 1000 m for EPSG:3005; 0.01 deg for EPSG:4326).
+    If the value is too large, the point might get snapped to a larger nearby stream.
+
+    `pntr`: If True, use the output from D8Pointer as input for D8FlowAccumulation. If False, use the original
+    stream-burned and filled DEM as input.
+
+    `using_srid`: the SRID that we are working in (4326 or 3005).  All files and features (DEM, input polygons)
+    should use the same projection. Results may be off or blank (and fail silently) if this is set wrong.
+
+    `engine`: "numpy" to run in-process, or "wbt" to use WhiteboxTools. Defaults to the
+    WATERSHED_DELINEATION_ENGINE setting.
     """
-    # set up GDAL settings for reading the Watershed output raster
-    # and converting it to a polygon.
-    try:
-        # Read in the raster with the watershed.
-        # the watershed is always in band 1.
-        sourceRaster = gdal.Open(in_file)
-        band = sourceRaster.GetRasterBand(1)
-
-        # create a shapefile with a layer for our watershed.
-        driver = ogr.GetDriverByName("ESRI Shapefile")
-        outDatasource = driver.CreateDataSource(out_file)
-        outLayer = outDatasource.CreateLayer("watershed", srs=None)
-
-        # write polygon to the output layer in `out_file`
-        gdal.Polygonize(band, band, outLayer, -1, [], callback=None)
-
-        # clean up
-        outDatasource.Destroy()
-        sourceRaster = None
-    except:
-        raise Exception("unable to convert from raster watershed to vector watershed")
+
+    with open_delineation_session(
+            watershed_area, dem_file, engine=engine,
+            log=log, pntr=pntr, accum_out_type=accum_out_type,
+            using_srid=using_srid) as session:
+        return session.delineate(point, snap_distance=snap_distance)
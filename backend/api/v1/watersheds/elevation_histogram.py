@@ -0,0 +1,115 @@
+"""
+Elevation histograms that can be merged.
+
+An exact median needs every cell of the area, so it can't be combined from the medians of
+smaller areas.  A histogram of cell counts per 1 metre elevation bin can: the histogram of a
+union of areas (that don't share cells) is the sum of their histograms, and its percentiles are
+exact for the CDEM (whose elevations are whole metres).
+
+Histograms are stored for every fundamental watershed (fwa_watershed_attributes), as JSON
+objects of {"elevation": cell count}, and merged to summarize watersheds made of them
+(see fwa_attributes.py).
+"""
+from typing import Dict, Iterable, Optional
+import numpy as np
+
+# bin width in metres.  Elevations are rounded to the nearest bin.
+BIN_SIZE = 1
+
+
+class ElevationHistogram:
+    """ the number of cells at each elevation (in BIN_SIZE bins) """
+
+    def __init__(self, counts: Optional[Dict[int, int]] = None):
+        self.counts: Dict[int, int] = {}
+        for elevation, cells in (counts or {}).items():
+            self.add(elevation, cells)
+
+    @classmethod
+    def from_values(cls, values: Iterable[float]) -> 'ElevationHistogram':
+        """ bins an array of elevations """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        bins, cells = np.unique(np.round(values / BIN_SIZE).astype(np.int64) * BIN_SIZE, return_counts=True)
+        hist = cls()
+        hist.counts = {int(b): int(c) for b, c in zip(bins, cells)}
+        return hist
+
+    @classmethod
+    def from_json(cls, data: Optional[dict]) -> 'ElevationHistogram':
+        """ reads a histogram stored as {"elevation": count} (JSON object keys are strings) """
+        return cls({float(e): c for e, c in (data or {}).items()})
+
+    def to_json(self) -> dict:
+        return {str(e): c for e, c in sorted(self.counts.items())}
+
+    def add(self, elevation: float, cells: int = 1):
+        b = int(round(float(elevation) / BIN_SIZE)) * BIN_SIZE
+        self.counts[b] = self.counts.get(b, 0) + int(cells)
+
+    def merge(self, *others: 'ElevationHistogram') -> 'ElevationHistogram':
+        """ adds the counts of `others` to this histogram (in place) and returns it """
+        for other in others:
+            for elevation, cells in other.counts.items():
+                self.counts[elevation] = self.counts.get(elevation, 0) + cells
+        return self
+
+    def __add__(self, other: 'ElevationHistogram') -> 'ElevationHistogram':
+        return ElevationHistogram(self.counts).merge(other)
+
+    def _arrays(self):
+        elevations = np.array(sorted(self.counts), dtype=np.float64)
+        cells = np.array([self.counts[e] for e in sorted(self.counts)], dtype=np.float64)
+        return elevations, cells
+
+    @property
+    def count(self) -> int:
+        return int(sum(self.counts.values()))
+
+    def summary_stats(self) -> dict:
+        """ count, sum, mean, population stddev, min and max, like ST_SummaryStats """
+        if not self.count:
+            raise ValueError("histogram is empty")
+        elevations, cells = self._arrays()
+        count = cells.sum()
+        total = (elevations * cells).sum()
+        mean = total / count
+        variance = max((elevations ** 2 * cells).sum() / count - mean ** 2, 0)
+        return {
+            "count": int(count),
+            "sum": float(total),
+            "mean": float(mean),
+            "stddev": float(np.sqrt(variance)),
+            "min": float(elevations[0]),
+            "max": float(elevations[-1]),
+        }
+
+    def percentile(self, q: float) -> float:
+        """
+        the `q` (0 - 1) percentile of all the cells, interpolated like percentile_cont(q)
+        over the cell values.
+        """
+        if not self.count:
+            raise ValueError("histogram is empty")
+        elevations, cells = self._arrays()
+        position = q * (cells.sum() - 1)
+        # the index of the last cell in each bin, when all the cells are sorted
+        last_cell = np.cumsum(cells) - 1
+        lower = elevations[np.searchsorted(last_cell, np.floor(position))]
+        upper = elevations[np.searchsorted(last_cell, np.ceil(position))]
+        return float(lower + (upper - lower) * (position - np.floor(position)))
+
+    def median(self) -> float:
+        return self.percentile(0.5)
+
+    def median_of_distinct(self) -> float:
+        """
+        the median of the distinct elevations, ignoring how many cells are at each one.
+        This is how the watershed median elevation has always been calculated
+        (percentile_cont over ST_ValueCount values), and what the SCSB model was fit with.
+        """
+        if not self.count:
+            raise ValueError("histogram is empty")
+        elevations = [e for e, c in self.counts.items() if c]
+        return float(np.median(elevations))
+
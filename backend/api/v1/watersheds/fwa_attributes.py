@@ -0,0 +1,402 @@
+"""
+Precomputed statistics for Freshwater Atlas fundamental watersheds.
+
+Watersheds delineated with the FWA methods (`generated`, `generated_full_stream`) are exactly a
+union of fundamental watershed polygons, and DEM+FWA watersheds are mostly made of them.  Instead of
+reading the climate, elevation and hillshade rasters for the whole watershed, the sums and cell counts
+of each fundamental watershed are computed once (offline) and stored in fwa_watershed_attributes.
+A watershed is then summarized by adding up the rows for its polygons:
+
+* precipitation and PET: sum and number of cells (mean = sum / count)
+* elevation: a histogram with 1 metre bins (see elevation_histogram.py), which gives the
+  summary stats and the median of the distinct elevations
+* slope (percent) and hillshade: sum and number of cells
+* glacier area (from the FWA GLACIER_AREA attribute)
+
+Raster cells are assigned to the polygon that contains the cell's centre, so the sums over
+neighbouring polygons add up without counting any cell twice.
+The slope is computed on a CDEM window that extends one cell past the polygon, so the cells on its
+edge have their neighbours and adjacent polygons add up to the slope of their union.
+
+For DEM+FWA watersheds, only the fundamental watersheds that are entirely inside the watershed are
+read from the table.  The part of the watershed near the outlet that the DEM cut through is
+summarized from the rasters and added in.
+
+Build or update the table (e.g. after loading the FWA or replacing a raster) with:
+
+    python -m api.v1.watersheds.fwa_attributes [--group WATERSHED_GROUP_CODE] [--refresh]
+"""
+import argparse
+import json
+import logging
+import time
+from typing import List, Optional, Tuple
+import numpy as np
+from shapely import wkb
+from shapely.ops import transform, unary_union
+from sqlalchemy.orm import Session
+
+from api.utils.raster import clip_raster
+from api.v1.aggregator.helpers import transform_4326_3005, transform_4326_4140
+from api.v1.watersheds import PRECIP_RASTER, PET_RASTER, HILLSHADE_RASTER
+from api.v1.watersheds.climate import read_climate_stack, HILLSHADE_MAX
+from api.v1.watersheds.elevation_histogram import ElevationHistogram
+from api.v1.watersheds.upstream import UpstreamWatershedSet
+from api.v1.watersheds.zonal_stats import read_cdem_window_with_margin, slope_percent
+
+logger = logging.getLogger('WATERSHEDS')
+
+PRECIP_NO_DATA = -9999
+PET_NO_DATA = -32768
+HILLSHADE_NO_DATA = -32768
+
+# watershed types (the first part of the watershed feature id) that are built
+# from fundamental watersheds.
+ATTRIBUTE_WATERSHED_TYPES = ('generated', 'generated_full_stream', 'generated_dem_fwa')
+
+# the summed polygons must account for the whole watershed area (within this fraction),
+# otherwise the watershed is summarized from the rasters.
+AREA_TOLERANCE = 0.01
+
+# polygons within this distance (degrees, about 1 m) of being inside a DEM+FWA watershed
+# are counted as inside.  The union/intersection in the delineation moves vertices slightly.
+COVERED_TOLERANCE = 0.00001
+
+SUM_FIELDS = (
+    'area_sqm', 'precip_sum', 'precip_count', 'pet_sum', 'pet_count', 'glacier_area_sqm',
+    'slope_sum', 'slope_count', 'hillshade_sum', 'hillshade_count'
+)
+
+FWA_ATTRIBUTE_SUMS_QUERY = """
+    with attrs as (
+        SELECT  *
+        FROM    fwa_watershed_attributes
+        WHERE   watershed_feature_id = ANY(:ids)
+    ),
+    histogram as (
+        SELECT  h.key as elevation,
+                sum(h.value::bigint) as cells
+        FROM    attrs, jsonb_each_text(attrs.elevation_histogram) h
+        GROUP BY h.key
+    )
+    SELECT  count(*) as polygon_count,
+            coalesce(sum(area_sqm), 0) as area_sqm,
+            coalesce(sum(precip_sum), 0) as precip_sum,
+            coalesce(sum(precip_count), 0) as precip_count,
+            coalesce(sum(pet_sum), 0) as pet_sum,
+            coalesce(sum(pet_count), 0) as pet_count,
+            coalesce(sum(glacier_area_sqm), 0) as glacier_area_sqm,
+            coalesce(sum(slope_sum), 0) as slope_sum,
+            coalesce(sum(slope_count), 0) as slope_count,
+            coalesce(sum(hillshade_sum), 0) as hillshade_sum,
+            coalesce(sum(hillshade_count), 0) as hillshade_count,
+            (SELECT jsonb_object_agg(elevation, cells) FROM histogram) as elevation_histogram
+    FROM    attrs
+"""
+
+
+def raster_sum_count(file_name: str, area, no_data) -> Tuple[float, int]:
+    """ returns the sum and number of the valid cells of `file_name` inside `area` (EPSG:4326) """
+    dataset = clip_raster(file_name, area, srid=4326, no_data=no_data)
+    if not dataset:
+        return 0.0, 0
+    data = dataset.ReadAsArray()
+    dataset = None
+    values = data[data != no_data]
+    return float(values.sum()), int(values.size)
+
+
+def cdem_attributes(db: Session, polygon_4140) -> Tuple[ElevationHistogram, float, int]:
+    """
+    returns the elevation histogram, and the slope sum and number of cells, of the CDEM cells
+    whose centre is inside `polygon_4140` (EPSG:4140).  The slope is computed before masking
+    the cells outside the polygon, so the cells on its edge have a slope.
+    """
+    try:
+        elevation, window, geotransform = read_cdem_window_with_margin(db, polygon_4140)
+    except Exception:
+        # the polygon doesn't contain the centre of any CDEM cell.
+        return ElevationHistogram(), 0.0, 0
+    if not elevation.count():
+        return ElevationHistogram(), 0.0, 0
+
+    slope = slope_percent(window, geotransform[1], geotransform[5])
+    slope = np.ma.array(slope.data, mask=np.ma.getmaskarray(slope) | np.ma.getmaskarray(elevation))
+    slope_count = int(slope.count())
+    slope_sum = float(slope.sum()) if slope_count else 0.0
+    return ElevationHistogram.from_values(elevation.compressed()), slope_sum, slope_count
+
+
+def calculate_attributes(db: Session, polygon, glacier_area_sqm: Optional[float] = None) -> dict:
+    """
+    reads the rasters for `polygon` (EPSG:4326) and returns its sums and cell counts.
+    If `glacier_area_sqm` isn't known, it is calculated from the FWA glaciers layer.
+    """
+    try:
+        climate = read_climate_stack(polygon)
+    except Exception:
+        # the polygon doesn't contain the centre of any cell, or the stack isn't available.
+        climate = None
+
+    if climate:
+        precip_sum, precip_count = climate['precipitation']
+        pet_sum, pet_count = climate['pet']
+        hillshade_sum, hillshade_count = climate['hillshade']
+    else:
+        precip_sum, precip_count = raster_sum_count(f"/vsis3/{PRECIP_RASTER}", polygon, PRECIP_NO_DATA)
+        pet_sum, pet_count = raster_sum_count(f"/vsis3/{PET_RASTER}", polygon, PET_NO_DATA)
+        hillshade_sum, hillshade_count = raster_sum_count(f"/vsis3/{HILLSHADE_RASTER}", polygon, HILLSHADE_NO_DATA)
+
+    histogram, slope_sum, slope_count = cdem_attributes(db, transform(transform_4326_4140, polygon))
+
+    if glacier_area_sqm is None:
+        # imported here, the controller imports this module.
+        from api.v1.watersheds.controller import calculate_glacial_area
+        glacier_area_sqm, _ = calculate_glacial_area(db, polygon)
+
+    return {
+        'area_sqm': transform(transform_4326_3005, polygon).area,
+        'precip_sum': precip_sum,
+        'precip_count': precip_count,
+        'pet_sum': pet_sum,
+        'pet_count': pet_count,
+        'glacier_area_sqm': glacier_area_sqm,
+        'elevation_histogram': histogram,
+        'slope_sum': slope_sum,
+        'slope_count': slope_count,
+        'hillshade_sum': hillshade_sum,
+        'hillshade_count': hillshade_count,
+    }
+
+
+def merge_attributes(*attributes: dict) -> dict:
+    """ adds up the sums, counts and elevation histograms of several areas """
+    merged = {field: 0 for field in SUM_FIELDS}
+    merged['elevation_histogram'] = ElevationHistogram()
+    for attrs in attributes:
+        for field in SUM_FIELDS:
+            merged[field] += attrs[field] or 0
+        merged['elevation_histogram'].merge(attrs['elevation_histogram'])
+    return merged
+
+
+def summarize_attributes(attrs: dict, watershed_area_sqm: float) -> Optional[dict]:
+    """
+    returns the watershed details (in the same form as get_watershed_details) from summed
+    attributes, or None if a raster didn't have any cells in the area (small watersheds
+    are summarized from the rasters, which can sample the nearest cell instead).
+    """
+    histogram = attrs['elevation_histogram']
+    if not (attrs['precip_count'] and attrs['pet_count'] and attrs['hillshade_count']
+            and attrs['slope_count'] and histogram.count):
+        return None
+
+    return {
+        "glacial_area": attrs['glacier_area_sqm'],
+        "glacial_coverage": attrs['glacier_area_sqm'] / watershed_area_sqm,
+        "annual_precipitation": attrs['precip_sum'] / attrs['precip_count'],
+        "potential_evapotranspiration": attrs['pet_sum'] / attrs['pet_count'],
+        "average_slope": attrs['slope_sum'] / attrs['slope_count'],
+        "solar_exposure": attrs['hillshade_sum'] / attrs['hillshade_count'] / HILLSHADE_MAX,
+        # median of the distinct elevations, like CDEM.get_median_elevation
+        "median_elevation": histogram.median_of_distinct(),
+        "elevation_stats": histogram.summary_stats(),
+    }
+
+
+def get_attribute_sums(db: Session, ids: List[int]) -> Optional[dict]:
+    """ sums the attributes of the fundamental watersheds `ids`, or None if any of them are missing """
+    if not ids:
+        return None
+    row = db.execute(FWA_ATTRIBUTE_SUMS_QUERY, {"ids": list(ids)}).fetchone()
+    if not row or row['polygon_count'] < len(set(ids)):
+        return None
+    attrs = dict(row)
+    attrs['elevation_histogram'] = ElevationHistogram.from_json(attrs['elevation_histogram'])
+    return attrs
+
+
+def get_full_stream_ids(db: Session, watershed_feature_id: int) -> List[int]:
+    """ the fundamental watersheds of the whole stream (see get_full_stream_catchment_area) """
+    q = """
+        SELECT  array_agg("WATERSHED_FEATURE_ID") as ids
+        FROM    freshwater_atlas_watersheds
+        WHERE   wscode_ltree <@ (
+            SELECT  wscode_ltree
+            FROM    freshwater_atlas_watersheds
+            WHERE   "WATERSHED_FEATURE_ID" = :watershed_feature_id
+        )
+    """
+    row = db.execute(q, {"watershed_feature_id": watershed_feature_id}).fetchone()
+    return list(row['ids'] or []) if row else []
+
+
+def split_watershed(db: Session, watershed_poly, ids: List[int]):
+    """
+    splits a watershed into the fundamental watersheds (from `ids`) that are entirely inside it,
+    and the rest of the watershed (the parts of the polygons it only partly covers),
+    returned as a geometry or None.
+    """
+    q = """
+        with watershed as (
+            SELECT  ST_GeomFromText(:watershed, 4326) as geom,
+                    ST_Buffer(ST_GeomFromText(:watershed, 4326), :tolerance) as buffered
+        )
+        SELECT  w."WATERSHED_FEATURE_ID" as id,
+                ST_CoveredBy(w."GEOMETRY", ws.buffered) as covered,
+                CASE WHEN ST_CoveredBy(w."GEOMETRY", ws.buffered) THEN NULL
+                     ELSE ST_AsBinary(ST_Intersection(w."GEOMETRY", ws.geom))
+                END as part
+        FROM    freshwater_atlas_watersheds w, watershed ws
+        WHERE   w."WATERSHED_FEATURE_ID" = ANY(:ids)
+        AND     ST_Intersects(w."GEOMETRY", ws.geom)
+    """
+    res = db.execute(q, {"watershed": watershed_poly.wkt, "tolerance": COVERED_TOLERANCE, "ids": ids})
+
+    covered = []
+    parts = []
+    for row in res:
+        if row['covered']:
+            covered.append(row['id'])
+        elif row['part']:
+            part = wkb.loads(bytes(row['part']))
+            if not part.is_empty and part.area:
+                parts.append(part)
+
+    remainder = unary_union(parts) if parts else None
+    return covered, remainder
+
+
+def get_fwa_watershed_stats(
+        db: Session, watershed_feature: str, watershed_poly, watershed_area_sqm: float,
+        fwa_watershed_id: Optional[int]) -> Optional[dict]:
+    """
+    summarizes a watershed from fwa_watershed_attributes.  Returns None if the watershed isn't
+    made of fundamental watersheds or the table doesn't cover it; the caller should then
+    read the rasters.
+    """
+    watershed_type = '.'.join(str(watershed_feature).split('.')[:-1])
+    if watershed_type not in ATTRIBUTE_WATERSHED_TYPES or not fwa_watershed_id:
+        return None
+
+    start = time.perf_counter()
+
+    if watershed_type == 'generated_full_stream':
+        ids = get_full_stream_ids(db, fwa_watershed_id)
+    else:
+        ids = UpstreamWatershedSet(db, fwa_watershed_id).ids
+
+    remainder = None
+    if watershed_type == 'generated_dem_fwa':
+        ids, remainder = split_watershed(db, watershed_poly, ids)
+
+    attrs = get_attribute_sums(db, ids)
+    if not attrs:
+        logger.info('fwa_watershed_attributes does not cover %s', watershed_feature)
+        return None
+
+    remainder_area = transform(transform_4326_3005, remainder).area if remainder else 0
+    if abs(attrs['area_sqm'] + remainder_area - watershed_area_sqm) > AREA_TOLERANCE * watershed_area_sqm:
+        logger.info('fundamental watersheds do not match the area of %s (%s + %s, expected %s)',
+                    watershed_feature, attrs['area_sqm'], remainder_area, watershed_area_sqm)
+        return None
+
+    if remainder:
+        attrs = merge_attributes(attrs, calculate_attributes(db, remainder))
+
+    stats = summarize_attributes(attrs, watershed_area_sqm)
+    logger.info('summarized %s from %s fundamental watersheds in %s',
+                watershed_feature, len(ids), time.perf_counter() - start)
+    return stats
+
+
+def store_attributes(db: Session, watershed_feature_id: int, attrs: dict):
+    q = """
+        INSERT INTO fwa_watershed_attributes (
+            watershed_feature_id, area_sqm, precip_sum, precip_count, pet_sum, pet_count,
+            glacier_area_sqm, elevation_histogram, slope_sum, slope_count, hillshade_sum, hillshade_count
+        )
+        VALUES (
+            :watershed_feature_id, :area_sqm, :precip_sum, :precip_count, :pet_sum, :pet_count,
+            :glacier_area_sqm, CAST(:elevation_histogram AS jsonb), :slope_sum, :slope_count,
+            :hillshade_sum, :hillshade_count
+        )
+        ON CONFLICT (watershed_feature_id) DO UPDATE
+        SET     area_sqm = excluded.area_sqm,
+                precip_sum = excluded.precip_sum,
+                precip_count = excluded.precip_count,
+                pet_sum = excluded.pet_sum,
+                pet_count = excluded.pet_count,
+                glacier_area_sqm = excluded.glacier_area_sqm,
+                elevation_histogram = excluded.elevation_histogram,
+                slope_sum = excluded.slope_sum,
+                slope_count = excluded.slope_count,
+                hillshade_sum = excluded.hillshade_sum,
+                hillshade_count = excluded.hillshade_count,
+                update_date = now()
+    """
+    db.execute(q, {
+        **attrs,
+        "watershed_feature_id": watershed_feature_id,
+        "elevation_histogram": json.dumps(attrs['elevation_histogram'].to_json())
+    })
+
+
+def refresh_fwa_watershed_attributes(
+        db: Session, watershed_group_code: Optional[str] = None, refresh: bool = False, batch_size: int = 100):
+    """
+    computes the attributes of every fundamental watershed (optionally only those in one
+    watershed group).  Polygons that already have attributes are skipped unless `refresh` is set.
+    Progress is committed every `batch_size` polygons, so the job can be restarted.
+    """
+    q = """
+        SELECT  array_agg(w."WATERSHED_FEATURE_ID" ORDER BY w."WATERSHED_FEATURE_ID") as ids
+        FROM    freshwater_atlas_watersheds w
+        WHERE   (CAST(:group AS text) IS NULL OR w."WATERSHED_GROUP_CODE" = :group)
+        AND     (:refresh OR NOT EXISTS (
+            SELECT 1 FROM fwa_watershed_attributes a WHERE a.watershed_feature_id = w."WATERSHED_FEATURE_ID"
+        ))
+    """
+    row = db.execute(q, {"group": watershed_group_code, "refresh": refresh}).fetchone()
+    ids = list(row['ids'] or [])
+    logger.info('computing attributes for %s fundamental watersheds', len(ids))
+
+    start = time.perf_counter()
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i + batch_size]
+        res = db.execute("""
+            SELECT  "WATERSHED_FEATURE_ID" as id,
+                    coalesce("GLACIER_AREA", 0) * 10000 as glacier_area_sqm,
+                    ST_AsBinary("GEOMETRY") as geom
+            FROM    freshwater_atlas_watersheds
+            WHERE   "WATERSHED_FEATURE_ID" = ANY(:ids)
+        """, {"ids": batch})
+
+        for polygon in res.fetchall():
+            geom = wkb.loads(bytes(polygon['geom']))
+            attrs = calculate_attributes(db, geom, glacier_area_sqm=polygon['glacier_area_sqm'])
+            store_attributes(db, polygon['id'], attrs)
+
+        db.commit()
+        logger.info('%s of %s fundamental watersheds done (%s s)',
+                    min(i + batch_size, len(ids)), len(ids), round(time.perf_counter() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the fwa_watershed_attributes table.")
+    parser.add_argument('--group', help='only this WATERSHED_GROUP_CODE (e.g. LFRA)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='recompute polygons that already have attributes')
+    args = parser.parse_args()
+
+    from api.db.session import Session as SessionLocal
+    db = SessionLocal()
+    try:
+        refresh_fwa_watershed_attributes(db, watershed_group_code=args.group, refresh=args.refresh)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,151 @@
+"""
+Background watershed delineation jobs.
+
+Delineating a large watershed from a DEM can take tens of seconds.  Instead of holding an API
+worker for that time, `submit_watershed_job` records a job in the watershed_delineation_job table
+and runs `calculate_watershed` on a small thread pool in the API process.  The job row is updated
+as the delineation moves through its stages, so any API process can report progress
+(`get_watershed_job`).  The result is stored like any other generated watershed
+(generated_watershed and watershed_cache).
+
+Each process runs at most WATERSHED_JOB_WORKERS delineations at once and queues at most
+WATERSHED_JOB_QUEUE_SIZE more; further jobs are refused until the queue drains.
+"""
+import json
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from shapely.geometry import Point
+from sqlalchemy.orm import Session
+
+from api.config import WATERSHED_JOB_WORKERS, WATERSHED_JOB_QUEUE_SIZE
+from api.db.session import Session as SessionLocal
+from api.v1.watersheds.controller import calculate_watershed, get_cached_watershed
+from api.v1.watersheds.schema import WatershedJob
+
+logger = logging.getLogger('WATERSHEDS')
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETE = 'complete'
+JOB_FAILED = 'failed'
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(WATERSHED_JOB_WORKERS + WATERSHED_JOB_QUEUE_SIZE)
+
+
+class JobQueueFull(Exception):
+    """ raised when this process already has the maximum number of queued jobs """
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # created on first use so that each gunicorn worker process gets its own pool.
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=WATERSHED_JOB_WORKERS, thread_name_prefix='watershed_job')
+        return _executor
+
+
+def _update_job(db: Session, job_id: str, **values):
+    assignments = ", ".join(f"{column} = :{column}" for column in values)
+    db.execute(
+        f"update watershed_delineation_job set {assignments}, update_date = now() where job_id = :job_id",
+        {"job_id": job_id, **values})
+    db.commit()
+
+
+def _run_job(job_id: str, user, point: Point, upstream_method: str, dem_source: str):
+    db = SessionLocal()
+    try:
+        _update_job(db, job_id, status=JOB_RUNNING)
+
+        def progress(stage: str):
+            _update_job(db, job_id, stage=stage)
+
+        watershed = calculate_watershed(
+            db, user, point, upstream_method=upstream_method, dem_source=dem_source, progress=progress)
+
+        if not watershed:
+            raise Exception("unable to delineate a watershed at this point")
+
+        _update_job(db, job_id, status=JOB_COMPLETE, stage=None,
+                    generated_watershed_id=watershed.generated_watershed_id)
+    except Exception as e:
+        logger.exception('watershed delineation job %s failed', job_id)
+        db.rollback()
+        _update_job(db, job_id, status=JOB_FAILED, error=str(e))
+    finally:
+        db.close()
+
+
+def submit_watershed_job(
+        db: Session, user, point: Point, upstream_method: str = 'DEM+FWA', dem_source: str = 'cdem') -> str:
+    """
+    queues a watershed delineation starting at `point` and returns the job ID.
+    Raises JobQueueFull if this process can't take any more jobs.
+    """
+    if not _slots.acquire(blocking=False):
+        raise JobQueueFull()
+
+    try:
+        job_id = str(uuid.uuid4())
+        db.execute(
+            """
+            insert into watershed_delineation_job (job_id, create_user, status, request)
+            values (:job_id, :create_user, :status, CAST(:request AS jsonb))
+            """,
+            {
+                "job_id": job_id,
+                "create_user": user.user_uuid if user else None,
+                "status": JOB_QUEUED,
+                "request": json.dumps({
+                    "point": [point.x, point.y],
+                    "upstream_method": upstream_method,
+                    "dem_source": dem_source
+                })
+            })
+        db.commit()
+
+        future = _get_executor().submit(_run_job, job_id, user, point, upstream_method, dem_source)
+    except Exception:
+        _slots.release()
+        raise
+
+    future.add_done_callback(lambda _: _slots.release())
+    return job_id
+
+
+def get_watershed_job(db: Session, job_id: str, include_result: bool = True) -> Optional[WatershedJob]:
+    """
+    returns the status of a job, or None if there is no job with `job_id`.
+    Once the job is complete, the watershed is included (if it is still cached).
+    """
+    q = """
+        select  job_id, status, stage, error, generated_watershed_id
+        from    watershed_delineation_job
+        where   job_id = :job_id
+    """
+    row = db.execute(q, {"job_id": job_id}).fetchone()
+    # end the transaction so that repeated polling sees updates from the job thread.
+    db.commit()
+
+    if not row:
+        return None
+
+    result = None
+    if include_result and row['status'] == JOB_COMPLETE and row['generated_watershed_id']:
+        result = get_cached_watershed(db, row['generated_watershed_id'])
+
+    return WatershedJob(
+        job_id=str(row['job_id']),
+        status=row['status'],
+        stage=row['stage'],
+        error=row['error'],
+        generated_watershed_id=row['generated_watershed_id'],
+        result=result
+    )
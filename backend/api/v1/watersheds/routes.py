@@ -2,16 +2,22 @@
 Endpoints for returning statistics about watersheds
 """
 from logging import getLogger
+import asyncio
 import datetime
 import json
+from uuid import UUID
 from fastapi import APIRouter, Depends, HTTPException, Query, Path
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
 from shapely.geometry import shape, Point
 from urllib.parse import unquote
 
 from api.db.utils import get_db
+from api.db.session import Session as SessionLocal
+from api.utils.task_graph import TaskGraph
 from api.v1.watersheds.controller import (
     export_summary_as_zipped_shp,
     get_watershed_details,
@@ -28,19 +34,27 @@ from api.v1.watersheds.controller import (
 )
 from api.v1.hydat.controller import (get_stations_in_area)
 from api.v1.watersheds.schema import (
-    GeneratedWatershedDetails
+    GeneratedWatershedDetails,
+    WatershedJob,
+    WatershedBatchRequest
 )
+from api.v1.watersheds.batch import stream_batch
+from api.v1.watersheds.jobs import submit_watershed_job, get_watershed_job, JobQueueFull
 from api.v1.models.isolines.controller import calculate_runoff_in_area
 from api.v1.models.scsb2016.controller import get_hydrological_zone, calculate_mean_annual_runoff, model_output_as_dict
 from api.v1.user.db_models import User
 from api.v1.user.session import get_user
-from api.config import WATERSHED_DEBUG
+from api.config import WATERSHED_DEBUG, WATERSHED_BATCH_MAX_ITEMS
 
 
 logger = getLogger("aggregator")
 
 router = APIRouter()
 
+# watershed job events are polled from the database every second, for up to 10 minutes.
+JOB_EVENTS_POLL_INTERVAL = 1
+JOB_EVENTS_MAX_POLLS = 600
+
 watershed_feature_description = """
     Watershed features follow the format <dataset>.<id>. Dataset is either
     the DataBC dataset code or 'calculated' for Wally generated watersheds.
@@ -109,6 +123,107 @@ def get_watersheds(
         db, user, point, upstream_method=upstream_method)
 
 
+@router.post('/batch')
+def delineate_watershed_batch(
+    req: WatershedBatchRequest,
+    user: User = Depends(get_user)
+):
+    """ delineates watersheds for a list of points, HYDAT station numbers or FWA watershed IDs.
+    Items are delineated in parallel by a pool of worker processes, and each result is streamed
+    back as a line of JSON (application/x-ndjson) as soon as it is ready, so results arrive out of order.
+    Each line has the item's `id` (or its index in the list), and either `watershed` or `error`.
+    """
+    if not req.items:
+        raise HTTPException(status_code=400, detail="No items to delineate")
+
+    if len(req.items) > WATERSHED_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400, detail=f"Batches are limited to {WATERSHED_BATCH_MAX_ITEMS} items")
+
+    user_uuid = str(user.user_uuid) if getattr(user, 'user_uuid', None) else None
+
+    return StreamingResponse(
+        stream_batch(req.items, req.upstream_method, req.dem_source, user_uuid),
+        media_type="application/x-ndjson")
+
+
+@router.post('/jobs', response_model=WatershedJob, status_code=202)
+def create_watershed_job(
+    db: Session = Depends(get_db),
+    user: User = Depends(get_user),
+    point: str = Query(
+        "", title="Search point",
+        description="Point to search within"),
+    upstream_method: str = Query(
+        "DEM+FWA", title="Upstream catchment estimation method",
+        description="Method for estimating upstream catchment area. See watersheds/controller.py"
+    )
+):
+    """ starts delineating the watershed at this point in the background and returns a job.
+    Use GET /watersheds/jobs/{job_id} (or /events) to follow progress.
+    """
+    if not point:
+        raise HTTPException(
+            status_code=400, detail="No search point. Supply a `point` (geojson geometry)")
+
+    point = Point(json.loads(point))
+    upstream_method = unquote(upstream_method)
+
+    try:
+        job_id = submit_watershed_job(db, user, point, upstream_method=upstream_method)
+    except JobQueueFull:
+        raise HTTPException(
+            status_code=503, detail="Too many watersheds are being delineated. Please try again shortly.")
+
+    return get_watershed_job(db, job_id)
+
+
+@router.get('/jobs/{job_id}', response_model=WatershedJob)
+def watershed_job(
+    db: Session = Depends(get_db),
+    job_id: UUID = Path(..., title="The ID of a watershed delineation job")
+):
+    """ returns the status (and stage) of a watershed delineation job,
+    and the watershed once the job is complete. """
+    job = get_watershed_job(db, str(job_id))
+    if not job:
+        raise HTTPException(status_code=404, detail="Watershed job not found")
+    return job
+
+
+@router.get('/jobs/{job_id}/events')
+async def watershed_job_events(
+    job_id: UUID = Path(..., title="The ID of a watershed delineation job")
+):
+    """ streams the progress of a watershed delineation job as server-sent events.
+    A `progress` event is sent when the status or stage changes, and a final `complete`
+    or `failed` event includes the watershed or error. """
+
+    def poll():
+        db = SessionLocal()
+        try:
+            return get_watershed_job(db, str(job_id))
+        finally:
+            db.close()
+
+    async def events():
+        last = None
+        for _ in range(JOB_EVENTS_MAX_POLLS):
+            job = await run_in_threadpool(poll)
+            if not job:
+                yield "event: failed\ndata: {\"error\": \"Watershed job not found\"}\n\n"
+                return
+            if job.status in ('complete', 'failed'):
+                yield f"event: {job.status}\ndata: {job.json()}\n\n"
+                return
+            if (job.status, job.stage) != last:
+                last = (job.status, job.stage)
+                yield f"event: progress\ndata: {job.json()}\n\n"
+            await asyncio.sleep(JOB_EVENTS_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 @router.get('/{watershed_feature}')
 def watershed_stats(
     db: Session = Depends(get_db),
@@ -137,27 +252,43 @@ def watershed_stats(
     watershed = watershed_data.watershed
     watershed_poly = shape(watershed.geometry)
 
-    watershed_details = get_watershed_details(db, watershed)
-    wd = watershed_details  # purely for shorthand below
+    # the model inputs, isoline runoff, model input stats and hydrometric stations are
+    # independent, so they are gathered concurrently. The SCSB model runs once its inputs are ready.
+    # get_watershed_details runs a task graph of its own, so it uses the request session (which
+    # nothing else uses until the graph is finished) instead of holding a task session.
+    graph = TaskGraph()
+    graph.add('watershed_details', lambda: get_watershed_details(
+        db, watershed, fwa_watershed_id=watershed_data.fwa_watershed_id), required=True)
 
     # isoline model outputs
-    isoline_runoff_model = calculate_runoff_in_area(db, watershed_poly)
+    graph.add('isoline_runoff_model', lambda db: calculate_runoff_in_area(db, watershed_poly),
+              db=True, timeout=60, default={'runoff': 0, 'area': 0})
 
     # custom linear mad model outputs
-    scsb2016_model = calculate_mean_annual_runoff(
-        db, wd["hydrological_zone"],
-        wd["median_elevation"],
-        wd["glacial_coverage"],
-        wd["annual_precipitation"],
-        wd["potential_evapotranspiration"],
-        wd["drainage_area"],
-        wd["solar_exposure"],
-        wd["average_slope"])
-
-    scsb2016_input_stats = get_scsb2016_input_stats(db)
+    graph.add('scsb2016_model', lambda db, watershed_details: calculate_mean_annual_runoff(
+        db, watershed_details["hydrological_zone"],
+        watershed_details["median_elevation"],
+        watershed_details["glacial_coverage"],
+        watershed_details["annual_precipitation"],
+        watershed_details["potential_evapotranspiration"],
+        watershed_details["drainage_area"],
+        watershed_details["solar_exposure"],
+        watershed_details["average_slope"]),
+        deps=['watershed_details'], db=True, timeout=30,
+        default={"error": "Unable to calculate scsb2016 model."})
+
+    graph.add('scsb2016_input_stats', get_scsb2016_input_stats, db=True, timeout=30, default=[])
 
     # hydro stations from federal source
-    hydrometric_stations = get_stations_in_area(db, shape(watershed.geometry))
+    graph.add('hydrometric_stations', lambda db: get_stations_in_area(db, watershed_poly),
+              db=True, timeout=30, default=[])
+
+    results = graph.run()
+    watershed_details = results['watershed_details']
+    isoline_runoff_model = results['isoline_runoff_model']
+    scsb2016_model = results['scsb2016_model']
+    scsb2016_input_stats = results['scsb2016_input_stats']
+    hydrometric_stations = results['hydrometric_stations']
 
     data = {
         "watershed_name": watershed.properties.get("name", None),
@@ -96,3 +96,32 @@ class GeneratedWatershedDetails(BaseModel):
 
     class Config:
         arbitrary_types_allowed = True
+
+
+class WatershedJob(BaseModel):
+    """ a watershed delineation running in the background """
+    job_id: str
+    status: str
+    stage: Optional[str]
+    error: Optional[str]
+    generated_watershed_id: Optional[int]
+    result: Optional[GeneratedWatershedDetails]
+
+    class Config:
+        arbitrary_types_allowed = True
+
+
+class WatershedBatchItem(BaseModel):
+    """ a point of interest in a batch delineation.
+    Provide one of `point` ([long, lat]), `hydat_station_number` or `watershed_id`. """
+    id: Optional[str]
+    point: Optional[List[float]]
+    hydat_station_number: Optional[str]
+    watershed_id: Optional[int]
+
+
+class WatershedBatchRequest(BaseModel):
+    """ a list of points of interest to delineate watersheds for """
+    items: List[WatershedBatchItem]
+    upstream_method: str = 'DEM+FWA'
+    dem_source: str = 'cdem'
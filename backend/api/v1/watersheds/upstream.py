@@ -0,0 +1,185 @@
+"""
+The set of Freshwater Atlas fundamental watershed polygons upstream of a watershed polygon.
+"""
+import logging
+from typing import List, Optional
+from shapely import wkb
+from sqlalchemy.orm import Session
+
+from api.config import RASTER_FILE_DIR
+from api.v1.watersheds import CDEM_FILE
+
+logger = logging.getLogger('WATERSHEDS')
+
+
+# selects the fundamental watersheds upstream of the polygon with :watershed_feature_id, using the
+# watershed code (wscode_ltree) and local watershed code (localcode_ltree).
+# See https://www2.gov.bc.ca/assets/gov/data/geographic/topography/fwa/fwa_user_guide.pdf
+UPSTREAM_WATERSHEDS_QUERY = """
+    with subwscode_ltree as (
+        SELECT  "WATERSHED_FEATURE_ID" as origin_id,
+                wscode_ltree as origin_wscode,
+                localcode_ltree as origin_localcode,
+                ltree2text(subpath(localcode_ltree, -1))::integer as downstream_tributary,
+                nlevel(localcode_ltree) as downstream_tributary_code_pos
+        FROM    freshwater_atlas_watersheds
+        WHERE   "WATERSHED_FEATURE_ID" = :watershed_feature_id
+    )
+    SELECT  array_agg("WATERSHED_FEATURE_ID") as ids,
+            coalesce(sum("FEATURE_AREA_SQM"), 0) as area_sqm
+    FROM    freshwater_atlas_watersheds
+    WHERE   wscode_ltree <@ (select origin_wscode from subwscode_ltree)
+    AND     ltree2text(subltree(
+                localcode_ltree || '000000'::ltree,
+                (select downstream_tributary_code_pos from subwscode_ltree) - 1,
+                (select downstream_tributary_code_pos from subwscode_ltree) - 0
+            ))::integer >= (select downstream_tributary from subwscode_ltree)
+    AND (NOT wscode_ltree <@ (select origin_localcode from subwscode_ltree) OR (select origin_wscode from subwscode_ltree) = (select origin_localcode from subwscode_ltree))
+"""
+
+# dissolves the upstream polygons (:ids, from UPSTREAM_WATERSHEDS_QUERY) into one geometry.
+# Tributaries that join the origin stream upstream of the origin polygon are entirely upstream,
+# so the large ones are taken whole from fwa_watershed_code_dissolved (already unioned) and only
+# the polygons that aren't part of one of those tributaries are unioned here.
+UPSTREAM_GEOMETRY_QUERY = """
+    with origin as (
+        SELECT  wscode_ltree as origin_wscode,
+                localcode_ltree as origin_localcode,
+                ltree2text(subpath(localcode_ltree, -1))::integer as downstream_tributary,
+                nlevel(localcode_ltree) as downstream_tributary_code_pos
+        FROM    freshwater_atlas_watersheds
+        WHERE   "WATERSHED_FEATURE_ID" = :watershed_feature_id
+    ),
+    tributaries as (
+        SELECT  d.wscode_ltree, d.geom
+        FROM    fwa_watershed_code_dissolved d, origin o
+        WHERE   d.wscode_ltree <@ o.origin_wscode
+        AND     nlevel(d.wscode_ltree) = o.downstream_tributary_code_pos
+        AND     ltree2text(subpath(d.wscode_ltree, o.downstream_tributary_code_pos - 1, 1))::integer
+                    >= o.downstream_tributary
+        AND     (NOT d.wscode_ltree <@ o.origin_localcode OR o.origin_wscode = o.origin_localcode)
+    ),
+    remainder as (
+        SELECT  w."GEOMETRY" as geom
+        FROM    freshwater_atlas_watersheds w
+        WHERE   w."WATERSHED_FEATURE_ID" = ANY(:ids)
+        AND     NOT EXISTS (
+            SELECT 1 FROM tributaries t WHERE w.wscode_ltree <@ t.wscode_ltree
+        )
+    )
+    SELECT  ST_Union(geom) as geom
+    FROM    (
+        SELECT geom FROM tributaries
+        UNION ALL
+        SELECT geom FROM remainder
+    ) pieces
+"""
+
+
+class UpstreamWatershedSet:
+    """
+    Looks up the IDs of the fundamental watershed polygons upstream of `watershed_feature_id`
+    (including the polygon itself) once, and answers questions about the upstream area
+    (border crossings, polygon count, area and the dissolved geometry) from that set of IDs
+    instead of repeating the ltree upstream query for each one.
+
+    Create one per request and pass it to the functions that need it. Results are
+    cached on the instance.
+    """
+
+    def __init__(self, db: Session, watershed_feature_id: int):
+        self.db = db
+        self.watershed_feature_id = watershed_feature_id
+
+        self._ids = None
+        self._area_sqm = None
+        self._border_crossings = None
+        self._geometry = None
+        self._dem_file = None
+
+    def _load(self):
+        res = self.db.execute(UPSTREAM_WATERSHEDS_QUERY, {"watershed_feature_id": self.watershed_feature_id})
+        record = res.fetchone()
+
+        self._ids = list(record['ids'] or []) if record else []
+        self._area_sqm = float(record['area_sqm']) if record else 0
+
+    @property
+    def ids(self) -> List[int]:
+        """ the WATERSHED_FEATURE_IDs of the upstream polygons """
+        if self._ids is None:
+            self._load()
+        return self._ids
+
+    def polygon_count(self) -> int:
+        return len(self.ids)
+
+    def area_sqm(self) -> float:
+        """ the sum of the upstream polygon areas (FEATURE_AREA_SQM) """
+        if self._ids is None:
+            self._load()
+        return self._area_sqm
+
+    def border_crossings(self) -> List[str]:
+        """
+        Returns the borders (from fwa_approx_borders) that the upstream area touches.
+        The list will be empty if no borders were reached.
+        """
+        if self._border_crossings is not None:
+            return self._border_crossings
+
+        if not self.ids:
+            self._border_crossings = []
+            return self._border_crossings
+
+        q = """
+            SELECT  distinct border
+            FROM    fwa_approx_borders b
+            INNER JOIN freshwater_atlas_watersheds w
+            ON      ST_Intersects(b.geom, ST_Transform(w."GEOMETRY", 3005))
+            WHERE   w."WATERSHED_FEATURE_ID" = ANY(:ids)
+        """
+        res = self.db.execute(q, {"ids": self.ids})
+        self._border_crossings = [row['border'] for row in res]
+        return self._border_crossings
+
+    def _load_geometry(self):
+        q = f"""
+            with upstream as (
+                {UPSTREAM_GEOMETRY_QUERY}
+            )
+            SELECT  ST_AsBinary(geom) as geom,
+                    (
+                        select filename
+                        from dem.stream_burned_cdem_tile t
+                        where ST_Within((select geom from upstream), t.geom)
+                        order by resolution asc
+                        limit 1
+                    ) as dem_file
+            FROM    upstream
+        """
+        res = self.db.execute(q, {"watershed_feature_id": self.watershed_feature_id, "ids": self.ids})
+        record = res.fetchone()
+
+        if not record or not record['geom']:
+            logger.warning(
+                'unable to calculate watershed from watershed feature id %s', self.watershed_feature_id)
+            self._geometry = False
+            return
+
+        self._geometry = wkb.loads(record['geom'].tobytes())
+        self._dem_file = f"{RASTER_FILE_DIR}/{record['dem_file']}" if record['dem_file'] else CDEM_FILE
+
+    def geometry(self):
+        """ the dissolved upstream area (EPSG:4326), or None if it couldn't be calculated """
+        if not self.ids:
+            return None
+        if self._geometry is None:
+            self._load_geometry()
+        return self._geometry or None
+
+    def dem_file(self) -> Optional[str]:
+        """ the best available stream-burned DEM file that covers the whole upstream area """
+        if self.geometry() is None:
+            return None
+        return self._dem_file
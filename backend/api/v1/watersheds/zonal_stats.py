@@ -0,0 +1,199 @@
+"""
+Zonal statistics for watershed areas, from a single read of the CDEM.
+
+The CDEM terrain statistics used to be three separate PostGIS queries (ST_SummaryStats,
+ST_ValueCount for the median elevation and ST_Slope for the average slope), each clipping
+the same raster tiles again.  `read_cdem_window` clips the dem.cdem tiles to the area once and
+returns the window as a masked NumPy array (cells outside the area are masked), and the
+functions below compute the same statistics the queries returned:
+
+* summary stats: count, sum, mean, population stddev, min and max (like ST_SummaryStats)
+* median elevation: the median of the distinct elevation values, interpolated like
+  percentile_cont(0.5) over ST_ValueCount
+* average slope: the mean of the distinct slope values in percent, using the same 3x3
+  (Horn) kernel as ST_Slope with a scale of 111120 (metres per degree). Like ST_Slope without
+  interpolate_nodata, cells next to a masked cell don't have a slope.
+"""
+import logging
+from typing import Tuple
+import numpy as np
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger('cdem')
+
+# ST_Slope scale for rasters in degrees, with elevation in metres.
+METRES_PER_DEGREE = 111120
+
+# CDEM cell size (12 arc seconds) and the margin read around an area so the cells on its
+# edge have their neighbours (1.5 cells covers the diagonal neighbours too).
+CDEM_CELL_SIZE = 1 / 300
+CDEM_MARGIN = 1.5 * CDEM_CELL_SIZE
+
+
+def read_cdem_window(db: Session, area_4140, table: str = "dem.cdem") -> Tuple[np.ma.MaskedArray, tuple]:
+    """
+    reads the CDEM cells covering `area_4140` (a polygon in EPSG:4140) from the raster
+    `table` in one query.  Returns the elevations as a masked array (masked outside the area
+    or where there is no data) and the window's GDAL-style geotransform.
+    """
+    # only tiles that intersect the area are read (using the index on the tiles' convex hulls).
+    # They are clipped and merged into one raster, and its cells are returned as an array
+    # with NULL for cells outside the area or without data.
+    q = f"""
+        WITH dem_window as (
+            SELECT  ST_Union(ST_Clip(cdem.rast, 1, geom, true)) as rast
+            FROM    {table} as cdem
+            INNER JOIN ST_GeomFromText(:area, 4140) as geom
+            ON      ST_Intersects(cdem.rast, geom)
+        )
+        SELECT  ST_DumpValues(rast, 1, true) as elevation,
+                ST_UpperLeftX(rast) as upper_left_x,
+                ST_UpperLeftY(rast) as upper_left_y,
+                ST_ScaleX(rast) as scale_x,
+                ST_ScaleY(rast) as scale_y
+        FROM    dem_window
+        WHERE   rast IS NOT NULL
+    """
+    row = db.execute(q, {"area": area_4140.wkt}).fetchone()
+    if not row or not row['elevation']:
+        raise Exception("elevation could not be found using CDEM")
+
+    # NULLs become nan
+    data = np.array(row['elevation'], dtype=np.float64)
+    geotransform = (row['upper_left_x'], row['scale_x'], 0, row['upper_left_y'], 0, row['scale_y'])
+    return np.ma.masked_invalid(data), geotransform
+
+
+def read_cdem_window_with_margin(
+        db: Session, area_4140, table: str = "dem.cdem",
+        margin: float = CDEM_MARGIN) -> Tuple[np.ma.MaskedArray, np.ma.MaskedArray, tuple]:
+    """
+    like `read_cdem_window`, but the window also includes the cells within `margin` (degrees)
+    of `area_4140`, so that cells on the edge of the area have all their neighbours for the slope.
+    Returns the elevations of the area (masked outside it), the elevations of the whole window
+    and the window's geotransform.  Both arrays are on the same grid.
+    """
+    # the tiles are clipped to the buffered area and to the area itself; the area's
+    # raster is a sub-window of the buffered one.
+    q = f"""
+        WITH area as (
+            SELECT  ST_GeomFromText(:area, 4140) as geom,
+                    ST_Buffer(ST_GeomFromText(:area, 4140), :margin) as buffered
+        ),
+        dem_window as (
+            SELECT  ST_Union(ST_Clip(cdem.rast, 1, area.buffered, true)) as rast,
+                    ST_Union(ST_Clip(cdem.rast, 1, area.geom, true))
+                        FILTER (WHERE ST_Intersects(cdem.rast, area.geom)) as area_rast
+            FROM    {table} as cdem
+            INNER JOIN area
+            ON      ST_Intersects(cdem.rast, area.buffered)
+        )
+        SELECT  ST_DumpValues(rast, 1, true) as elevation,
+                ST_UpperLeftX(rast) as upper_left_x,
+                ST_UpperLeftY(rast) as upper_left_y,
+                ST_ScaleX(rast) as scale_x,
+                ST_ScaleY(rast) as scale_y,
+                ST_DumpValues(area_rast, 1, true) as area_elevation,
+                ST_UpperLeftX(area_rast) as area_upper_left_x,
+                ST_UpperLeftY(area_rast) as area_upper_left_y
+        FROM    dem_window
+        WHERE   rast IS NOT NULL
+        AND     area_rast IS NOT NULL
+    """
+    row = db.execute(q, {"area": area_4140.wkt, "margin": margin}).fetchone()
+    if not row or not row['elevation'] or not row['area_elevation']:
+        raise Exception("elevation could not be found using CDEM")
+
+    window = np.ma.masked_invalid(np.array(row['elevation'], dtype=np.float64))
+    area_data = np.array(row['area_elevation'], dtype=np.float64)
+    geotransform = (row['upper_left_x'], row['scale_x'], 0, row['upper_left_y'], 0, row['scale_y'])
+
+    # position of the area's raster in the window
+    row_offset = int(round((row['area_upper_left_y'] - row['upper_left_y']) / row['scale_y']))
+    col_offset = int(round((row['area_upper_left_x'] - row['upper_left_x']) / row['scale_x']))
+    in_area = np.zeros(window.shape, dtype=bool)
+    in_area[row_offset:row_offset + area_data.shape[0],
+            col_offset:col_offset + area_data.shape[1]] = ~np.isnan(area_data)
+
+    elevation = np.ma.array(window.data, mask=np.ma.getmaskarray(window) | ~in_area)
+    return elevation, window, geotransform
+
+
+def summary_stats(elevation: np.ma.MaskedArray) -> dict:
+    """ returns the same summary as ST_SummaryStats for the unmasked cells """
+    values = elevation.compressed()
+    if not values.size:
+        raise Exception("elevation stats could not be found using CDEM")
+    return {
+        "count": int(values.size),
+        "sum": float(values.sum()),
+        "mean": float(values.mean()),
+        "stddev": float(values.std()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+    }
+
+
+def median_of_distinct(values: np.ma.MaskedArray) -> float:
+    """
+    returns the median of the distinct unmasked values, interpolating between the two middle
+    values like percentile_cont(0.5) does.
+    """
+    distinct = np.unique(values.compressed())
+    if not distinct.size:
+        raise Exception("median elevation could not be found using CDEM")
+    return float(np.median(distinct))
+
+
+def mean_of_distinct(values: np.ma.MaskedArray) -> float:
+    """ returns the mean of the distinct unmasked values (AVG over ST_ValueCount) """
+    distinct = np.unique(values.compressed())
+    if not distinct.size:
+        raise Exception("mean slope could not be found using CDEM")
+    return float(distinct.mean())
+
+
+def slope_percent(elevation: np.ma.MaskedArray, pixel_width: float, pixel_height: float,
+                  scale: float = METRES_PER_DEGREE) -> np.ma.MaskedArray:
+    """
+    returns the slope of each cell in percent, with the same kernel as ST_Slope:
+
+        dz/dx = ((z3 + 2*z6 + z9) - (z1 + 2*z4 + z7)) / (8 * pixel_width * scale)
+        dz/dy = ((z1 + 2*z2 + z3) - (z7 + 2*z8 + z9)) / (8 * pixel_height * scale)
+        slope = sqrt(dz/dx² + dz/dy²) * 100
+
+    Cells on the edge of the window or next to a masked cell are masked.
+    """
+    z = np.ma.filled(elevation.astype(np.float64), np.nan)
+    rows, cols = z.shape
+    slope = np.full(z.shape, np.nan)
+
+    if rows >= 3 and cols >= 3:
+        def cell(dy, dx):
+            # the neighbour at row offset dy, column offset dx of every interior cell
+            return z[1 + dy:rows - 1 + dy, 1 + dx:cols - 1 + dx]
+
+        width = abs(pixel_width) * scale
+        height = abs(pixel_height) * scale
+
+        dz_dx = ((cell(-1, 1) + 2 * cell(0, 1) + cell(1, 1)) -
+                 (cell(-1, -1) + 2 * cell(0, -1) + cell(1, -1))) / (8 * width)
+        dz_dy = ((cell(-1, -1) + 2 * cell(-1, 0) + cell(-1, 1)) -
+                 (cell(1, -1) + 2 * cell(1, 0) + cell(1, 1))) / (8 * height)
+        slope[1:-1, 1:-1] = np.sqrt(dz_dx ** 2 + dz_dy ** 2) * 100
+
+    # nan propagates from any masked neighbour, like NULL in ST_Slope's callback.
+    return np.ma.masked_invalid(slope)
+
+
+def calculate_terrain_stats(elevation: np.ma.MaskedArray, geotransform: tuple) -> dict:
+    """
+    computes the elevation summary, median elevation and average slope (percent)
+    from one CDEM window (see `read_cdem_window`).
+    """
+    slope = slope_percent(elevation, geotransform[1], geotransform[5])
+    return {
+        "elevation_stats": summary_stats(elevation),
+        "median_elevation": median_of_distinct(elevation),
+        "average_slope": mean_of_distinct(slope),
+    }
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+
+import pytest
+from aiohttp import web
+
+from api.utils import http_client
+from api.v1.aggregator.controller import fetch_geojson_features
+from api.v1.aggregator.schema import ExternalAPIRequest
+
+FEATURES = {
+    "type": "FeatureCollection",
+    "features": [{"type": "Feature", "id": 1, "geometry": {"type": "Point", "coordinates": [-123, 49]},
+                  "properties": {"name": "test"}}]
+}
+
+
+@pytest.fixture
+def server():
+    """ a local GeoJSON API, recording the client port of each request (one port per connection) """
+    ports = []
+
+    async def features(request):
+        ports.append(request.transport.get_extra_info('peername')[1])
+        return web.json_response(FEATURES)
+
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_get('/features', features)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{port}/features", ports
+
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(http_client, '_http_client', None)
+    yield
+    http_client.close_http_client()
+
+
+def test_fetch_geojson_features_reuses_connections(server, client):
+    url, ports = server
+
+    for _ in range(3):
+        results = fetch_geojson_features([ExternalAPIRequest(url=url, layer='test', paginate=False)])
+        assert results[0].status == 200
+        assert len(results[0].geojson.features) == 1
+
+    # the three lookups were made on one kept-alive connection
+    assert len(ports) == 3
+    assert len(set(ports)) == 1
+
+
+def test_http_client_is_per_process(client, monkeypatch):
+    parent = http_client.get_http_client()
+    assert http_client.get_http_client() is parent
+
+    # a forked process gets its own client, and leaves the parent's alone
+    monkeypatch.setattr(http_client.os, 'getpid', lambda: parent.pid + 1)
+    child = http_client.get_http_client()
+    assert child is not parent
+    assert child.pid == parent.pid + 1
+    assert not parent.closed
+
+    monkeypatch.undo()
+    parent.close()
+    child.close()
+    assert parent.closed and child.closed
+
+
+def test_http_client_run_timeout(client):
+    """ run gives up on a coroutine that doesn't finish in time, and cancels it """
+    cancelled = threading.Event()
+
+    async def stuck():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with pytest.raises(TimeoutError):
+        http_client.get_http_client().run(stuck(), timeout=0.1)
+    assert cancelled.wait(5)
@@ -0,0 +1,97 @@
+"""
+Benchmarks predicting zone flows with XGBoost and with the compiled ensemble (compiled.py).
+
+Not collected by pytest. Run it in the backend container:
+
+    python tests/models/benchmark_zone_models.py --rows 1 10 1000
+
+A zone's 13 models (annual and monthly) are trained on random data, with `--estimators`
+trees of `--depth` levels each, like the models in the modelling bucket.  Each backend
+predicts `--rows` watersheds (the compiled ensemble is called directly, whatever the number
+of rows); the median of `--runs` runs is printed per call and per watershed, with the largest
+difference between the two backends' predictions.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from xgboost import XGBRegressor
+
+from api.v1.models.hydrological_zones.compiled import COMPILED_MAX_ROWS, CompiledEnsemble
+from api.v1.models.hydrological_zones.registry import ZoneModel, ZoneModels, load_booster
+from api.v1.models.hydrological_zones.controller import input_matrix, predict_zone_flows
+
+ANNUAL_INPUTS = ['drainage_area', 'annual_precipitation', 'median_elevation']
+MONTHLY_INPUTS = ['drainage_area', 'annual_precipitation', 'median_elevation', 'solar_exposure',
+                  'average_slope', 'glacial_coverage']
+
+
+def train_model(inputs, seed: int, estimators: int, depth: int) -> bytes:
+    rng = np.random.RandomState(seed)
+    x = rng.rand(500, len(inputs))
+    y = x @ rng.rand(len(inputs)) + rng.rand(500) * 0.1
+    xgb = XGBRegressor(n_estimators=estimators, max_depth=depth, random_state=42)
+    xgb.fit(x, y)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model.json')
+        xgb.save_model(path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def timed(fn, runs: int):
+    times = []
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1, 10, 100, 1000], help='watersheds per call')
+    parser.add_argument('--estimators', type=int, default=100)
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    models = [(train_model(ANNUAL_INPUTS, 0, args.estimators, args.depth), ANNUAL_INPUTS)]
+    models += [(train_model(MONTHLY_INPUTS, month, args.estimators, args.depth), MONTHLY_INPUTS)
+               for month in range(1, 13)]
+
+    xgboost_models = ZoneModels(
+        zone=0,
+        annual=ZoneModel(load_booster(models[0][0]), 1.0, ANNUAL_INPUTS),
+        monthly=[ZoneModel(load_booster(content), 1.0, inputs) for content, inputs in models[1:]],
+    )
+    compiled = CompiledEnsemble(models)
+
+    print(f"13 models of {args.estimators} trees, depth {args.depth}, median of {args.runs} runs")
+    print(f"(predict_zone_flows uses the compiled models for up to {COMPILED_MAX_ROWS} rows)\n")
+    rng = np.random.RandomState(1)
+    for n in args.rows:
+        rows = [dict(zip(MONTHLY_INPUTS, values)) for values in rng.rand(n, len(MONTHLY_INPUTS))]
+
+        def xgboost():
+            return np.column_stack(predict_zone_flows(xgboost_models, rows))
+
+        def compiled_ensemble():
+            return compiled.predict(input_matrix(rows, compiled.inputs))
+
+        expected = None
+        for name, fn in (('xgboost', xgboost), ('compiled', compiled_ensemble)):
+            elapsed, flows = timed(fn, args.runs)
+            if expected is None:
+                expected = flows
+            difference = np.abs(flows - expected).max()
+            print(f"{n:>6} rows  {name:<9} {elapsed * 1000:>9.2f} ms  "
+                  f"{elapsed / n * 1e6:>9.1f} µs/watershed   max difference {difference:.2e}")
+
+
+if __name__ == "__main__":
+    main()
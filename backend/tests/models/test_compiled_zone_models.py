@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import pytest
+from xgboost import XGBRegressor
+
+from api.v1.models.hydrological_zones.compiled import CompiledEnsemble
+
+
+def train_model(n_inputs: int, seed: int, missing: bool = False, **params) -> XGBRegressor:
+    """ a model trained on random data.  With `missing`, some of the training values are NaN. """
+    rng = np.random.RandomState(seed)
+    x = rng.rand(200, n_inputs) * 1000
+    y = x.sum(axis=1) * rng.rand() + rng.rand(200) * 100
+    if missing:
+        x[rng.rand(*x.shape) < 0.2] = np.nan
+    xgb = XGBRegressor(random_state=42, **params)
+    xgb.fit(x, y)
+    return xgb
+
+
+def model_json(xgb: XGBRegressor) -> bytes:
+    """ the model saved as json, the way the zone models are stored in Minio """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model.json')
+        xgb.save_model(path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def random_rows(n, n_inputs, seed, missing=False):
+    rng = np.random.RandomState(seed)
+    rows = rng.rand(n, n_inputs) * 1200 - 100
+    if missing:
+        rows[rng.rand(*rows.shape) < 0.2] = np.nan
+    return rows
+
+
+@pytest.mark.parametrize('params', [
+    dict(n_estimators=1, max_depth=1),
+    dict(n_estimators=10, max_depth=3),
+    dict(n_estimators=100, max_depth=6, learning_rate=0.1),
+    dict(n_estimators=50, max_depth=8, min_child_weight=5),
+])
+@pytest.mark.parametrize('missing', [False, True])
+def test_compiled_matches_xgboost(params, missing):
+    xgb = train_model(3, seed=1, missing=missing, **params)
+    ensemble = CompiledEnsemble([(model_json(xgb), ['a', 'b', 'c'])])
+
+    rows = random_rows(500, 3, seed=2, missing=missing)
+    assert np.allclose(ensemble.predict(rows)[:, 0], xgb.predict(rows), rtol=1e-5, atol=1e-3)
+
+
+def test_compiled_zone_ensemble_matches_each_model():
+    # models with different inputs, like a zone's annual and monthly models
+    inputs = [['drainage_area', 'annual_precipitation'], ['median_elevation', 'drainage_area', 'solar_exposure'],
+              ['annual_precipitation']]
+    models = [train_model(len(names), seed=i, n_estimators=20, max_depth=4) for i, names in enumerate(inputs)]
+    ensemble = CompiledEnsemble([(json.loads(model_json(m)), names) for m, names in zip(models, inputs)])
+
+    assert len(ensemble) == 3
+    assert set(ensemble.inputs) == {'drainage_area', 'annual_precipitation', 'median_elevation', 'solar_exposure'}
+
+    rows = random_rows(100, len(ensemble.inputs), seed=3)
+    predictions = ensemble.predict(rows)
+    assert predictions.shape == (100, 3)
+    for i, (model, names) in enumerate(zip(models, inputs)):
+        columns = [ensemble.inputs.index(name) for name in names]
+        assert np.allclose(predictions[:, i], model.predict(rows[:, columns]), rtol=1e-5, atol=1e-3)
+
+
+def test_compiled_rejects_other_objectives():
+    rng = np.random.RandomState(0)
+    xgb = XGBRegressor(n_estimators=2, objective='count:poisson')
+    xgb.fit(rng.rand(50, 2), rng.randint(0, 5, 50))
+    with pytest.raises(ValueError):
+        CompiledEnsemble([(model_json(xgb), ['a', 'b'])])
+
+
+def test_registry_compiles_zone_models():
+    from api.v1.models.hydrological_zones.controller import input_matrix, predict_zone_flows
+    from api.v1.models.hydrological_zones.registry import ModelRegistry
+    from tests.models.test_hydrological_zone_models import FakeMinio, zone_objects
+
+    objects = zone_objects(27)
+    zone_models = ModelRegistry(client=FakeMinio(objects), compile_models=True).get_zone_models(27)
+    assert zone_models.compiled is not None and len(zone_models.compiled) == 13
+
+    rng = np.random.RandomState(0)
+    rows = [dict(drainage_area=a, annual_precipitation=p, median_elevation=e, solar_exposure=s)
+            for a, p, e, s in rng.rand(20, 4)]
+
+    annual, monthly = predict_zone_flows(zone_models, rows)
+    assert np.allclose(annual, zone_models.annual.predict(input_matrix(rows, zone_models.annual.inputs)),
+                       rtol=1e-5, atol=1e-5)
+    for month, model in enumerate(zone_models.monthly):
+        assert np.allclose(monthly[:, month], model.predict(input_matrix(rows, model.inputs)), rtol=1e-5, atol=1e-5)
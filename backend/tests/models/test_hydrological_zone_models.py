@@ -0,0 +1,168 @@
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+from xgboost import XGBRegressor
+
+from api.v1.models.hydrological_zones.registry import (
+    ModelRegistry, V2_ANNUAL_FLOW_BUCKET, V2_MONTHLY_DISTRIBUTIONS_BUCKET
+)
+
+
+class FakeStat:
+    def __init__(self, etag):
+        self.etag = etag
+
+
+class FakeResponse(io.BytesIO):
+    def release_conn(self):
+        pass
+
+
+class FakeMinio:
+    """ serves objects from a dict of {path: (etag, content)}, counting downloads """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = 0
+
+    def stat_object(self, bucket, path):
+        return FakeStat(self.objects[path][0])
+
+    def get_object(self, bucket, path):
+        self.downloads += 1
+        return FakeResponse(self.objects[path][1])
+
+
+def train_model(inputs: int, seed: int) -> bytes:
+    """ a small model trained on random data, saved as json """
+    rng = np.random.RandomState(seed)
+    xgb = XGBRegressor(n_estimators=5, max_depth=3, random_state=42)
+    xgb.fit(rng.rand(50, inputs), rng.rand(50))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model.json')
+        xgb.save_model(path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def zone_objects(zone, seed=0):
+    annual_inputs = ['drainage_area', 'annual_precipitation']
+    monthly_inputs = ['drainage_area', 'median_elevation', 'solar_exposure']
+    objects = {
+        V2_ANNUAL_FLOW_BUCKET + 'annual_model_scores.json': (
+            'scores', json.dumps({str(zone): {'score': 0.9, 'best_inputs': annual_inputs}}).encode()),
+        V2_ANNUAL_FLOW_BUCKET + f'zone_{zone}.json': ('annual', train_model(len(annual_inputs), seed)),
+        V2_MONTHLY_DISTRIBUTIONS_BUCKET + f'zone_{zone}/monthly_model_scores.json': ('monthly_scores', json.dumps({
+            str(month): {'score': 0.5, 'best_inputs': monthly_inputs} for month in range(1, 13)
+        }).encode()),
+    }
+    for month in range(1, 13):
+        objects[V2_MONTHLY_DISTRIBUTIONS_BUCKET + f'zone_{zone}/{month}.json'] = (
+            f'month{month}', train_model(len(monthly_inputs), seed + month))
+    return objects
+
+
+def test_model_registry_loads_once():
+    client = FakeMinio(zone_objects(27))
+    registry = ModelRegistry(client=client, ttl=0)
+
+    zone_models = registry.get_zone_models(27)
+    assert client.downloads == 15
+    assert zone_models.annual.score == 0.9
+    assert zone_models.annual.inputs == ['drainage_area', 'annual_precipitation']
+    assert len(zone_models.monthly) == 12
+
+    # the etags haven't changed, so nothing is downloaded again
+    assert registry.get_zone_models(27) is zone_models
+    assert client.downloads == 15
+
+    rows = np.array([[100.0, 1200.0], [20.0, 800.0]])
+    expected = XGBRegressor()
+    expected.load_model(bytearray(client.objects[V2_ANNUAL_FLOW_BUCKET + 'zone_27.json'][1]))
+    assert np.allclose(zone_models.annual.predict(rows), expected.predict(rows))
+
+
+def test_model_registry_reloads_changed_objects():
+    client = FakeMinio(zone_objects(27))
+    registry = ModelRegistry(client=client, ttl=0)
+    zone_models = registry.get_zone_models(27)
+
+    path = V2_ANNUAL_FLOW_BUCKET + 'zone_27.json'
+    client.objects[path] = ('annual2', train_model(2, 100))
+
+    reloaded = registry.get_zone_models(27)
+    assert client.downloads == 16
+    assert reloaded is not zone_models
+    assert reloaded.annual.model is not zone_models.annual.model
+    assert reloaded.monthly[0].model is zone_models.monthly[0].model
+
+
+def test_batch_prediction_matches_single_predictions(monkeypatch):
+    from api.v1.models.hydrological_zones import controller
+    from api.v1.models.hydrological_zones.schema import HydroZoneModelBatchItem, HydroZoneModelInputs
+
+    objects = zone_objects(25, seed=1)
+    objects.update({k: v for k, v in zone_objects(26, seed=2).items() if 'annual_model_scores' not in k})
+    scores_path = V2_ANNUAL_FLOW_BUCKET + 'annual_model_scores.json'
+    objects[scores_path] = ('scores', json.dumps({
+        str(zone): {'score': 0.9, 'best_inputs': ['drainage_area', 'annual_precipitation']} for zone in (25, 26)
+    }).encode())
+    registry = ModelRegistry(client=FakeMinio(objects))
+    monkeypatch.setattr(controller, 'get_model_registry', lambda: registry)
+
+    rng = np.random.RandomState(0)
+    items = [
+        HydroZoneModelBatchItem(
+            id=str(i), hydrological_zone=(25, 26, 99)[i % 3], drainage_area=rng.rand(),
+            annual_precipitation=rng.rand(), median_elevation=rng.rand(), solar_exposure=rng.rand())
+        for i in range(9)
+    ]
+    response = controller.predict_hydrological_zone_models(items)
+
+    assert [result.id for result in response.results] == [str(i) for i in range(9)]
+    assert set(response.scores) == {25, 26}
+    for item, result in zip(items, response.results):
+        if item.hydrological_zone == 99:
+            assert result.error and result.mean_annual_flow is None
+            continue
+        single = controller.get_hydrological_zone_model_v2(
+            HydroZoneModelInputs(**item.dict(exclude={'id'})))
+        assert np.isclose(result.mean_annual_flow, single['mean_annual_flow'].mean_annual_flow)
+        assert np.allclose(result.mean_monthly_flows,
+                           [flow.mean_monthly_flow for flow in single['mean_monthly_flows']])
+
+
+def test_missing_inputs_are_not_predicted(monkeypatch):
+    import pytest
+    from fastapi import HTTPException
+    from api.v1.models.hydrological_zones import controller
+    from api.v1.models.hydrological_zones.schema import HydroZoneModelBatchItem, HydroZoneModelInputs
+
+    registry = ModelRegistry(client=FakeMinio(zone_objects(25)))
+    monkeypatch.setattr(controller, 'get_model_registry', lambda: registry)
+
+    inputs = dict(hydrological_zone=25, drainage_area=0.5, annual_precipitation=0.5,
+                  median_elevation=0.5, solar_exposure=0.5)
+    missing = dict(inputs, solar_exposure=None)
+
+    # the monthly models use solar_exposure
+    with pytest.raises(HTTPException) as e:
+        controller.get_hydrological_zone_model_v2(HydroZoneModelInputs(**missing))
+    assert e.value.status_code == 400
+    assert 'solar_exposure' in e.value.detail
+
+    response = controller.predict_hydrological_zone_models([
+        HydroZoneModelBatchItem(id='a', **inputs),
+        HydroZoneModelBatchItem(id='b', **missing),
+        HydroZoneModelBatchItem(id='c', **dict(inputs, drainage_area=float('nan'))),
+    ])
+    a, b, c = response.results
+    assert a.error is None and a.mean_annual_flow is not None
+    assert b.error == 'missing model inputs: solar_exposure' and b.mean_annual_flow is None
+    assert c.error == 'missing model inputs: drainage_area' and c.mean_monthly_flows is None
+
+    with pytest.raises(ValueError):
+        controller.input_matrix([missing], ['drainage_area', 'solar_exposure'])
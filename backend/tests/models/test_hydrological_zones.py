@@ -0,0 +1,36 @@
+from shapely.geometry import Point, box
+
+from api.v1.models.scsb2016.hydrological_zones import HydrologicalZoneIndex
+
+
+def make_index():
+    # two zones side by side, and a zone with a hole (filled by zone 4)
+    outer = box(0, 2, 3, 5).difference(box(1, 3, 2, 4))
+    return HydrologicalZoneIndex([
+        (25, box(0, 0, 1, 1)),
+        (26, box(1, 0, 2, 1)),
+        (27, outer),
+        (4, box(1, 3, 2, 4)),
+    ])
+
+
+def test_lookup():
+    index = make_index()
+
+    assert index.lookup(Point(0.5, 0.5)) == 25
+    assert index.lookup(Point(1.5, 0.5)) == 26
+    assert index.lookup(Point(0.5, 2.5)) == 27
+    assert index.lookup(Point(1.5, 3.5)) == 4
+    assert index.lookup(Point(10, 10)) is None
+
+    # on the border between 25 and 26, the first zone wins
+    assert index.lookup(Point(1, 0.5)) == 25
+
+
+def test_lookup_many_matches_lookup():
+    index = make_index()
+    xs = [0.5, 1.5, 0.5, 1.5, 10, 1, 2.5]
+    ys = [0.5, 0.5, 2.5, 3.5, 10, 0.5, 4.5]
+
+    assert index.lookup_many(xs, ys) == [index.lookup(Point(x, y)) for x, y in zip(xs, ys)]
+    assert index.lookup_many([], []) == []
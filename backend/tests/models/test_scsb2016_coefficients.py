@@ -0,0 +1,108 @@
+import json
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from api.v1.models.scsb2016 import coefficients
+from api.v1.models.scsb2016.controller import calculate_mean_annual_runoff, calculate_mean_annual_runoff_many
+
+
+class FixtureDB:
+    """ returns the mad_model_coefficients fixture rows for any query, counting queries """
+
+    def __init__(self):
+        with open('./fixtures/models/mad_model_coefficients.json') as f:
+            self.rows = json.load(f)
+        self.queries = 0
+
+    def execute(self, q, params=None):
+        self.queries += 1
+        return list(self.rows)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(coefficients, '_zones', {})
+    monkeypatch.setattr(coefficients, '_next_load', 0.0)
+    return FixtureDB()
+
+
+# Stawamus River, Mashiter Creek and Slesse Creek (zone 26, see test_scsb2016.py)
+WATERSHEDS = [
+    [953, 0, 3292, 668, 51, 0.57, 26],
+    [1096, 0, 3304, 666, 42, 0.67, 19],
+    [1320, 0, 2229, 648, 165, 0.66, 31],
+]
+
+
+def test_evaluate_matches_exact(db):
+    zone = coefficients.get_zone_coefficients(db, 26)
+    assert zone.output_types[:3] == ['MAR', '7Q2', 'S-7Q10']
+
+    results = zone.evaluate(np.array(WATERSHEDS))
+    assert results.shape == (3, 15)
+    for watershed, row in zip(WATERSHEDS, results):
+        assert np.allclose(row, [float(v) for v in zone.evaluate_exact(watershed)])
+
+    # MAR
+    assert 77 < results[0, 0] < 79
+    assert 77 < results[1, 0] < 79
+    assert 49 < results[2, 0] < 50
+
+    # the table is only read once
+    coefficients.get_zone_coefficients(db, 25)
+    assert db.queries == 1
+
+
+def test_calculate_many_matches_single(db):
+    zones = [26, 26, 99, 26]
+    many = calculate_mean_annual_runoff_many(db, zones, WATERSHEDS[:2] + [WATERSHEDS[0], WATERSHEDS[2]])
+
+    assert many[2] == {"error": "Selection point not within supported hydrological zone."}
+    for outputs, watershed in zip([many[0], many[1], many[3]], WATERSHEDS):
+        single = calculate_mean_annual_runoff(db, 26, *watershed)
+        exact = calculate_mean_annual_runoff(db, 26, *[Decimal(v) for v in watershed], exact=True)
+        assert [o['output_type'] for o in outputs] == [o['output_type'] for o in single]
+        assert isinstance(exact[0]['model_result'], Decimal)
+        assert np.allclose([o['model_result'] for o in outputs], [o['model_result'] for o in single])
+        assert np.allclose([o['model_result'] for o in outputs], [float(o['model_result']) for o in exact])
+
+
+def test_float_outputs_serialize_like_exact(db):
+    """ the API returns the same JSON for the float outputs as for the Decimal (exact) ones """
+    from fastapi.encoders import jsonable_encoder
+    from api.v1.models.scsb2016.controller import model_output_as_dict
+
+    watershed = WATERSHEDS[0]
+    outputs = calculate_mean_annual_runoff(db, 26, *watershed)
+    exact = calculate_mean_annual_runoff(db, 26, *[Decimal(v) for v in watershed], exact=True)
+
+    encoded, encoded_exact = jsonable_encoder(outputs), jsonable_encoder(exact)
+    for output, output_exact in zip(encoded, encoded_exact):
+        assert type(output['model_result']) is type(output_exact['model_result']) is float
+        assert np.isclose(output['model_result'], output_exact['model_result'])
+
+    summary, summary_exact = model_output_as_dict(outputs), model_output_as_dict(exact)
+    assert summary.keys() == summary_exact.keys()
+    assert sorted(summary['monthly_discharge']) == list(range(1, 13))
+    assert np.isclose(summary['mar']['model_result'], float(summary_exact['mar']['model_result']))
+
+
+def test_null_coefficients_are_an_error(db):
+    """ a zone with a NULL coefficient isn't evaluated (NULL isn't treated as 0) """
+    for row in db.rows:
+        if row['hydrologic_zone_id'] == 26 and row['model_output_type'] == 'MAR':
+            row['drainage_area_co'] = None
+
+    zone = coefficients.get_zone_coefficients(db, 26)
+    assert zone.error == "Missing scsb2016 model coefficients: drainage_area_co"
+    with pytest.raises(ValueError):
+        zone.evaluate(np.array(WATERSHEDS))
+    with pytest.raises(ValueError):
+        zone.evaluate_exact(WATERSHEDS[0])
+
+    assert calculate_mean_annual_runoff(db, 26, *WATERSHEDS[0]) == {"error": zone.error}
+    many = calculate_mean_annual_runoff_many(db, [26, 25], WATERSHEDS[:2])
+    assert many[0] == {"error": zone.error}
+    assert isinstance(many[1], list)
@@ -0,0 +1,277 @@
+"""
+Benchmarks the CDEM statistics queries against the Whistler fixture DEM.
+
+Not collected by pytest. Run it in the backend container (it needs a PostGIS database):
+
+    python tests/watersheds/benchmark_cdem_stats.py --copies 200
+
+The fixture DEM (fixtures/raster/Whistler_CDEM.tif) is tiled into a temporary raster table.
+`--copies` adds that many shifted copies of the tiles around it, to stand in for the rest of
+the province: the original queries visit every tile in the table, the current ones only the
+tiles under the area.  Each method is timed over `--runs` runs and its result is printed,
+so the values can be compared.
+"""
+import argparse
+import os
+import statistics
+import time
+from shapely.geometry import Point
+
+from api.db.session import db_session
+from api.utils import new_polygon
+from api.v1.watersheds.cdem import CDEM
+
+FIXTURE_DEM = os.path.join(os.path.dirname(__file__), '../../fixtures/raster/Whistler_CDEM.tif')
+BENCHMARK_TABLE = 'cdem_benchmark'
+
+# the statistics queries before they were filtered with ST_Intersects and merged per tile.
+LEGACY_QUERIES = {
+    'summary_stats': f"""
+        select ST_SummaryStats(ST_Clip(cdem.rast,ST_GeomFromText(:area, 4140))) FROM {BENCHMARK_TABLE} as cdem
+    """,
+    'median_elevation': f"""
+        with elev as
+        (
+            select distinct
+                    (vc).value,
+                    sum ((vc).count) as tot_pix
+            from    {BENCHMARK_TABLE} as cdem
+            inner join
+                    ST_GeomFromText(:area, 4140) as geom
+            on      ST_Intersects(cdem.rast, geom),
+                    ST_ValueCount(ST_Clip(cdem.rast,geom),1)
+            as vc
+            group by (vc).value
+            order by (vc).value
+        )
+        select percentile_cont(0.5) WITHIN GROUP (ORDER BY value) AS median
+        from elev;
+    """,
+    'average_slope': f"""
+        SELECT AVG((vc).value)
+        FROM (
+            SELECT ST_ValueCount(
+                ST_Slope(ST_Clip(cdem.rast, ST_GeomFromText(:area, 4140)), 1, '32BF', 'PERCENT', 111120, FALSE::boolean)
+            ) as vc
+            FROM {BENCHMARK_TABLE} as cdem
+        ) as foo
+    """,
+}
+
+
+class BenchmarkCDEM(CDEM):
+    table = BENCHMARK_TABLE
+
+    # the query_ methods compute the same stats in PostGIS, one query each, as CDEM did
+    # before the zonal stats engine (zonal_stats.py).  Each query only visits the tiles that
+    # intersect the area (using the spatial index on the tiles' convex hulls), computes partial
+    # stats for every tile and then merges them.
+    def query_raster_summary_stats(self):
+        """ finds the elevation stats summary from CDEM for a given area
+            area should be a polygon with SRID 4140.
+        """
+
+        # Use ST_SummaryStats to find a summary of raster stats for each tile
+        # https://postgis.net/docs/RT_ST_SummaryStats.html
+        # The population stddev of all the cells is merged from the tile
+        # counts, means and stddevs:  sqrt(E[x²] - E[x]²)
+        q = f"""
+            with tile_stats as (
+                select  ST_SummaryStats(ST_Clip(cdem.rast, 1, geom, true), 1, true) as stats
+                from    {self.table} as cdem
+                inner join
+                        ST_GeomFromText(:area, 4140) as geom
+                on      ST_Intersects(cdem.rast, geom)
+            )
+            select  sum((stats).count) as count,
+                    sum((stats).sum) as sum,
+                    sum((stats).sum) / sum((stats).count) as mean,
+                    sqrt(greatest(
+                        sum((stats).count * ((stats).stddev ^ 2 + (stats).mean ^ 2)) / sum((stats).count)
+                        - (sum((stats).sum) / sum((stats).count)) ^ 2,
+                        0
+                    )) as stddev,
+                    min((stats).min) as min,
+                    max((stats).max) as max
+            from    tile_stats
+            where   (stats).count > 0
+        """
+
+        stats = self.db.execute(q, {"area": self.area4140.wkt})
+        stats = stats.fetchone()
+        if not stats or not stats['count']:
+            raise Exception(
+                "elevation stats could not be found using CDEM")
+        stats = dict(stats)
+
+        return stats
+
+    def query_median_elevation(self):
+        """ finds the median elevation in METERS from CDEM for a given area
+            area should be a polygon with SRID 4140.
+        """
+
+        # Use ST_ValueCount to find the values in each tile
+        # https://postgis.net/2014/09/26/tip_count_of_pixel_values/
+        # The median is taken over the distinct values of all the tiles.
+        q = f"""
+        with elev as
+        (
+            select  vc.value
+            from    {self.table} as cdem
+            inner join
+                    ST_GeomFromText(:area, 4140) as geom
+            on      ST_Intersects(cdem.rast, geom)
+            cross join lateral
+                    ST_ValueCount(ST_Clip(cdem.rast, 1, geom, true), 1, true) as vc
+            group by vc.value
+        )
+        select percentile_cont(0.5) WITHIN GROUP (ORDER BY value) AS median
+        from elev;
+        """
+
+        median_elev = self.db.execute(q, {"area": self.area4140.wkt})
+        median_elev = median_elev.fetchone()
+        if not median_elev or not median_elev[0]:
+            raise Exception(
+                "median elevation could not be found using CDEM")
+        median_elev = median_elev[0]
+
+        return median_elev
+
+    def query_average_slope(self):
+        """ finds the mean slope in PERCENT from CDEM for a given area
+            area should be a polygon with SRID 4140.
+        """
+
+        # Use ST_Slope to find the slope of a pixel
+        # https://postgis.net/docs/RT_ST_Slope.html
+        # Each tile contributes the sum and number of its distinct slope values.
+        q = f"""
+          with tile_slope as (
+            select  cdem.rid,
+                    sum(vc.value) as value_sum,
+                    count(*) as value_count
+            from    {self.table} as cdem
+            inner join
+                    ST_GeomFromText(:area, 4140) as geom
+            on      ST_Intersects(cdem.rast, geom)
+            cross join lateral
+                    ST_ValueCount(
+                      ST_Slope(
+                        ST_Clip(cdem.rast, 1, geom, true),
+                        1,
+                        '32BF',
+                        'PERCENT',
+                        111120,
+                        FALSE::boolean
+                      ),
+                      1,
+                      true
+                    ) as vc
+            group by cdem.rid
+          )
+          select sum(value_sum) / sum(value_count) as average_slope
+          from tile_slope
+        """
+
+        avg_slope_perc = self.db.execute(q, {"area": self.area4140.wkt})
+        avg_slope_perc = avg_slope_perc.fetchone()
+        if not avg_slope_perc or not avg_slope_perc[0]:
+            raise Exception(
+                "mean slope could not be found using CDEM")
+        avg_slope_perc = avg_slope_perc[0]
+
+        return avg_slope_perc
+
+
+def load_fixture_dem(db, copies: int, tile_size: int):
+    """ tiles the fixture DEM into a temporary raster table with `copies` shifted copies """
+    with open(FIXTURE_DEM, 'rb') as f:
+        tif = f.read()
+
+    # ST_FromGDALRaster needs the GTiff driver
+    db.execute("SET postgis.gdal_enabled_drivers = 'GTiff'")
+    db.execute(f"DROP TABLE IF EXISTS {BENCHMARK_TABLE}")
+    db.execute(f"""
+        CREATE TEMP TABLE {BENCHMARK_TABLE} AS
+        WITH dem as (
+            SELECT ST_SetSRID(ST_FromGDALRaster(:tif), 4140) as rast
+        ),
+        shifts as (
+            -- copies are laid out in a grid around the original (copy 0)
+            SELECT  n,
+                    (n % 20) * ST_Width(rast) * ST_ScaleX(rast) as dx,
+                    (n / 20) * ST_Height(rast) * ST_ScaleY(rast) as dy
+            FROM    dem, generate_series(0, :copies) as n
+        )
+        SELECT  row_number() over () as rid, rast
+        FROM (
+            SELECT  ST_Tile(
+                        ST_SetUpperLeft(dem.rast, ST_UpperLeftX(dem.rast) + dx, ST_UpperLeftY(dem.rast) + dy),
+                        1, :tile_size, :tile_size
+                    ) as rast
+            FROM    dem, shifts
+        ) as tiles
+    """, {"tif": tif, "copies": copies, "tile_size": tile_size})
+    db.execute(f"CREATE INDEX ON {BENCHMARK_TABLE} USING gist (ST_ConvexHull(rast))")
+    db.execute(f"ANALYZE {BENCHMARK_TABLE}")
+
+    row = db.execute(f"""
+        SELECT  count(*) as tiles,
+                ST_X(ST_Centroid(ST_Envelope(ST_FromGDALRaster(:tif)))) as x,
+                ST_Y(ST_Centroid(ST_Envelope(ST_FromGDALRaster(:tif)))) as y
+        FROM    {BENCHMARK_TABLE}
+    """, {"tif": tif}).fetchone()
+    return row['tiles'], Point(row['x'], row['y'])
+
+
+def timed(fn, runs: int):
+    times = []
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--copies', type=int, default=100, help='shifted copies of the fixture DEM to add')
+    parser.add_argument('--tile-size', type=int, default=100, help='tile width and height in cells')
+    parser.add_argument('--area', type=float, default=25e6, help='area to summarize (square metres)')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    db = db_session()
+    try:
+        tiles, centre = load_fixture_dem(db, args.copies, args.tile_size)
+        cdem = BenchmarkCDEM(new_polygon(centre, size_sqm=args.area), db=db)
+        area = {"area": cdem.area4140.wkt}
+        print(f"{tiles} tiles, {args.area / 1e6} km² area, median of {args.runs} runs\n")
+
+        def terrain_stats():
+            # a new instance each run, so the stats aren't reused
+            return BenchmarkCDEM(cdem.area4326, db=db).get_terrain_stats()
+
+        cases = [
+            ('legacy summary stats', lambda: db.execute(LEGACY_QUERIES['summary_stats'], area).fetchone()),
+            ('summary stats', cdem.query_raster_summary_stats),
+            ('legacy median elevation', lambda: db.execute(LEGACY_QUERIES['median_elevation'], area).fetchone()),
+            ('median elevation', cdem.query_median_elevation),
+            ('legacy average slope', lambda: db.execute(LEGACY_QUERIES['average_slope'], area).fetchone()),
+            ('average slope', cdem.query_average_slope),
+            ('zonal stats (all three)', terrain_stats),
+        ]
+
+        for name, fn in cases:
+            elapsed, result = timed(fn, args.runs)
+            print(f"{name:<26} {elapsed * 1000:>10.1f} ms   {result}")
+    finally:
+        db.rollback()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from shapely.geometry import Point, Polygon
+
+import api.db.session
+from api.v1.watersheds import batch, controller
+
+WATERSHED = Polygon([(-123.0, 50.0), (-122.9, 50.0), (-122.9, 50.1), (-123.0, 50.1)])
+
+
+class FakeSession:
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeUpstream:
+    def __init__(self, db, watershed_feature_id):
+        self.watershed_feature_id = watershed_feature_id
+
+    def border_crossings(self):
+        return []
+
+
+def test_watershed_id_item(monkeypatch):
+    """ an item given by FWA watershed ID is delineated, with a point in the watershed as its click point """
+    monkeypatch.setattr(api.db.session, 'Session', FakeSession)
+    monkeypatch.setattr(controller, 'get_point_in_watershed', lambda db, watershed_id: Point(-122.95, 50.05))
+    monkeypatch.setattr(controller, 'get_watershed_data_version', lambda db: '1')
+    monkeypatch.setattr(controller, 'get_shared_cached_watershed', lambda db, key, version: None)
+    monkeypatch.setattr(controller, 'store_shared_cached_watershed', lambda *args: None)
+    monkeypatch.setattr(controller, 'store_generated_watershed', lambda db, user, watershed: 1)
+    monkeypatch.setattr(controller, 'UpstreamWatershedSet', FakeUpstream)
+    monkeypatch.setattr(controller, 'get_upstream_catchment_area', lambda db, watershed_id, upstream: WATERSHED)
+
+    line = batch.delineate_batch_item(
+        {"id": "a", "watershed_id": 123}, 'FWA+UPSTREAM', 'cdem', None)
+    result = json.loads(line)
+
+    assert result["error"] is None
+    assert result["id"] == "a"
+    assert result["watershed"]["fwa_watershed_id"] == 123
+    assert result["watershed"]["click_point"] == 'POINT (-122.95 50.05)'
+    assert result["watershed"]["snapped_point"] == 'POINT (-122.95 50.05)'
+
+
+def test_stream_batch_bounds_items_in_pool(monkeypatch):
+    """ a batch keeps at most WATERSHED_BATCH_PROCESSES items in the shared pool """
+    running = []
+    lock = threading.Lock()
+    max_running = [0]
+
+    def delineate(item, upstream_method, dem_source, user_uuid):
+        with lock:
+            running.append(item["id"])
+            max_running[0] = max(max_running[0], len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(item["id"])
+        return json.dumps({"id": item["id"]}) + "\n"
+
+    pool = ThreadPoolExecutor(8)
+    monkeypatch.setattr(batch, 'WATERSHED_BATCH_PROCESSES', 2)
+    monkeypatch.setattr(batch, 'get_batch_executor', lambda: pool)
+    monkeypatch.setattr(batch, 'delineate_batch_item', delineate)
+
+    async def collect():
+        return [json.loads(line) async for line in batch.stream_batch(
+            [{"point": [0, 0]} for _ in range(10)], 'DEM+FWA', 'cdem', None)]
+
+    try:
+        results = asyncio.run(collect())
+    finally:
+        pool.shutdown()
+
+    assert sorted(int(result["id"]) for result in results) == list(range(10))
+    assert max_running[0] <= 2
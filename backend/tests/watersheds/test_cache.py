@@ -0,0 +1,20 @@
+from shapely.geometry import Point
+from api.v1.watersheds.cache import watershed_cache_key, CACHE_CELL_SIZE_DEGREES
+
+
+class TestWatershedCacheKey:
+    def test_dem_points_in_the_same_cell_share_a_key(self):
+        point = Point(-123.1, 49.3)
+        nearby = Point(-123.1 + CACHE_CELL_SIZE_DEGREES / 10, 49.3)
+        next_cell = Point(-123.1 + CACHE_CELL_SIZE_DEGREES, 49.3)
+
+        key = watershed_cache_key('DEM+FWA', 'cdem', 100, point)
+        assert watershed_cache_key('DEM+FWA', 'cdem', 100, nearby) == key
+        assert watershed_cache_key('DEM+FWA', 'cdem', 100, next_cell) != key
+        assert watershed_cache_key('DEM+FWA', 'srtm', 100, point) != key
+        assert watershed_cache_key('DEM', 'cdem', 100, point) != key
+
+    def test_fwa_methods_ignore_the_point(self):
+        key = watershed_cache_key('FWA+UPSTREAM', 'cdem', 100, Point(-123.1, 49.3))
+        assert watershed_cache_key('FWA+UPSTREAM', 'srtm', 100, Point(-120, 50)) == key
+        assert watershed_cache_key('FWA+UPSTREAM', 'cdem', 101) != key
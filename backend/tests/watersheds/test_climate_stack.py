@@ -0,0 +1,153 @@
+import math
+
+import numpy as np
+import pytest
+from geojson import Feature
+from osgeo import gdal, osr
+from shapely.geometry import box, mapping
+
+from api.utils.raster import clip_raster, select_overview, METRES_PER_DEGREE
+from api.v1.watersheds import controller
+from api.v1.watersheds.climate import (
+    read_climate_stack, get_climate_means, CLIMATE_STACK_NO_DATA, HILLSHADE_MAX
+)
+
+
+def make_stack(path):
+    """ a 3 band, 4x4 cell stack covering -123, 50 to -122, 51 """
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, 4, 4, 3, gdal.GDT_Float32)
+    ds.SetGeoTransform((-123, 0.25, 0, 51, 0, -0.25))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+
+    precip = np.full((4, 4), 1000, dtype=np.float32)
+    precip[0, 0] = CLIMATE_STACK_NO_DATA
+    pet = np.full((4, 4), 500, dtype=np.float32)
+    hillshade = np.full((4, 4), HILLSHADE_MAX / 2, dtype=np.float32)
+
+    for i, data in enumerate((precip, pet, hillshade)):
+        band = ds.GetRasterBand(i + 1)
+        band.SetNoDataValue(CLIMATE_STACK_NO_DATA)
+        band.WriteArray(data)
+    ds = None
+
+
+def test_read_climate_stack():
+    path = '/vsimem/test_climate_stack.tif'
+    make_stack(path)
+    try:
+        area = box(-123, 50, -122, 51)
+        sums = read_climate_stack(area, raster=path)
+
+        # the nodata cell isn't counted
+        assert sums['precipitation'] == (15000, 15)
+        assert sums['pet'] == (8000, 16)
+
+        means = get_climate_means(area, raster=path)
+        assert means['annual_precipitation'] == 1000
+        assert means['potential_evapotranspiration'] == 500
+        assert means['solar_exposure'] == 0.5
+    finally:
+        gdal.Unlink(path)
+
+
+def test_select_overview():
+    path = '/vsimem/test_overviews.tif'
+    # 12 arc second cells (about 240 x 370 m at 50°N) with 2x and 4x overviews
+    ds = gdal.GetDriverByName('GTiff').Create(path, 1200, 1200, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((-124, 1 / 300, 0, 52, 0, -1 / 300))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.BuildOverviews('AVERAGE', [2, 4])
+    ds = None
+    try:
+        # small watersheds are read at full resolution
+        level, cell_size = select_overview(path, box(-123, 50, -122.9, 50.1), 80e6, error_budget=0.02)
+        assert level is None
+        assert 290 < cell_size < 310
+
+        # the overviews have about 600 m and 1200 m cells. 4 * 600 m / sqrt(10000 km²) = 0.024
+        level, _ = select_overview(path, box(-123, 50, -122, 51), 10000e6, error_budget=0.02)
+        assert level is None
+        level, _ = select_overview(path, box(-123, 50, -122, 51), 20000e6, error_budget=0.02)
+        assert level == 0
+        level, cell_size = select_overview(path, box(-123, 50, -122, 51), 100000e6, error_budget=0.02)
+        assert level == 1
+        assert 1170 < cell_size < 1200
+    finally:
+        gdal.Unlink(path)
+
+
+def make_overview_raster(path):
+    """ a 1200x1200 cell GeoTIFF (1/300° cells) covering -124, 48 to -120, 52, with 2x and 4x overviews """
+    ds = gdal.GetDriverByName('GTiff').Create(path, 1200, 1200, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((-124, 1 / 300, 0, 52, 0, -1 / 300))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(np.arange(1200 * 1200, dtype=np.float32).reshape(1200, 1200))
+    ds.BuildOverviews('AVERAGE', [2, 4])
+    ds = None
+
+
+def cell_size_metres(dataset, latitude):
+    """ the cell size (metres) of a EPSG:4326 dataset, the way select_overview measures it """
+    gt = dataset.GetGeoTransform()
+    return math.sqrt(abs(gt[1] * gt[5]) * METRES_PER_DEGREE ** 2 * math.cos(math.radians(latitude)))
+
+
+def test_clip_raster_overview(tmp_path):
+    path = str(tmp_path / 'overviews.tif')
+    make_overview_raster(path)
+    area = box(-124, 48, -120, 52)
+
+    for level, factor in ((None, 1), (0, 2), (1, 4)):
+        dataset = clip_raster(path, area, overview_level=level)
+        gt = dataset.GetGeoTransform()
+        assert gt[1] == pytest.approx(factor / 300)
+        assert gt[5] == pytest.approx(-factor / 300)
+        assert (dataset.RasterXSize, dataset.RasterYSize) == (1200 // factor, 1200 // factor)
+
+
+def test_watershed_details_raster_resolution(tmp_path, monkeypatch):
+    """ the climate stack is read from the selected overview, and raster_resolution is its cell size """
+    path = str(tmp_path / 'overviews.tif')
+    make_overview_raster(path)
+    area = box(-124, 48, -120, 52)
+    clipped = []
+
+    def climate_means(area, retry_min_size=None, overview_level=None):
+        clipped.append(clip_raster(path, area, overview_level=overview_level))
+        return {'annual_precipitation': 1000, 'potential_evapotranspiration': 500, 'solar_exposure': 0.5}
+
+    class FakeCDEM:
+        def __init__(self, polygon, db=None):
+            pass
+
+        def get_terrain_stats(self):
+            return {}
+
+    # the /vsis3/ climate stack is replaced with the local raster
+    monkeypatch.setattr(controller, 'select_overview', lambda file_name, *args: select_overview(path, *args))
+    monkeypatch.setattr(controller, 'get_climate_means', climate_means)
+    monkeypatch.setattr(controller, 'get_fwa_watershed_stats', lambda *args: None)
+    monkeypatch.setattr(controller, 'get_hydrological_zone', lambda point: None)
+    monkeypatch.setattr(controller, 'calculate_glacial_area', lambda db, polygon: (0, 0))
+    monkeypatch.setattr(controller, 'CDEM', FakeCDEM)
+    monkeypatch.setattr(controller, 'SessionLocal', lambda: None)
+
+    data = controller.get_watershed_details(None, Feature(id='test', geometry=mapping(area)))
+
+    # about 290 km x 445 km, so the 4x overview (about 1190 m cells) is within the 2% error budget.
+    [dataset] = clipped
+    assert (dataset.RasterXSize, dataset.RasterYSize) == (300, 300)
+    resolution = round(cell_size_metres(dataset, area.centroid.y))
+    assert 1170 < resolution < 1200
+    assert data['raster_resolution'] == {
+        'annual_precipitation': resolution,
+        'potential_evapotranspiration': resolution,
+        'solar_exposure': resolution
+    }
@@ -0,0 +1,62 @@
+import numpy as np
+from api.v1.watersheds import d8
+
+
+def valley_dem(size=21):
+    """
+    a V shaped valley draining south, with the stream in the centre column
+    and a pit partway down the stream.
+    """
+    rows, cols = np.mgrid[0:size, 0:size]
+    dem = np.abs(cols - size // 2) * 2.0 + (size - rows) * 0.5
+    dem[10, size // 2] = -5
+    return dem
+
+
+class TestD8:
+    def test_fill_depressions(self):
+        """ the pit should be filled so that every cell can drain off the grid """
+        dem = valley_dem()
+        valid = np.ones(dem.shape, dtype=bool)
+
+        filled = d8.fill_depressions(dem, valid)
+        direction = d8.d8_pointer(filled, valid, d8.cell_distances(25, 25))
+
+        assert filled[10, 10] > dem[11, 10]
+        # only cells on the edge of the grid may have no downslope neighbour.
+        assert (direction[1:-1, 1:-1] != d8.NO_FLOW).all()
+
+    def test_flow_accumulation_and_watershed(self):
+        dem = valley_dem()
+        valid = np.ones(dem.shape, dtype=bool)
+        valid[0, 0] = False
+
+        filled = d8.fill_depressions(dem, valid)
+        direction = d8.d8_pointer(filled, valid, d8.cell_distances(25, 25))
+        accumulation = d8.d8_flow_accumulation(direction, valid)
+
+        # the outlet at the bottom of the stream collects most of the valley.
+        outlet = np.unravel_index(np.argmax(accumulation), accumulation.shape)
+        assert outlet == (20, 10)
+
+        mask = d8.watershed_mask(direction, *outlet)
+        assert mask.sum() == accumulation[outlet]
+        assert not mask[0, 0]
+
+    def test_snap_pour_point(self):
+        dem = valley_dem()
+        valid = np.ones(dem.shape, dtype=bool)
+        filled = d8.fill_depressions(dem, valid)
+        direction = d8.d8_pointer(filled, valid, d8.cell_distances(25, 25))
+        accumulation = d8.d8_flow_accumulation(direction, valid)
+
+        # a point beside the stream snaps onto the stream cell with the highest
+        # flow accumulation in the window (the furthest downstream).
+        assert d8.snap_pour_point(accumulation, 15, 12, 2) == (17, 10)
+        # with no snap distance, the point doesn't move.
+        assert d8.snap_pour_point(accumulation, 15, 12, 0) == (15, 12)
+
+    def test_from_wbt_pointer(self):
+        pointer = np.array([[1, 2, 4], [8, 16, 32], [64, 128, 0]])
+        direction = d8.from_wbt_pointer(pointer)
+        assert direction.ravel().tolist() == [0, 1, 2, 3, 4, 5, 6, 7, d8.NO_FLOW]
@@ -0,0 +1,54 @@
+import pytest
+from shapely.geometry import Point
+
+from api.v1.watersheds.delineate_watersheds import get_fwa_polygons_for_dem
+
+
+class RecordingDB:
+    """ records the queries executed, and returns an empty row """
+
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, q, params=None):
+        self.queries.append((q, params))
+        return self
+
+    def fetchone(self):
+        return {"working_area": None, "watershed_mask": None, "dem_file": None}
+
+
+class NoUpstream:
+    ids = []
+
+
+def test_fwa_polygons_for_dem_query():
+    """ the rendered working area query is a single, well formed WITH statement """
+    db = RecordingDB()
+    result = get_fwa_polygons_for_dem(db, 1, 2, Point(-122.9, 50.1), upstream=NoUpstream())
+    assert result is None
+
+    [(q, params)] = db.queries
+    assert q.lstrip().lower().startswith('with subwscode_ltree as')
+    assert q.count('"') % 2 == 0
+    assert q.count('(') == q.count(')')
+    assert params['click_point'] == 'POINT (-122.9 50.1)'
+
+
+def test_fwa_polygons_for_dem_query_executes():
+    """ the working area query runs against the database (skipped if there isn't one) """
+    from sqlalchemy.exc import OperationalError
+    from api.db.session import db_session
+
+    db = db_session()
+    try:
+        try:
+            db.execute("select 1")
+        except OperationalError:
+            pytest.skip("database not available")
+
+        # no polygon has this id, so there is no working area, but the query has to run.
+        assert get_fwa_polygons_for_dem(db, -1, -1, Point(-122.9, 50.1), upstream=NoUpstream()) is None
+    finally:
+        db.rollback()
+        db.close()
@@ -0,0 +1,28 @@
+import numpy as np
+from api.v1.watersheds.elevation_histogram import ElevationHistogram
+
+
+class TestElevationHistogram:
+    def test_merged_histograms_match_the_whole_area(self):
+        """ percentiles of merged histograms are the same as for all the cells together """
+        rng = np.random.RandomState(1)
+        a = rng.randint(200, 2500, size=1000)
+        b = rng.randint(800, 3000, size=1500)
+        cells = np.concatenate([a, b])
+
+        hist = ElevationHistogram.from_values(a).merge(ElevationHistogram.from_values(b))
+
+        assert hist.count == cells.size
+        for q in (0, 0.1, 0.25, 0.5, 0.9, 1):
+            assert abs(hist.percentile(q) - np.percentile(cells, q * 100)) < 1e-9
+        assert abs(hist.summary_stats()["mean"] - cells.mean()) < 1e-9
+        assert abs(hist.summary_stats()["stddev"] - cells.std()) < 1e-6
+        assert hist.median_of_distinct() == np.median(np.unique(cells))
+
+    def test_json_round_trip(self):
+        hist = ElevationHistogram.from_values([100.2, 99.8, 250, 250, 250])
+        assert hist.counts == {100: 2, 250: 3}
+
+        restored = ElevationHistogram.from_json(hist.to_json())
+        assert restored.counts == hist.counts
+        assert restored.median() == 250
@@ -0,0 +1,112 @@
+import numpy as np
+from api.v1.watersheds.elevation_histogram import ElevationHistogram
+from api.v1.watersheds.fwa_attributes import (
+    cdem_attributes, merge_attributes, summarize_attributes, HILLSHADE_MAX)
+from api.v1.watersheds.zonal_stats import CDEM_CELL_SIZE
+
+# a 12 x 12 cell CDEM, with its upper left corner at (-123, 50)
+DEM = np.random.RandomState(1).uniform(100, 300, (12, 12))
+DEM_ORIGIN = (-123, 50)
+
+
+class CellArea:
+    """ an area made of the DEM cells in `rows` and `cols` (ranges of cell indexes) """
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.wkt = f"area {rows} {cols}"
+
+
+class FakeCDEM:
+    """
+    answers the read_cdem_window_with_margin query for CellAreas: the window is the area
+    plus one cell on each side, like ST_Clip with the area buffered by CDEM_MARGIN.
+    """
+
+    def __init__(self, *areas):
+        self.areas = {area.wkt: area for area in areas}
+
+    def execute(self, q, params):
+        area = self.areas[params['area']]
+        rows = range(area.rows.start - 1, area.rows.stop + 1)
+        cols = range(area.cols.start - 1, area.cols.stop + 1)
+        x, y = DEM_ORIGIN
+        row = {
+            'elevation': DEM[rows.start:rows.stop, cols.start:cols.stop].tolist(),
+            'upper_left_x': x + cols.start * CDEM_CELL_SIZE,
+            'upper_left_y': y - rows.start * CDEM_CELL_SIZE,
+            'scale_x': CDEM_CELL_SIZE,
+            'scale_y': -CDEM_CELL_SIZE,
+            'area_elevation': DEM[area.rows.start:area.rows.stop, area.cols.start:area.cols.stop].tolist(),
+            'area_upper_left_x': x + area.cols.start * CDEM_CELL_SIZE,
+            'area_upper_left_y': y - area.rows.start * CDEM_CELL_SIZE,
+        }
+        return type('Result', (), {'fetchone': lambda self: row})()
+
+
+def attributes(elevations, precip, pet, slope, hillshade, glacier_area_sqm=0, area_sqm=1e6):
+    """ attributes for a polygon with one cell per elevation """
+    return {
+        'area_sqm': area_sqm,
+        'precip_sum': sum(precip),
+        'precip_count': len(precip),
+        'pet_sum': sum(pet),
+        'pet_count': len(pet),
+        'glacier_area_sqm': glacier_area_sqm,
+        'elevation_histogram': ElevationHistogram.from_values(elevations),
+        'slope_sum': sum(slope),
+        'slope_count': len(slope),
+        'hillshade_sum': sum(hillshade),
+        'hillshade_count': len(hillshade),
+    }
+
+
+class TestFWAAttributes:
+    def test_sums_match_the_whole_area(self):
+        """ the merged sums of two polygons give the same stats as the cells of both """
+        a = attributes([100, 110, 110], precip=[1000, 1200], pet=[400], slope=[10, 20],
+                       hillshade=[16000, 20000], glacier_area_sqm=2e5)
+        b = attributes([110, 150], precip=[800], pet=[500, 600], slope=[30],
+                       hillshade=[30000], glacier_area_sqm=0)
+
+        stats = summarize_attributes(merge_attributes(a, b), 2e6)
+
+        elevations = np.array([100, 110, 110, 110, 150])
+        assert stats['annual_precipitation'] == 1000
+        assert stats['potential_evapotranspiration'] == 500
+        assert stats['average_slope'] == 20
+        assert abs(stats['solar_exposure'] - 22000 / HILLSHADE_MAX) < 1e-9
+        assert stats['glacial_area'] == 2e5
+        assert stats['glacial_coverage'] == 0.1
+
+        assert stats['elevation_stats']['count'] == 5
+        assert stats['elevation_stats']['min'] == 100
+        assert stats['elevation_stats']['max'] == 150
+        assert abs(stats['elevation_stats']['mean'] - elevations.mean()) < 1e-9
+        assert abs(stats['elevation_stats']['stddev'] - elevations.std()) < 1e-9
+
+        # median of the distinct elevations (100, 110, 150)
+        assert stats['median_elevation'] == 110
+
+    def test_missing_cells_fall_back_to_rasters(self):
+        """ if a raster has no cells in the area, the stats aren't summarized from the table """
+        a = attributes([100], precip=[], pet=[400], slope=[10], hillshade=[16000])
+        assert summarize_attributes(merge_attributes(a), 1e6) is None
+
+    def test_slope_of_adjacent_polygons_matches_their_union(self):
+        """ the cells on the shared edge of two polygons have a slope, so they add up to the union """
+        west = CellArea(range(2, 10), range(2, 6))
+        east = CellArea(range(2, 10), range(6, 10))
+        union = CellArea(range(2, 10), range(2, 10))
+        db = FakeCDEM(west, east, union)
+
+        west_histogram, west_sum, west_count = cdem_attributes(db, west)
+        east_histogram, east_sum, east_count = cdem_attributes(db, east)
+        union_histogram, union_sum, union_count = cdem_attributes(db, union)
+
+        # every cell has a slope, including those on the polygons' edges
+        assert west_count == east_count == 32
+        assert west_count + east_count == union_count == 64
+        assert abs(west_sum + east_sum - union_sum) < 1e-6 * union_sum
+        assert west_histogram.count + east_histogram.count == union_histogram.count == 64
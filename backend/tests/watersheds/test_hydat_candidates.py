@@ -0,0 +1,60 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from api.v1.watersheds import controller
+
+
+def fake_watershed(area_km2):
+    return SimpleNamespace(watershed=SimpleNamespace(properties={'FEATURE_AREA_SQM': area_km2 * 1e6}))
+
+
+def fake_delineation(monkeypatch, delays):
+    """ candidate {'i': i} takes delays[i][0] seconds and has an area of delays[i][1] km2 """
+    cancelled = set()
+
+    def delineate(user, candidate, cancel: threading.Event):
+        delay, area = delays[candidate['i']]
+        if cancel.wait(delay):
+            cancelled.add(candidate['i'])
+            raise controller.DelineationCancelled()
+        return fake_watershed(area)
+
+    monkeypatch.setattr(controller, '_delineate_candidate', delineate)
+    monkeypatch.setattr(controller, 'WATERSHED_CANDIDATE_WORKERS', len(delays))
+    return cancelled
+
+
+def test_earlier_candidate_is_preferred(monkeypatch):
+    """ a later candidate within the tolerance that finishes first doesn't beat an earlier one """
+    cancelled = fake_delineation(monkeypatch, [(0.3, 102), (0.01, 95), (1, 100)])
+
+    watershed, difference, index = controller.delineate_candidates(
+        None, [{'i': i} for i in range(3)], 100)
+
+    assert index == 0
+    assert round(difference, 2) == 0.02
+    assert watershed.watershed.properties['FEATURE_AREA_SQM'] == 102e6
+    # the last candidate can't be chosen once the first is within the tolerance.
+    assert cancelled == {2}
+
+
+def test_later_candidate_when_earlier_misses(monkeypatch):
+    """ a later candidate is chosen once the earlier ones have missed the tolerance """
+    fake_delineation(monkeypatch, [(0.2, 150), (0.01, 95), (0.1, 30)])
+
+    start = time.perf_counter()
+    _, difference, index = controller.delineate_candidates(None, [{'i': i} for i in range(3)], 100)
+
+    assert index == 1
+    assert round(difference, 2) == 0.05
+    assert time.perf_counter() - start < 1
+
+
+def test_closest_candidate_when_none_within_tolerance(monkeypatch):
+    fake_delineation(monkeypatch, [(0.01, 150), (0.02, 80), (0.03, 30)])
+
+    _, difference, index = controller.delineate_candidates(None, [{'i': i} for i in range(3)], 100)
+
+    assert index == 1
+    assert round(difference, 2) == 0.2
@@ -0,0 +1,145 @@
+import os
+
+import numpy as np
+import pytest
+from osgeo import gdal, osr
+from shapely.geometry import box
+
+from api.utils.raster_cache import RasterCache
+
+
+class FakeStat:
+    def __init__(self, size, etag):
+        self.size = size
+        self.etag = etag
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class FakeMinio:
+    """ serves byte ranges of a local file, counting the requests """
+
+    def __init__(self, path):
+        self.path = path
+        self.requests = 0
+
+    def stat_object(self, bucket, key):
+        return FakeStat(os.path.getsize(self.path), 'etag1')
+
+    def get_partial_object(self, bucket, key, offset=0, length=0):
+        self.requests += 1
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return FakeResponse(f.read(length))
+
+
+def make_cog(path):
+    """ a 1024x1024 cell COG with 128x128 tiles covering -124, 49 to -122, 51 """
+    mem = gdal.GetDriverByName('MEM').Create('', 1024, 1024, 1, gdal.GDT_Float32)
+    mem.SetGeoTransform((-124, 2 / 1024, 0, 51, 0, -2 / 1024))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    mem.SetProjection(srs.ExportToWkt())
+    mem.GetRasterBand(1).WriteArray(np.arange(1024 * 1024, dtype=np.float32).reshape(1024, 1024))
+    mem.BuildOverviews('AVERAGE', [2, 4])
+    gdal.Translate(path, mem, creationOptions=['TILED=YES', 'BLOCKXSIZE=128', 'BLOCKYSIZE=128',
+                                               'COPY_SRC_OVERVIEWS=YES'])
+
+
+def test_raster_cache_window(tmp_path):
+    cog = str(tmp_path / 'test.tif')
+    make_cog(cog)
+    client = FakeMinio(cog)
+    cache = RasterCache(str(tmp_path / 'cache'), 100 * 1024 * 1024, client=client, block_size=16 * 1024)
+
+    area = box(-123.2, 49.8, -122.9, 50.1)
+    expected = gdal.Warp('', cog, format='MEM', outputBounds=area.bounds).ReadAsArray()
+
+    with cache.window('/vsis3/raster/test.tif', area) as path:
+        assert path.startswith('/vsisparse/')
+        result = gdal.Warp('', path, format='MEM', outputBounds=area.bounds).ReadAsArray()
+    assert np.array_equal(result, expected)
+
+    # a second read of the same area comes from the cache
+    requests = client.requests
+    with cache.window('/vsis3/raster/test.tif', area) as path:
+        result = gdal.Warp('', path, format='MEM', outputBounds=area.bounds).ReadAsArray()
+    assert np.array_equal(result, expected)
+    assert client.requests == requests
+
+
+def test_raster_cache_evict(tmp_path):
+    cog = str(tmp_path / 'test.tif')
+    make_cog(cog)
+    cache = RasterCache(str(tmp_path / 'cache'), 64 * 1024, client=FakeMinio(cog), block_size=16 * 1024)
+
+    with cache.window('/vsis3/raster/test.tif', box(-124, 49, -122, 51)):
+        pass
+    cache.evict()
+
+    used = sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(cache.cache_dir) for name in files
+        if name not in ('meta.json', '.lock'))
+    assert used <= 64 * 1024
+
+
+def test_raster_cache_reads_outside_window(tmp_path):
+    """ parts of the raster that weren't cached for the window are read from the source, not as zeros """
+    cog = str(tmp_path / 'test.tif')
+    make_cog(cog)
+    cache = RasterCache(str(tmp_path / 'cache'), 100 * 1024 * 1024, client=FakeMinio(cog), block_size=16 * 1024)
+
+    area = box(-123.2, 49.8, -122.9, 50.1)
+    wider = box(-123.8, 49.2, -122.2, 50.8)
+    expected = gdal.Warp('', cog, format='MEM', outputBounds=wider.bounds).ReadAsArray()
+    expected_overview = gdal.Warp('', cog, format='MEM', outputBounds=wider.bounds,
+                                  options=['-ovr', '1']).ReadAsArray()
+
+    meta = cache.get_meta('raster', 'test.tif')
+    blocks = cache.window_blocks('raster', 'test.tif', meta, area, 4326)
+    cache.ensure_blocks('raster', 'test.tif', meta, blocks)
+
+    # the local COG stands in for its /vsis3/ path
+    with cache.sparse_file(meta, blocks, source=cog) as path:
+        result = gdal.Warp('', path, format='MEM', outputBounds=wider.bounds).ReadAsArray()
+        result_overview = gdal.Warp('', path, format='MEM', outputBounds=wider.bounds,
+                                    options=['-ovr', '1']).ReadAsArray()
+    assert np.array_equal(result, expected)
+    assert np.array_equal(result_overview, expected_overview)
+
+
+def test_raster_cache_block_removed_during_read(tmp_path):
+    """ a read fails if one of its blocks is removed before it finishes """
+    cog = str(tmp_path / 'test.tif')
+    make_cog(cog)
+    cache = RasterCache(str(tmp_path / 'cache'), 100 * 1024 * 1024, client=FakeMinio(cog), block_size=16 * 1024)
+
+    with pytest.raises(IOError):
+        with cache.window('/vsis3/raster/test.tif', box(-123.2, 49.8, -122.9, 50.1)):
+            meta = cache.get_meta('raster', 'test.tif')
+            block = max(name for name in os.listdir(os.path.join(cache.cache_dir, meta['id'])) if name != 'meta.json')
+            os.remove(os.path.join(cache.cache_dir, meta['id'], block))
+
+
+def test_raster_cache_evict_waits_for_reads(tmp_path):
+    """ blocks aren't evicted while a window is being read """
+    cog = str(tmp_path / 'test.tif')
+    make_cog(cog)
+    cache = RasterCache(str(tmp_path / 'cache'), 64 * 1024, client=FakeMinio(cog), block_size=16 * 1024)
+
+    with cache.window('/vsis3/raster/test.tif', box(-124, 49, -122, 51)):
+        assert cache.evict() is None
+    assert cache.evict() is not None
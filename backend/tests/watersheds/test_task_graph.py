@@ -0,0 +1,85 @@
+import threading
+import time
+import pytest
+from api.utils import task_graph
+from api.utils.task_graph import TaskGraph
+
+
+class TestTaskGraph:
+    def test_dependencies_receive_results(self):
+        graph = TaskGraph()
+        graph.add('a', lambda: 1)
+        graph.add('b', lambda: 2)
+        graph.add('c', lambda a, b: a + b, deps=['a', 'b'])
+        assert graph.run() == {'a': 1, 'b': 2, 'c': 3}
+
+    def test_independent_tasks_run_concurrently(self):
+        graph = TaskGraph()
+        for name in ('a', 'b', 'c'):
+            graph.add(name, time.sleep, args=(0.2,))
+
+        start = time.perf_counter()
+        graph.run()
+        assert time.perf_counter() - start < 0.5
+
+    def test_errors_and_timeouts_use_the_default(self):
+        def fail():
+            raise Exception("failed")
+
+        graph = TaskGraph()
+        graph.add('fails', fail, default='default')
+        graph.add('slow', lambda: time.sleep(1) or 'slow', timeout=0.1, default='too slow')
+        graph.add('ok', lambda: 'ok')
+
+        results = graph.run()
+        assert results == {'fails': 'default', 'slow': 'too slow', 'ok': 'ok'}
+        assert set(graph.errors) == {'fails', 'slow'}
+
+    def test_required_task_errors_are_raised(self):
+        def fail():
+            raise ValueError("failed")
+
+        graph = TaskGraph()
+        graph.add('fails', fail, required=True)
+        with pytest.raises(ValueError):
+            graph.run()
+
+    def test_shared_deadline_bounds_dependent_tasks(self):
+        # the fallback starts after the slow read times out, but has to finish by the same deadline.
+        deadline = time.monotonic() + 0.3
+        graph = TaskGraph()
+        graph.add('read', lambda: time.sleep(0.2) or 'read', deadline=deadline)
+        graph.add('fallback', lambda read: time.sleep(1) or 'fallback', deps=['read'],
+                  timeout=1, deadline=deadline, default='too slow')
+
+        start = time.perf_counter()
+        results = graph.run()
+        assert time.perf_counter() - start < 0.6
+        assert results == {'read': 'read', 'fallback': 'too slow'}
+        assert set(graph.errors) == {'fallback'}
+
+    def test_database_sessions_are_limited(self, monkeypatch):
+        open_sessions = []
+        max_open = [0]
+        lock = threading.Lock()
+
+        class FakeSession:
+            def __init__(self):
+                with lock:
+                    open_sessions.append(self)
+                    max_open[0] = max(max_open[0], len(open_sessions))
+
+            def close(self):
+                with lock:
+                    open_sessions.remove(self)
+
+        monkeypatch.setattr(task_graph, 'SessionLocal', FakeSession)
+        monkeypatch.setattr(task_graph, '_db_sessions', threading.BoundedSemaphore(2))
+
+        graph = TaskGraph()
+        for name in ('a', 'b', 'c', 'd', 'e'):
+            graph.add(name, lambda db: time.sleep(0.05) or isinstance(db, FakeSession), db=True)
+
+        assert graph.run() == {name: True for name in ('a', 'b', 'c', 'd', 'e')}
+        assert max_open[0] == 2
+        assert not open_sessions
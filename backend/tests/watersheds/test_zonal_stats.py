@@ -0,0 +1,51 @@
+import numpy as np
+from api.v1.watersheds.zonal_stats import (
+    summary_stats, median_of_distinct, mean_of_distinct, slope_percent, METRES_PER_DEGREE)
+
+
+class TestZonalStats:
+    def test_summary_stats_ignores_masked_cells(self):
+        elevation = np.ma.masked_array(
+            [[1.0, 2.0], [3.0, -32768.0]], mask=[[False, False], [False, True]])
+
+        stats = summary_stats(elevation)
+
+        assert stats["count"] == 3
+        assert stats["sum"] == 6.0
+        assert stats["mean"] == 2.0
+        assert stats["min"] == 1.0
+        assert stats["max"] == 3.0
+        # population standard deviation, like ST_SummaryStats
+        assert abs(stats["stddev"] - np.std([1.0, 2.0, 3.0])) < 1e-9
+
+    def test_median_uses_distinct_values(self):
+        """ the median is over the distinct values (percentile_cont over ST_ValueCount) """
+        elevation = np.ma.masked_array([[100, 100, 100], [100, 200, 400]], mask=False)
+
+        # distinct values are 100, 200 and 400
+        assert median_of_distinct(elevation) == 200
+
+        elevation = np.ma.masked_array([100, 200, 300, 400], mask=False)
+        assert median_of_distinct(elevation) == 250
+
+    def test_slope_of_a_plane(self):
+        """ a plane rising 1 m per cell to the east has the same slope everywhere inside the window """
+        pixel_size = 1 / 300
+        elevation = np.ma.masked_array(np.tile(np.arange(5, dtype=float), (5, 1)), mask=False)
+
+        slope = slope_percent(elevation, pixel_size, -pixel_size)
+        expected = 1 / (pixel_size * METRES_PER_DEGREE) * 100
+
+        # edge cells have no slope
+        assert slope.count() == 9
+        assert np.allclose(slope.compressed(), expected)
+        assert abs(mean_of_distinct(slope) - expected) < 1e-9
+
+    def test_slope_masks_cells_next_to_nodata(self):
+        elevation = np.ma.masked_array(np.zeros((5, 5)), mask=False)
+        elevation[0, 0] = np.ma.masked
+
+        slope = slope_percent(elevation, 1 / 300, -1 / 300)
+
+        assert slope.mask[1, 1]
+        assert slope.count() == 8
@@ -0,0 +1,63 @@
+#!/bin/bash
+# USAGE: ./build_flow_grids.sh [dem_file ...]
+# Precomputes D8 flow direction (pointer) and flow accumulation rasters for the
+# stream-burned DEMs used for watershed delineation, and uploads them to Minio as
+# Cloud Optimized GeoTIFFs next to the DEM they were computed from:
+#
+#   raster/Burned_CDEM_4326.tif
+#   raster/Burned_CDEM_4326_d8_pointer.tif
+#   raster/Burned_CDEM_4326_d8_accumulation.tif
+#
+# The backend uses these grids (if they exist) instead of conditioning the DEM
+# for every delineation.  See backend/api/v1/watersheds/README.md.
+#
+# If no DEM files are given, all of the DEMs registered in dem.stream_burned_cdem_tile
+# are processed, plus the province wide CDEM and the SRTM DEM.
+#
+# Each DEM is conditioned and routed as a whole (not tile by tile), so flow paths
+# are continuous across the internal tiles of the output COGs and there are no seams.
+# Conditioning a full DEM needs a lot of memory (see the 25m CDEM notes in the README).
+
+set -euo pipefail
+cd /dataload
+
+pg_host="postgres://wally:$POSTGRES_PASSWORD@$POSTGRES_SERVER:5432/wally"
+
+echo "Setting up Minio host"
+mc --config-dir=./.mc config host add minio "${MINIO_HOST_URL}" "$MINIO_ACCESS_KEY" "$MINIO_SECRET_KEY"
+
+if [ "$#" -gt 0 ]; then
+  dem_files=("$@")
+else
+  dem_files=("Burned_CDEM_4326.tif" "Burned_SRTM_3005.tif")
+  dem_files+=($(psql "$pg_host" -X -A -t -c "select filename from dem.stream_burned_cdem_tile;"))
+fi
+
+mkdir -p ./flow_grids
+cd ./flow_grids
+
+for dem_file in "${dem_files[@]}"; do
+  name="${dem_file%.tif}"
+  echo "Processing $dem_file"
+
+  mc --config-dir=../.mc cp "minio/raster/$dem_file" "./$dem_file"
+
+  # same conditioning steps that were used to delineate watersheds from the working area.
+  whitebox_tools -r=BreachDepressions -v --wd="$(pwd)" --dem="$dem_file" -o="${name}_breached.tif"
+  whitebox_tools -r=D8Pointer -v --wd="$(pwd)" --dem="${name}_breached.tif" -o="${name}_pointer.tif"
+  whitebox_tools -r=D8FlowAccumulation -v --wd="$(pwd)" -i="${name}_pointer.tif" --pntr --out_type=cells -o="${name}_accumulation.tif"
+
+  # pointer values must never be resampled, so no overviews are built for either grid.
+  gdal_translate -of COG -ot Byte -co COMPRESS=DEFLATE -co BLOCKSIZE=512 -co OVERVIEWS=NONE \
+    "${name}_pointer.tif" "${name}_d8_pointer.tif"
+  gdal_translate -of COG -ot Float32 -co COMPRESS=DEFLATE -co PREDICTOR=YES -co BLOCKSIZE=512 -co OVERVIEWS=NONE \
+    "${name}_accumulation.tif" "${name}_d8_accumulation.tif"
+
+  mc --config-dir=../.mc cp "./${name}_d8_pointer.tif" "minio/raster/${name}_d8_pointer.tif"
+  mc --config-dir=../.mc cp "./${name}_d8_accumulation.tif" "minio/raster/${name}_d8_accumulation.tif"
+
+  rm -f ./*.tif
+  echo "Uploaded flow grids for $dem_file"
+done
+
+echo "Finished."
@@ -0,0 +1,60 @@
+#!/bin/bash
+# USAGE: ./build_climate_stack.sh
+# Builds raster/BC_Climate_Stack_4326.tif, a multi-band Cloud Optimized GeoTIFF with the
+# rasters used for watershed summaries resampled onto one grid:
+#
+#   band 1: mean annual precipitation (mm)       from raster/NORM_6190_Precip.tif
+#   band 2: potential evapotranspiration (mm)    from raster/WNA_et0.tif
+#   band 3: hillshade (0 - 32767)                from raster/BC_Area_Hillshade_3005.tif
+#
+# The backend reads all three bands for a watershed with one windowed read instead of one
+# read per file.  See backend/api/v1/watersheds/README.md.
+#
+# The grid is EPSG:4326 at 12 arc seconds (the resolution of the CDEM the hillshade was made
+# from), covering BC and the parts of the US that BC watersheds start in.  The climate
+# rasters are coarser, so they are resampled with nearest neighbour and keep their values.
+# All bands are Float32 with a nodata value of -9999.
+# Re-run the job whenever one of the source rasters is replaced.
+
+set -euo pipefail
+cd /dataload
+
+extent="${CLIMATE_STACK_EXTENT:--142 46 -110 62}"
+resolution="0.00333333333333333"
+no_data=-9999
+
+echo "(1/4) Setting up Minio host"
+mc --config-dir=./.mc config host add minio "${MINIO_HOST_URL}" "$MINIO_ACCESS_KEY" "$MINIO_SECRET_KEY"
+
+mkdir -p ./climate_stack
+cd ./climate_stack
+
+echo "(2/4) Copying source rasters from Minio"
+mc --config-dir=../.mc cp "minio/raster/NORM_6190_Precip.tif" "./"
+mc --config-dir=../.mc cp "minio/raster/WNA_et0.tif" "./"
+mc --config-dir=../.mc cp "minio/raster/BC_Area_Hillshade_3005.tif" "./"
+
+echo "(3/4) Resampling rasters onto a common grid"
+warp() {
+  gdalwarp -overwrite -t_srs EPSG:4326 -te $extent -tr "$resolution" "$resolution" -tap \
+    -ot Float32 -srcnodata "$2" -dstnodata "$no_data" -r "$3" -co TILED=YES "$1" "$4"
+}
+warp NORM_6190_Precip.tif -9999 near 01_precip.tif
+warp WNA_et0.tif -32768 near 02_pet.tif
+warp BC_Area_Hillshade_3005.tif -32768 bilinear 03_hillshade.tif
+
+echo "(4/4) Creating the multi-band COG"
+gdalbuildvrt -separate stack.vrt 01_precip.tif 02_pet.tif 03_hillshade.tif
+# COG bands are pixel interleaved, so each block holds all three bands and a window is
+# fetched with one set of range requests.  The overviews (used for large watersheds) are
+# averages of the valid cells, so their means stay close to the full resolution means.
+gdal_translate -of COG -a_nodata "$no_data" -co COMPRESS=DEFLATE -co PREDICTOR=YES -co BLOCKSIZE=512 \
+  -co OVERVIEWS=IGNORE_EXISTING -co RESAMPLING=AVERAGE \
+  stack.vrt BC_Climate_Stack_4326.tif
+
+mc --config-dir=../.mc cp "./BC_Climate_Stack_4326.tif" "minio/raster/BC_Climate_Stack_4326.tif"
+
+cd ..
+rm -rf ./climate_stack
+
+echo "Finished."
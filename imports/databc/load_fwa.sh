@@ -35,4 +35,10 @@ last_updated=$(./mc --config-dir=./.mc ls "minio/geojson/$1.zip" --json | jq .la
 
 psql "postgres://wally:$POSTGRES_PASSWORD@$POSTGRES_SERVER:5432/wally" -c "UPDATE metadata.data_source SET last_updated_data = '$last_updated' WHERE data_table_name = '$1';"
 
+if [ "$1" = "freshwater_atlas_watersheds" ]; then
+  # rebuild the pre-dissolved tributary sub-basins used to assemble upstream catchments.
+  echo "Refreshing fwa_watershed_code_dissolved (this can take a while)"
+  psql "postgres://wally:$POSTGRES_PASSWORD@$POSTGRES_SERVER:5432/wally" -c "SELECT refresh_fwa_watershed_code_dissolved();"
+fi
+
 echo "Finished."